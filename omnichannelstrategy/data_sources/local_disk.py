@@ -1,5 +1,9 @@
 import os
+import uuid
+import shutil
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 
 
@@ -23,5 +27,156 @@ def get_local_parquet(custom_file_path: str=None) -> pd.DataFrame:
 
     return local_df
 
+
+def iter_local_parquet(custom_file_path: str=None, batch_size: int=500_000, columns: list=None):
+    """
+    This function is the chunked counterpart of `get_local_parquet`.
+    It iterates over the record batches of the local data files (.parquet) and yields them one by one as pandas DataFrames.
+    `custom_file_path` can be a single parquet file or a directory of parquet files (default: LOCAL_DATA_PATH).
+    Peak memory is bounded by `batch_size` (number of rows per batch) and the row group size of the files, not by the size of the table.
+    """
+
+    PATH = os.getenv("LOCAL_DATA_PATH")
+
+    if custom_file_path:
+        PATH = custom_file_path
+
+    print(f"Streaming local data from {PATH} in batches of {batch_size} rows.")
+
+    dataset = ds.dataset(PATH, format="parquet")
+
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size, batch_readahead=1, fragment_readahead=1):
+        yield batch.to_pandas()
+
+
+def save_local_parquet_batches(dfs, target_file_path: str, schema: pa.Schema=None) -> int:
+    """
+    This function takes an iterable of pandas DataFrames (eg. a generator of cleaned chunks)
+    and writes them incrementally into one local parquet file (one row group per DataFrame).
+    The `schema` (default: schema of the first non-empty DataFrame) is used for the whole file, the DataFrames are cast to it and empty DataFrames are skipped.
+    The data types of the DataFrames must not depend on the values of the chunk (eg. downcast integers or categories),
+    otherwise the cast fails. Use `vectorized_basic_cleaning` with `lean_dtypes=True` (fixed data types) or pass a wide enough `schema`.
+    It returns the number of rows written.
+    """
+
+    writer = None
+    num_rows = 0
+
+    try:
+        for df in dfs:
+            if df.empty:
+                continue
+
+            if writer is None:
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                writer = pq.ParquetWriter(target_file_path, table.schema)
+            else:
+                table = pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False)
+
+            writer.write_table(table)
+            num_rows += table.num_rows
+
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print(f"Saved {num_rows} rows to {target_file_path}")
+
+    return num_rows
+
+
+def save_local_partitioned_parquet(df: pd.DataFrame, target_path: str, partition_cols: list=['year_quarter', 'Group']) -> int:
+    """
+    This function saves a pandas DataFrame (eg. the aggregated panel or the treated order data) as a Hive-partitioned parquet dataset
+    in the directory `target_path` (eg. `target_path/year_quarter=2015Q3/Group=Non_Store/part-0.parquet`).
+    Period partition columns (`year_quarter`) are written as strings like `2015Q3` and turned back into Periods by `get_local_partitioned_parquet`.
+    The dataset is first written to a temporary directory next to `target_path` and only then moved into place, so readers never see a partially written dataset.
+    CAUTION: replacing an existing dataset is not atomic. The old dataset is renamed to `{target_path}.old-{uuid}` before the new one is moved into place,
+    a reader in between these two renames finds no dataset at `target_path`. If moving the new dataset fails, the old dataset is moved back.
+    It returns the number of rows written.
+    """
+
+    ## partition values have to be strings or numbers, Periods are stored as strings and their frequency is kept in the schema metadata
+    period_columns = {column: df[column].dtype.freq.freqstr for column in partition_cols if isinstance(df[column].dtype, pd.PeriodDtype)}
+    df = df.assign(**{column: df[column].astype(str) for column in period_columns})
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'partition_periods'] = ",".join(f"{column}:{freq}" for column, freq in period_columns.items()).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    target_path = target_path.rstrip(os.sep)
+    temp_path = f"{target_path}.tmp-{uuid.uuid4().hex}"
+    old_path = f"{target_path}.old-{uuid.uuid4().hex}"
+
+    try:
+        ds.write_dataset(table, temp_path, format="parquet", partitioning=partition_cols, partitioning_flavor="hive",
+                         basename_template="part-{i}.parquet", existing_data_behavior="error")
+
+        ## swap the new dataset into place (two renames), the old one is only removed after the new one is in place
+        if os.path.exists(target_path):
+            os.replace(target_path, old_path)
+
+        try:
+            os.replace(temp_path, target_path)
+        except OSError:
+            if os.path.exists(old_path):
+                os.replace(old_path, target_path)
+            raise
+
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    print(f"Saved {table.num_rows} rows to {target_path} (partitioned by {', '.join(partition_cols)})")
+
+    return table.num_rows
+
+
+def get_local_partitioned_parquet(target_path: str, columns: list=None, filters=None) -> pd.DataFrame:
+    """
+    This function loads a Hive-partitioned parquet dataset written by `save_local_partitioned_parquet`.
+    Only the `columns` given are read (default: all columns).
+    `filters` can be a pyarrow expression or filters in the DNF format of `pyarrow.parquet` (eg. `[('Group', 'in', ['Non_Store', 'Early_Store'])]`),
+    Period values in the filters are compared as strings like `2015Q3`.
+    Filters on partition columns skip whole partitions without reading them, filters on other columns are pushed down to the parquet row groups.
+    The partition columns are the last columns of the returned DataFrame and the rows are ordered by partition.
+    """
+
+    dataset = ds.dataset(target_path, format="parquet", partitioning="hive")
+
+    ## frequencies of the partition columns that were Periods before saving
+    metadata = (dataset.schema.metadata or {}).get(b'partition_periods', b'').decode()
+    period_columns = dict(item.split(":") for item in metadata.split(",") if item)
+
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(_periods_to_str(filters))
+
+    print(f"Loading local data from {target_path}.")
+
+    df = dataset.to_table(columns=columns, filter=filters).to_pandas()
+
+    for column, freq in period_columns.items():
+        if column in df.columns:
+            df[column] = pd.PeriodIndex(df[column], freq=freq).to_series(index=df.index)
+
+    return df
+
+
+def _periods_to_str(filters):
+    # converts Period values in DNF filters (nested lists of (column, operator, value) tuples) to strings like `2015Q3`
+    if isinstance(filters, tuple):
+        column, operator, value = filters
+        if isinstance(value, (list, set, tuple)):
+            value = [str(item) if isinstance(item, pd.Period) else item for item in value]
+        elif isinstance(value, pd.Period):
+            value = str(value)
+        return (column, operator, value)
+
+    return [_periods_to_str(item) for item in filters]
+
+
 ### Code Annotations ###
 # read one file: pd.read_parquet('file.parquet', engine='pyarrow')
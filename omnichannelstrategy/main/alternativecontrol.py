@@ -2,47 +2,17 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
-from sklearn.neighbors import NearestNeighbors
 from omnichannelstrategy.preprocessing.syntheticcontrol import get_before_after_opening_quarters
+from omnichannelstrategy.main.matching import add_nearest_neighbors
 
-def get_nearest_neigbors(df_input, num_neighbors=1, earliest_qt_column='order_value_2013Q2'):
+def get_nearest_neigbors(df_input, num_neighbors=1, earliest_qt_column='order_value_2013Q2', cache_dir=None, standardize=True):
+    """
+    Matches each treated postal code to its `num_neighbors` nearest control postal codes on `credit_score`, `population_density_per_sqkm`
+    and `earliest_qt_column` and appends their rows as `Matched_Control` (see `matching.add_nearest_neighbors`).
+    The covariates are standardized (unless `standardize` is False) and the fitted index is cached in `cache_dir` (if given).
+    """
 
-    df = df_input
-
-    # Keep just one observations per shipping_post_code
-    earliest_yq = df.year_quarter.min()
-    df_obs = df[df['year_quarter']==earliest_yq]
-
-    assert df_obs.duplicated(subset=['shipping_post_code']).sum() == 0 # no duplicates
-    df_obs = df_obs[['Treatment', 'credit_score', 'population_density_per_sqkm', earliest_qt_column]]
-    Control_df = df_obs[df_obs['Treatment'] == 0].loc[:,df_obs.columns != 'Treatment']
-    Treatment_df = df_obs[df_obs['Treatment'] == 1].loc[:,df_obs.columns != 'Treatment']
-
-    # Determine Nearest Neighbors
-    neigh = NearestNeighbors()
-    neigh.fit(Control_df)
-
-    if num_neighbors == 1:
-        neighbor_index = neigh.kneighbors(X=Treatment_df, n_neighbors=1, return_distance=False)[:,0] # If number of neighbors is 1
-
-    else:
-        neighbor_index = neigh.kneighbors(X=Treatment_df, n_neighbors=num_neighbors, return_distance=False).flatten()
-
-    # Create df with the matched control rows
-    result_df = Control_df.iloc[neighbor_index].reset_index()
-    result_df = result_df.drop(columns=['credit_score', 'population_density_per_sqkm', earliest_qt_column])
-
-    # Get the shipping codes of the matched control rows
-    df_Control_Shipping_Code = pd.merge(result_df, df, how='left', left_on='index', right_index=True)
-    df_Control_Shipping_Code = df_Control_Shipping_Code[['shipping_post_code']]
-
-    # Merge them back to the main dataset
-    df_Matched_Controls = pd.merge(df_Control_Shipping_Code, df, how='left', left_on='shipping_post_code', right_on='shipping_post_code')
-    df_Matched_Controls['Group'] = "Matched_Control"
-    assert len(df_Matched_Controls.columns) == len(df.columns)
-    df = pd.concat([df, df_Matched_Controls]).reset_index()
-
-    return df
+    return add_nearest_neighbors(df_input, num_neighbors=num_neighbors, baseline_column=earliest_qt_column, cache_dir=cache_dir, standardize=standardize)
 
 def alternative_control_preprocessing(df_input: pd.DataFrame,
                       treatment_area: str,
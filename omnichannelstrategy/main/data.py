@@ -2,20 +2,26 @@ import os
 import pandas as pd
 
 from omnichannelstrategy.data_sources.big_query import get_bq_data, save_to_bq
-from omnichannelstrategy.data_sources.local_disk import get_local_parquet
+from omnichannelstrategy.data_sources.local_disk import get_local_parquet, iter_local_parquet, save_local_parquet_batches, \
+                                                       get_local_partitioned_parquet, save_local_partitioned_parquet
+from omnichannelstrategy.preprocessing.cleaning import iter_basic_cleaning
 
 
 def load_data(table: str=None,
               rand_sample_size: float=1,
               custom_query: str=None,
               force_local: bool=False,
-              custom_file_path: str=None) -> pd.DataFrame:
+              custom_file_path: str=None,
+              columns: list=None,
+              filters=None) -> pd.DataFrame:
     """
     This function loads the data either from Google BigQuery or from a local file path.
     The decision follows the environmental variable DATA_SOURCE (see .env file).
     If DATA_SOURCE is set to `bigquery` the data will be loaded from BigQuery.
     If DATA_SOURCE is set to `local` the data will be loaded locally.
     Both paths have to be specified. See get_bq_data or get_local_parquet for further documentation.
+    Locally, a `table` saved with `save_data` is loaded from the partitioned dataset in LOCAL_DATASET_PATH/`table`,
+    reading only the given `columns` and the partitions / row groups matching `filters` (see get_local_partitioned_parquet).
     """
 
     DATA_SOURCE = os.getenv("DATA_SOURCE")
@@ -26,18 +32,25 @@ def load_data(table: str=None,
 
     if DATA_SOURCE == 'local' or force_local:
 
+        if table and not custom_file_path:
+            return get_local_partitioned_parquet(os.path.join(os.getenv("LOCAL_DATASET_PATH"), table), columns=columns, filters=filters)
+
         return get_local_parquet(custom_file_path=custom_file_path)
 
     raise ValueError("No proper data source specified in local environment (.env file)")
 
 
-def save_data(df: pd.DataFrame, schema: list=None, target_table: str=None):
+def save_data(df: pd.DataFrame,
+              schema: list=None,
+              target_table: str=None,
+              force_local: bool=False,
+              partition_cols: list=['year_quarter', 'Group']):
     """
     This function either saves the data locally or uploads it to Google BigQuery.
     The decision follows the environmental variable DATA_SOURCE (see .env file).
     If DATA_SOURCE is set to `bigquery` the data will be uploaded to BigQuery.
-    If DATA_SOURCE is set to `local` the data will be saved locally.
-    IMPORTANT NOTICE: At the moment, the option for local saving is yet to be implemented.
+    If DATA_SOURCE is set to `local` the data will be saved locally as a Hive-partitioned parquet dataset
+    (by `partition_cols`) in LOCAL_DATASET_PATH/`target_table`, replacing an existing dataset (see save_local_partitioned_parquet).
     """
 
     DATA_SOURCE = os.getenv("DATA_SOURCE")
@@ -48,8 +61,28 @@ def save_data(df: pd.DataFrame, schema: list=None, target_table: str=None):
 
         return save_to_bq(df, schema=schema, target_table=target_table)
 
-    # if DATA_SOURCE == 'local':
-        # here should be function to save parquet files locally
-        # currently not implemented and won't be in the future
+    if DATA_SOURCE == 'local' or force_local:
+        if not target_table:
+          return "Nothing happened! Please specify target table because you want to save locally!"
+
+        return save_local_partitioned_parquet(df, target_path=os.path.join(os.getenv("LOCAL_DATASET_PATH"), target_table), partition_cols=partition_cols)
 
     raise ValueError("No proper data source specified in local environment (.env file)")
+
+
+def clean_local_data(target_file_path: str,
+                     custom_file_path: str=None,
+                     batch_size: int=500_000,
+                     lean_dtypes: bool=False) -> int:
+    """
+    This function streams the local order data (.parquet) through the basic cleaning without loading the whole table.
+    The data is read in record batches of `batch_size` rows (see `iter_local_parquet`), each batch is cleaned
+    (see `vectorized_basic_cleaning`) and written incrementally to `target_file_path`.
+    Peak memory is therefore bounded by `batch_size` and not by the size of the table.
+    It returns the number of cleaned rows written.
+    """
+
+    chunks = iter_local_parquet(custom_file_path=custom_file_path, batch_size=batch_size)
+    cleaned_chunks = iter_basic_cleaning(chunks, lean_dtypes=lean_dtypes)
+
+    return save_local_parquet_batches(cleaned_chunks, target_file_path=target_file_path)
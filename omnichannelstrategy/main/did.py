@@ -1,7 +1,8 @@
 import pandas as pd
 import numpy as np
 
-from sklearn.neighbors import NearestNeighbors
+from omnichannelstrategy.preprocessing.compactpanel import CompactPanel
+from omnichannelstrategy.main.matching import add_nearest_neighbors
 
 def did_preprocessing(df_input: pd.DataFrame,
                       first_quarter='2013Q2',
@@ -10,13 +11,30 @@ def did_preprocessing(df_input: pd.DataFrame,
                       num_quarter_before=12,
                       num_quarter_after=12,
                       num_neighbors=1) -> pd.DataFrame:
+  """
+  This function adds the `order_value` of the `first_quarter` (`order_value_firstQ`), distance buckets and its quartile to the treated and aggregated panel.
+  Instead of a DataFrame, `df_input` can be a `CompactPanel`. Then steps 1-3 (which only add time-invariant columns) run on one row per postal code
+  (the `first_quarter`) and the long DataFrame is materialized once at the end, without merging onto the long panel.
+  """
 
-  df = df_input.copy()
+  if isinstance(df_input, CompactPanel):
+    panel = df_input.dropna(subset=["latitude"]) if dropna else df_input
+
+    if pd.Period(first_quarter, freq='Q') not in panel.quarters:
+      raise ValueError(f"First quarter {first_quarter} is not in the panel.")
+
+    ## one row per postal code with the `order_value` of the first quarter
+    df = panel.attributes.reset_index()
+    df['year_quarter'] = pd.Period(first_quarter, freq='Q')
+    df['order_value'] = panel.measure('order_value', quarters=[first_quarter])[:, 0]
+
+  else:
+    df = df_input.copy()
 
-  # # 0. Drop NaN
-  # ## drop postal codes where there is not latitude/longitude because they might be wrong but be assigned to control group "Non_Store"
-  if dropna:
-      df.dropna(subset=["latitude"], inplace=True)
+    # # 0. Drop NaN
+    # ## drop postal codes where there is not latitude/longitude because they might be wrong but be assigned to control group "Non_Store"
+    if dropna:
+        df.dropna(subset=["latitude"], inplace=True)
 
   # 1. Additional Outcome Variables
   ## create 2015Q1 `order_value` as constant variable
@@ -65,6 +83,11 @@ def did_preprocessing(df_input: pd.DataFrame,
   temp_df = temp_df.loc[:, ['shipping_post_code', 'quantile_order_value_firstQ']]
   df = pd.merge(df, temp_df, how='left', left_on='shipping_post_code', right_on='shipping_post_code')
 
+  if isinstance(df_input, CompactPanel):
+    ## attributes of the panel (changed eg. `treatment_store_distance`) and new postal code columns replace the attributes, then the long DataFrame is materialized
+    attribute_columns = [column for column in df.columns if column in panel.attributes.columns or column not in panel.columns]
+    df = panel.with_attributes(df.set_index('shipping_post_code')[attribute_columns]).to_long()
+
   return df
 
 
@@ -85,45 +108,15 @@ def get_before_after_opening_quarters(df, treatment_area, num_quarter_before = 1
     return df
 
 
-def get_nearest_neighbors(input_df, num_neighbors=1):
-
-    df = input_df
-
-    # Keep just one observations per shipping_post_code
-    #df_obs = df[df['year_quarter']=="2015Q1"]
-    earliest_yq = df.year_quarter.min()
-    df_obs = df[df['year_quarter']==earliest_yq]
-
-    assert df_obs.duplicated(subset=['shipping_post_code']).sum() == 0 # no duplicates
-    df_obs = df_obs[['Treatment', 'credit_score', 'population_density_per_sqkm', 'order_value_firstQ']]
-    Control_df = df_obs[df_obs['Treatment'] == 0].loc[:,df_obs.columns != 'Treatment']
-    Treatment_df = df_obs[df_obs['Treatment'] == 1].loc[:,df_obs.columns != 'Treatment']
+def get_nearest_neighbors(input_df, num_neighbors=1, cache_dir=None, standardize=True):
+    """
+    Matches each treated postal code to its `num_neighbors` nearest control postal codes on `credit_score`, `population_density_per_sqkm`
+    and `order_value_firstQ` and appends their rows as `Matched_Control` (see `matching.add_nearest_neighbors`).
+    The covariates are standardized (unless `standardize` is False) and the fitted index is cached in `cache_dir` (if given).
+    To match several treatment areas with one index and one query, use `matching.nearest_neighbors_by_city`.
+    """
 
-    # Determine Nearest Neighbors
-    neigh = NearestNeighbors()
-    neigh.fit(Control_df)
-
-    if num_neighbors == 1:
-        neighbor_index = neigh.kneighbors(X=Treatment_df, n_neighbors=1, return_distance=False)[:,0] # If number of neighbors is 1
-
-    else:
-        neighbor_index = neigh.kneighbors(X=Treatment_df, n_neighbors=num_neighbors, return_distance=False).flatten()
-
-    # Create df with the matched control rows
-    result_df = Control_df.iloc[neighbor_index].reset_index()
-    result_df = result_df.drop(columns=['credit_score', 'population_density_per_sqkm', 'order_value_firstQ'])
-
-    # Get the shipping codes of the matched control rows
-    df_Control_Shipping_Code = pd.merge(result_df, df, how='left', left_on='index', right_index=True)
-    df_Control_Shipping_Code = df_Control_Shipping_Code[['shipping_post_code']]
-
-    # Merge them back to the main dataset
-    df_Matched_Controls = pd.merge(df_Control_Shipping_Code, df, how='left', left_on='shipping_post_code', right_on='shipping_post_code')
-    df_Matched_Controls['Group'] = "Matched_Control"
-    assert len(df_Matched_Controls.columns) == len(df.columns)
-    df = pd.concat([df, df_Matched_Controls]).reset_index()
-
-    return df
+    return add_nearest_neighbors(input_df, num_neighbors=num_neighbors, baseline_column='order_value_firstQ', cache_dir=cache_dir, standardize=standardize)
 
 
 def generate_regression_city_df(input_df: pd.DataFrame,
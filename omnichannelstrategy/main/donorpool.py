@@ -0,0 +1,232 @@
+import time
+import numpy as np
+import pandas as pd
+
+from sklearn.cluster import KMeans
+from sklearn.neighbors import NearestNeighbors
+
+from omnichannelstrategy.main.matching import MATCHING_COLUMNS
+from omnichannelstrategy.main.scmplotting import CustomSynth
+
+# covariates of the KNN prefilter (plus the baseline `order_value_{earliest_quarter}`), the same as of the nearest neighbor matching
+KNN_COLUMNS = MATCHING_COLUMNS
+
+
+def _donor_covariates(df: pd.DataFrame, treatment_area: str, covariates: list, id_var: str) -> tuple:
+    # one row of (time-invariant) covariates per postal code: treated unit (1 x covariates) and donors (donors x covariates)
+    df_units = df.groupby(id_var, sort=True)[covariates].first()
+
+    return df_units.loc[[treatment_area]], df_units.drop(index=treatment_area)
+
+
+def _pre_period_outcomes(df: pd.DataFrame, treatment_area: str, treatment_period: int, outcome_var: str, id_var: str, time_var: str) -> tuple:
+    # pre-period trajectories of the outcome: treated unit (1-d array over the pre-periods) and donors (wide DataFrame, donors x pre-periods)
+    df_pre = df[df[time_var] < treatment_period]
+    df_wide = df_pre.pivot(index=id_var, columns=time_var, values=outcome_var).sort_index(axis=1)
+
+    return df_wide.loc[treatment_area].to_numpy(dtype='float64'), df_wide.drop(index=treatment_area)
+
+
+def knn_donor_filter(df: pd.DataFrame,
+                     treatment_area: str,
+                     num_donors: int=200,
+                     covariates: list=None,
+                     earliest_quarter='2013Q2',
+                     id_var: str='shipping_post_code') -> list:
+    """
+    This function takes the output of `scm_preprocessing` and returns the `num_donors` postal codes of the control group
+    that are closest to the `treatment_area` in the `covariates` (default: `credit_score`, `population_density_per_sqkm` and `order_value_{earliest_quarter}`).
+    The covariates are standardized with the mean and standard deviation of the control group first, so each covariate counts equally in the euclidean distance.
+    Missing covariates are set to the mean of the control group (standardized value 0), so postal codes are not dropped because of them.
+    """
+
+    covariates = covariates or KNN_COLUMNS + [f'order_value_{earliest_quarter}']
+    df_treated, df_donors = _donor_covariates(df, treatment_area, covariates, id_var)
+
+    if num_donors >= len(df_donors):
+        return list(df_donors.index)
+
+    # 1. Standardize with the Statistics of the Control Group
+    mean, std = df_donors.mean(), df_donors.std().replace(0, 1)
+    donors = ((df_donors - mean) / std).fillna(0).to_numpy()
+    treated = ((df_treated - mean) / std).fillna(0).to_numpy()
+
+    # 2. Nearest Neighbors of the Treated Unit
+    neigh = NearestNeighbors(n_neighbors=num_donors).fit(donors)
+    neighbor_index = neigh.kneighbors(X=treated, return_distance=False)[0]
+
+    return list(df_donors.index[neighbor_index])
+
+
+def correlation_donor_filter(df: pd.DataFrame,
+                             treatment_area: str,
+                             treatment_period: int,
+                             min_correlation: float=None,
+                             num_donors: int=None,
+                             outcome_var: str='order_value',
+                             id_var: str='shipping_post_code',
+                             time_var: str='q_since_observation') -> list:
+    """
+    This function takes the output of `scm_preprocessing` and screens the control group by the (Pearson) correlation
+    of each postal code's pre-period trajectory of `outcome_var` (`time_var` < `treatment_period`) with the trajectory of the `treatment_area`.
+    It returns the postal codes with a correlation of at least `min_correlation` (if given), at most the `num_donors` most correlated (if given),
+    ordered by decreasing correlation. Postal codes with a constant pre-period trajectory (eg. no orders at all) have no correlation and are dropped.
+    """
+
+    treated, df_donors = _pre_period_outcomes(df, treatment_area, treatment_period, outcome_var, id_var, time_var)
+
+    # 1. Correlation of All Donors at Once
+    ## centered trajectories, correlation = scalar product / product of the norms
+    treated_centered = treated - treated.mean()
+    donors_centered = df_donors.to_numpy(dtype='float64') - df_donors.to_numpy(dtype='float64').mean(axis=1, keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = (donors_centered @ treated_centered) / (np.linalg.norm(donors_centered, axis=1) * np.linalg.norm(treated_centered))
+
+    correlation = pd.Series(correlation, index=df_donors.index).dropna().sort_values(ascending=False, kind='stable')
+
+    # 2. Screening
+    if min_correlation is not None:
+        correlation = correlation[correlation >= min_correlation]
+
+    if num_donors is not None:
+        correlation = correlation.iloc[:num_donors]
+
+    return list(correlation.index)
+
+
+def composite_donors(df: pd.DataFrame,
+                     treatment_area: str,
+                     treatment_period: int,
+                     num_clusters: int=50,
+                     outcome_var: str='order_value',
+                     id_var: str='shipping_post_code',
+                     time_var: str='q_since_observation',
+                     random_seed: int=0) -> tuple:
+    """
+    This function takes the output of `scm_preprocessing` and clusters the postal codes of the control group with k-means
+    on their standardized pre-period trajectories of `outcome_var` (`time_var` < `treatment_period`) into `num_clusters` clusters.
+    Each cluster is combined to one composite donor `composite_{cluster}` in the same way `scm_preprocessing` combines the postal codes
+    of the treatment_area (mean of the numeric columns per quarter, first value of the other columns).
+    It returns the DataFrame with the treatment_area and the composite donors (same columns and sorting)
+    and a Series with the cluster of each postal code, to trace the weight of a composite donor back to its postal codes.
+    Every postal code needs a pre-period trajectory, postal codes with rows only in the post-period raise a ValueError.
+    """
+
+    _, df_donors = _pre_period_outcomes(df, treatment_area, treatment_period, outcome_var, id_var, time_var)
+    num_clusters = min(num_clusters, len(df_donors))
+
+    ## postal codes without pre-period rows cannot be clustered (and would end up in a composite donor without id)
+    missing = df.loc[(df[id_var] != treatment_area) & ~df[id_var].isin(df_donors.index), id_var].unique()
+    if len(missing) > 0:
+        raise ValueError(f"Postal codes without pre-period rows ({time_var} < {treatment_period}) cannot be combined to composite donors: {', '.join(map(str, missing))}")
+
+    # 1. Clustering of the Pre-Period Trajectories
+    ## standardized per quarter, so quarters with high order values do not dominate the distance
+    trajectories = df_donors.to_numpy(dtype='float64')
+    trajectories = (trajectories - trajectories.mean(axis=0)) / np.where(trajectories.std(axis=0) > 0, trajectories.std(axis=0), 1)
+
+    clusters = KMeans(n_clusters=num_clusters, n_init=10, random_state=random_seed).fit_predict(np.nan_to_num(trajectories))
+    donor_clusters = pd.Series([f'composite_{cluster}' for cluster in clusters], index=df_donors.index, name='composite_donor')
+
+    # 2. Composite Donors
+    ## same aggregation as for the postal codes of the treatment_area in `scm_preprocessing`
+    df_controls = df[df[id_var] != treatment_area].copy()
+    df_controls[id_var] = df_controls[id_var].map(donor_clusters)
+
+    aggregation_log = {column: 'mean' if pd.api.types.is_numeric_dtype(df[column]) else 'first' for column in df.columns if column not in [id_var, time_var]}
+    df_controls = df_controls.groupby([id_var, time_var], dropna=False).aggregate(aggregation_log).reset_index()
+
+    df = pd.concat([df[df[id_var] == treatment_area], df_controls[df.columns]], ignore_index=True)
+    df.sort_values(by=[id_var, time_var], axis=0, inplace=True)
+
+    return df, donor_clusters
+
+
+def prune_donor_pool(df: pd.DataFrame,
+                     treatment_area: str,
+                     treatment_period: int,
+                     num_knn: int=None,
+                     min_correlation: float=None,
+                     num_correlated: int=None,
+                     num_clusters: int=None,
+                     earliest_quarter='2013Q2',
+                     outcome_var: str='order_value',
+                     id_var: str='shipping_post_code',
+                     time_var: str='q_since_observation',
+                     random_seed: int=0) -> pd.DataFrame:
+    """
+    This function reduces the donor pool (control group) of the output of `scm_preprocessing` before it is passed to `CustomSynth`.
+    The stages are applied in this order, each only if its parameter is given:
+    (1) covariate KNN prefilter: keep the `num_knn` nearest postal codes (see `knn_donor_filter`),
+    (2) correlation screening of the pre-period trajectories: keep postal codes with a correlation of at least `min_correlation`
+    and at most the `num_correlated` most correlated (see `correlation_donor_filter`),
+    (3) k-means clustering of the remaining postal codes into `num_clusters` composite donors (see `composite_donors`).
+    It returns a DataFrame in the format of `scm_preprocessing` with the treatment_area and the remaining donors.
+    Use `donor_pool_report` to compare the pre-period fit and the runtime with the full donor pool.
+    """
+
+    num_donors = df[id_var].nunique() - 1
+
+    # 1. Covariate KNN Prefilter
+    if num_knn is not None:
+        donors = knn_donor_filter(df, treatment_area, num_donors=num_knn, earliest_quarter=earliest_quarter, id_var=id_var)
+        df = df[df[id_var].isin(donors + [treatment_area])]
+
+    # 2. Correlation Screening
+    if min_correlation is not None or num_correlated is not None:
+        donors = correlation_donor_filter(df, treatment_area, treatment_period, min_correlation=min_correlation, num_donors=num_correlated,
+                                          outcome_var=outcome_var, id_var=id_var, time_var=time_var)
+        df = df[df[id_var].isin(donors + [treatment_area])]
+
+    # 3. Composite Donors
+    if num_clusters is not None:
+        df, _ = composite_donors(df, treatment_area, treatment_period, num_clusters=num_clusters, outcome_var=outcome_var,
+                                 id_var=id_var, time_var=time_var, random_seed=random_seed)
+
+    print(f"Donor pool of {treatment_area}: {num_donors} -> {df[id_var].nunique() - 1} donors")
+
+    return df
+
+
+def donor_pool_report(df: pd.DataFrame,
+                      df_pruned: pd.DataFrame,
+                      treatment_area: str,
+                      treatment_period: int,
+                      columns: list=None,
+                      outcome_var: str='order_value',
+                      id_var: str='shipping_post_code',
+                      time_var: str='q_since_observation',
+                      **synth_kwargs) -> pd.DataFrame:
+    """
+    This function fits `CustomSynth` with the full (`df`) and the pruned donor pool (`df_pruned`, see `prune_donor_pool`)
+    on the given `columns` (id, time, outcome and covariates, default: `credit_score` as covariate) and the `synth_kwargs` (eg. `pen`, `n_optim`, `solver`).
+    It returns a DataFrame with one row per donor pool: number of donors, runtime of the fit in seconds, pre- and post-period RMSPE of the treated unit
+    and the treatment effect (mean post-period difference of treated unit and synthetic control),
+    as well as the pre-period fit lost (`pre_rmspe_increase`: relative increase of the pre-period RMSPE) for the runtime saved (`speedup`).
+    """
+
+    columns = columns or [id_var, time_var, outcome_var, 'credit_score']
+    report = []
+
+    for donor_pool, df_pool in [('full', df), ('pruned', df_pruned)]:
+
+        start = time.perf_counter()
+        model = CustomSynth(dataset=df_pool[columns], outcome_var=outcome_var, id_var=id_var, time_var=time_var,
+                            treatment_period=treatment_period, treated_unit=treatment_area, **synth_kwargs)
+        runtime = time.perf_counter() - start
+
+        data = model.original_data
+        rmspe = data.rmspe_df.iloc[0]
+        effect = (data.treated_outcome_all.ravel() - data.synth_outcome.ravel())[data.periods_pre_treatment:].mean()
+
+        report.append({'donor_pool': donor_pool, 'num_donors': data.n_controls, 'runtime_sec': runtime,
+                       'pre_rmspe': rmspe['pre_rmspe'], 'post_rmspe': rmspe['post_rmspe'], 'effect': effect})
+
+    df_report = pd.DataFrame(report).set_index('donor_pool')
+
+    # Fit Lost for Runtime Saved
+    df_report['pre_rmspe_increase'] = df_report['pre_rmspe'] / df_report.loc['full', 'pre_rmspe'] - 1
+    df_report['speedup'] = df_report.loc['full', 'runtime_sec'] / df_report['runtime_sec']
+
+    return df_report
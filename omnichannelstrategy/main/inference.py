@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+
+
+def stack_placebo_gaps(models: dict) -> tuple:
+    """
+    This function takes a dictionary {city: fitted `CustomSynth`} with in-space placebos (`in_space_placebo` or `parallel_in_space_placebo`)
+    and stacks the gaps (outcome - synthetic outcome) of all cities into one array of shape (cities x units x periods):
+    unit 0 is the treated unit, units 1, 2, ... are the placebo units (control units with their own synthetic control).
+    Cities with fewer units or periods are padded with NaN, as are placebo units that were not fitted (early stopping).
+    It returns the array, the number of pre-treatment periods of each city (1-d array) and the list of cities.
+    """
+
+    cities = list(models)
+    datas = [models[city].original_data for city in cities]
+
+    if any(data.in_space_placebos is None for data in datas):
+        raise ValueError("In-space placebos have to be fitted for all cities first (`in_space_placebo` or `parallel_in_space_placebo`).")
+
+    num_units = max(data.n_controls for data in datas) + 1
+    num_periods = max(data.periods_all for data in datas)
+
+    gaps = np.full((len(cities), num_units, num_periods), np.nan)
+    for idx, data in enumerate(datas):
+        gaps[idx, 0, :data.periods_all] = data.treated_outcome_all.ravel() - data.synth_outcome.ravel()
+
+        ## `in_space_placebos` are normalized as synthetic outcome - outcome, the sign is flipped to match the treated gap
+        gaps[idx, 1:data.n_controls + 1, :data.periods_all] = -np.column_stack([np.ravel(placebo) for placebo in data.in_space_placebos]).T
+
+    return gaps, np.array([data.periods_pre_treatment for data in datas]), cities
+
+
+def _period_masks(gaps: np.ndarray, periods_pre_treatment) -> tuple:
+    # boolean masks (cities x 1 x periods) of the pre- and post-treatment periods of each city
+    periods_pre_treatment = np.broadcast_to(np.asarray(periods_pre_treatment), (gaps.shape[0],))
+    pre = np.arange(gaps.shape[2])[np.newaxis, :] < periods_pre_treatment[:, np.newaxis]
+
+    return pre[:, np.newaxis, :], ~pre[:, np.newaxis, :]
+
+
+def _masked_mean(values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    # mean over the periods (last axis) within `mask`, NaN (padding) is skipped, NaN if there is no value
+    values = np.where(mask, values, np.nan)
+
+    with np.errstate(invalid='ignore'):
+        return np.nanmean(values, axis=-1) if values.shape[-1] else np.full(values.shape[:-1], np.nan)
+
+
+def rmspe_ratios(gaps: np.ndarray, periods_pre_treatment) -> tuple:
+    """
+    This function computes the pre- and post-treatment RMSPE and the post/pre RMSPE ratio of all units of all cities at once
+    from the stacked gaps (cities x units x periods, see `stack_placebo_gaps`) and the number of pre-treatment periods (scalar or one per city).
+    It returns three arrays of shape (cities x units): pre_rmspe, post_rmspe and the ratio (NaN for padded or not fitted units).
+    """
+
+    pre, post = _period_masks(gaps, periods_pre_treatment)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pre_rmspe = np.sqrt(_masked_mean(gaps ** 2, pre))
+        post_rmspe = np.sqrt(_masked_mean(gaps ** 2, post))
+
+        return pre_rmspe, post_rmspe, post_rmspe / pre_rmspe
+
+
+def post_effects(gaps: np.ndarray, periods_pre_treatment) -> np.ndarray:
+    """
+    This function returns the effect (mean gap in the post-treatment period) of all units of all cities (cities x units).
+    """
+
+    _, post = _period_masks(gaps, periods_pre_treatment)
+
+    return _masked_mean(gaps, post)
+
+
+def _extremeness(values: np.ndarray, alternative: str) -> np.ndarray:
+    # values where larger means more extreme for the given alternative
+    if alternative == 'greater':
+        return values
+    if alternative == 'less':
+        return -values
+    if alternative == 'two-sided':
+        return np.abs(values)
+
+    raise ValueError(f"Unknown alternative {alternative}, valid alternatives: greater, less, two-sided")
+
+
+def permutation_p_values(values: np.ndarray, alternative: str='greater') -> np.ndarray:
+    """
+    This function computes the exact permutation (placebo rank) p-value of the treated unit (unit 0) of each city
+    from a statistic of all units (cities x units, eg. the RMSPE ratios of `rmspe_ratios` or the effects of `post_effects`):
+    p-value = (number of units at least as extreme as the treated unit, including itself) / (number of units), NaN units are not counted.
+    `alternative` is "greater" (large values are extreme, eg. RMSPE ratios), "less" or "two-sided" (absolute values, eg. effects).
+    It returns a 1-d array with one p-value per city.
+    """
+
+    extremeness = _extremeness(values, alternative)
+    valid = ~np.isnan(values)
+
+    num_extreme = np.sum(valid & (extremeness >= extremeness[:, [0]]), axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(valid[:, 0], num_extreme / np.sum(valid, axis=1), np.nan)
+
+
+def pooled_permutation_test(values: np.ndarray,
+                            num_permutations: int=10_000,
+                            alternative: str='greater',
+                            random_seed: int=0,
+                            batch_size: int=100_000) -> dict:
+    """
+    This function tests the effect across all cities: the test statistic is the mean of the statistic of the treated units (unit 0) over the cities
+    (eg. the averaged effect of `post_effects` or the average RMSPE ratio of `rmspe_ratios`).
+    Under the null hypothesis, the treated status is randomly reassigned within each city to one of its units (treated or placebo units, NaN units excluded),
+    independently across cities. If there are at most `num_permutations` possible assignments, all of them are enumerated (exact test),
+    otherwise `num_permutations` random assignments are drawn (in batches of `batch_size`, each permutation is one gather of integer positions).
+    It returns a dictionary with the `statistic`, the `p_value` (share of assignments at least as extreme, the observed assignment counts as one),
+    the `num_permutations` and whether the test is `exact`.
+    """
+
+    extremeness = _extremeness(values, alternative)
+
+    # 1. Valid Units First
+    ## units of each city sorted so that the valid units come first (treated unit stays first), then a position < number of valid units is a valid unit
+    order = np.argsort(np.isnan(values), axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    num_valid = np.sum(~np.isnan(values), axis=1)
+    num_cities = values.shape[0]
+
+    if np.isnan(values[:, 0]).any():
+        raise ValueError("The statistic of the treated unit is NaN for at least one city.")
+
+    statistic = np.mean(values[:, 0])
+    observed = _extremeness(statistic, alternative)
+
+    # 2. Assignments (exact enumeration or random draws)
+    num_assignments = np.prod(num_valid.astype('float64'))
+    exact = num_assignments <= num_permutations
+    total = int(num_assignments) if exact else num_permutations
+
+    rng = np.random.default_rng(random_seed)
+    num_extreme = 0
+
+    for start in range(0, total, batch_size):
+        size = min(batch_size, total - start)
+
+        if exact:
+            positions = np.column_stack(np.unravel_index(np.arange(start, start + size), num_valid))
+        else:
+            positions = (rng.random((size, num_cities)) * num_valid).astype('int64')
+
+        permuted = sorted_values[np.arange(num_cities), positions].mean(axis=1)
+        num_extreme += int(np.sum(_extremeness(permuted, alternative) >= observed))
+
+    ## the exact enumeration contains the observed assignment, random draws are complemented by it
+    p_value = num_extreme / total if exact else (num_extreme + 1) / (total + 1)
+
+    return {'statistic': statistic, 'p_value': p_value, 'num_permutations': total, 'exact': bool(exact)}
+
+
+def permutation_inference(gaps: np.ndarray,
+                          periods_pre_treatment,
+                          cities: list=None,
+                          num_permutations: int=10_000,
+                          random_seed: int=0) -> pd.DataFrame:
+    """
+    This function summarizes the permutation inference of all cities from the stacked gaps (see `stack_placebo_gaps`):
+    one row per city with pre/post RMSPE and post/pre RMSPE ratio of the treated unit and its exact permutation p-value,
+    the effect (mean post-treatment gap) and its two-sided permutation p-value and the number of placebo units,
+    plus a row `pooled` with the mean over the cities and the p-values of the pooled permutation tests (`pooled_permutation_test`)
+    for the average RMSPE ratio and the averaged effect.
+    """
+
+    cities = cities if cities is not None else list(range(gaps.shape[0]))
+
+    pre_rmspe, post_rmspe, ratios = rmspe_ratios(gaps, periods_pre_treatment)
+    effects = post_effects(gaps, periods_pre_treatment)
+
+    df = pd.DataFrame({'pre_rmspe': pre_rmspe[:, 0],
+                       'post_rmspe': post_rmspe[:, 0],
+                       'post/pre': ratios[:, 0],
+                       'p_value': permutation_p_values(ratios, alternative='greater'),
+                       'effect': effects[:, 0],
+                       'effect_p_value': permutation_p_values(effects, alternative='two-sided'),
+                       'num_placebos': np.sum(~np.isnan(ratios[:, 1:]), axis=1)},
+                      index=pd.Index(cities, name='city'))
+
+    # Pooled Tests across Cities
+    ## units without a ratio (eg. not fitted) are excluded from both tests
+    effects = np.where(np.isnan(ratios), np.nan, effects)
+    ratio_test = pooled_permutation_test(ratios, num_permutations=num_permutations, alternative='greater', random_seed=random_seed)
+    effect_test = pooled_permutation_test(effects, num_permutations=num_permutations, alternative='two-sided', random_seed=random_seed)
+
+    df.loc['pooled'] = {'pre_rmspe': df['pre_rmspe'].mean(), 'post_rmspe': df['post_rmspe'].mean(), 'post/pre': ratio_test['statistic'],
+                        'p_value': ratio_test['p_value'], 'effect': effect_test['statistic'], 'effect_p_value': effect_test['p_value'],
+                        'num_placebos': df['num_placebos'].sum()}
+
+    return df
@@ -0,0 +1,197 @@
+import os
+import joblib
+import numpy as np
+import pandas as pd
+
+from sklearn.neighbors import NearestNeighbors
+
+from omnichannelstrategy.preprocessing.syntheticcontrol import get_before_after_opening_quarters
+
+# covariates of the nearest neighbor matching (plus the baseline `order_value` column), as in `get_nearest_neighbors`
+MATCHING_COLUMNS = ['credit_score', 'population_density_per_sqkm']
+
+
+class MatchingIndex():
+    """
+    Nearest neighbor index over the control postal codes (one row per postal code with the matching `covariates`).
+    The covariates are standardized with the mean and standard deviation of the control postal codes (unless `standardize` is False),
+    so each covariate counts equally in the euclidean distance. Control postal codes with missing covariates cannot be matched and are not part of the index.
+    The index is fitted once and answers the matches of any number of treated postal codes in one query.
+    It can be saved to and loaded from disk, see `get_matching_index`.
+    """
+
+    def __init__(self, df_controls: pd.DataFrame, covariates: list, standardize: bool=True):
+
+        df_controls = df_controls.dropna(subset=covariates)
+        values = df_controls[covariates].to_numpy(dtype='float64')
+
+        self.covariates = list(covariates)
+        self.post_codes = df_controls['shipping_post_code'].to_numpy()
+        self.mean = values.mean(axis=0) if standardize else np.zeros(len(covariates))
+        self.std = np.where(values.std(axis=0) > 0, values.std(axis=0), 1) if standardize else np.ones(len(covariates))
+        self.neighbors = NearestNeighbors().fit((values - self.mean) / self.std)
+        self.fingerprint = matching_fingerprint(df_controls, covariates, standardize)
+
+
+    def query(self, df_treated: pd.DataFrame, num_neighbors: int=1) -> tuple:
+        """
+        Returns the positions (in `post_codes`) of the `num_neighbors` nearest control postal codes of each row of `df_treated`
+        and their distances (in standardized units), both as arrays of shape (treated rows x num_neighbors).
+        """
+
+        values = df_treated[self.covariates].to_numpy(dtype='float64')
+
+        if np.isnan(values).any():
+            raise ValueError(f"Treated postal codes with missing matching covariates ({', '.join(self.covariates)}) cannot be matched.")
+
+        distances, positions = self.neighbors.kneighbors(X=(values - self.mean) / self.std, n_neighbors=num_neighbors)
+
+        return positions, distances
+
+
+    def save(self, file_path: str):
+        """
+        Saves the index to `file_path` (joblib). The file is written to a temporary file first and then moved into place.
+        """
+
+        temp_file_path = f"{file_path}.tmp"
+        joblib.dump(self, temp_file_path)
+        os.replace(temp_file_path, file_path)
+
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Loads an index saved with `save`.
+        """
+
+        return joblib.load(file_path)
+
+
+def matching_fingerprint(df_controls: pd.DataFrame, covariates: list, standardize: bool=True) -> str:
+    """
+    This function returns a fingerprint (hash) of the control postal codes, the covariate set and their values (eg. of the baseline quarter).
+    It identifies the saved index of a matching specification.
+    """
+
+    hashes = pd.util.hash_pandas_object(df_controls[['shipping_post_code'] + list(covariates)], index=False)
+
+    return f"{'-'.join(covariates)}-{'std' if standardize else 'raw'}-{len(hashes)}-{int(hashes.sum()) & 0xFFFFFFFFFFFFFFFF:x}"
+
+
+def get_matching_index(df_controls: pd.DataFrame, covariates: list, cache_dir: str=None, standardize: bool=True) -> MatchingIndex:
+    """
+    This function returns the `MatchingIndex` of the control postal codes `df_controls` (one row per postal code) and `covariates`.
+    With `cache_dir`, the index is saved there under its fingerprint (covariate set and values), so it is fitted only once per specification
+    and loaded on reruns (across cities, notebook sessions and specifications that share the control pool).
+    """
+
+    if not cache_dir:
+        return MatchingIndex(df_controls, covariates, standardize=standardize)
+
+    file_path = os.path.join(cache_dir, f"matching_index_{matching_fingerprint(df_controls.dropna(subset=covariates), covariates, standardize)}.joblib")
+
+    if os.path.exists(file_path):
+        return MatchingIndex.load(file_path)
+
+    matching_index = MatchingIndex(df_controls, covariates, standardize=standardize)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    matching_index.save(file_path)
+
+    return matching_index
+
+
+def _post_code_rows(df: pd.DataFrame, quarter=None) -> pd.DataFrame:
+    # one row per postal code (the `quarter`, default: earliest quarter of `df`) with the time-invariant columns
+    quarter = quarter if quarter is not None else df.year_quarter.min()
+    df_obs = df[df['year_quarter'] == quarter]
+
+    if df_obs.duplicated(subset=['shipping_post_code']).any():
+        raise ValueError("The matching needs one row per shipping_post_code and year_quarter.")
+
+    return df_obs
+
+
+def gather_matched_rows(df: pd.DataFrame, matched_post_codes) -> pd.DataFrame:
+    """
+    This function returns all rows (quarters) of each of the `matched_post_codes` in `df` (once per match, in the order of the matches)
+    with `Group` set to "Matched_Control". The rows are gathered by their integer positions instead of merging on `shipping_post_code`.
+    """
+
+    rows_by_post_code = df.groupby('shipping_post_code', sort=False).indices
+    positions = [rows_by_post_code[post_code] for post_code in matched_post_codes if post_code in rows_by_post_code]
+
+    ## fresh index (like the result of the former merges)
+    df_matched = df.iloc[np.concatenate(positions) if positions else []].reset_index(drop=True)
+    df_matched['Group'] = "Matched_Control"
+
+    return df_matched
+
+
+def add_nearest_neighbors(df_input: pd.DataFrame,
+                          num_neighbors: int=1,
+                          baseline_column: str='order_value_firstQ',
+                          covariates: list=None,
+                          matching_index: MatchingIndex=None,
+                          cache_dir: str=None,
+                          standardize: bool=True) -> pd.DataFrame:
+    """
+    This function matches each treated postal code (`Treatment` == 1) of a treatment area frame (eg. output of `get_before_after_opening_quarters`)
+    to its `num_neighbors` nearest control postal codes (`Treatment` == 0) on the `covariates` (default: `credit_score`, `population_density_per_sqkm`
+    and `baseline_column`) in the earliest quarter of the frame, using a (cached) `MatchingIndex` (or the given `matching_index`).
+    All rows of the matched control postal codes are appended once per match with `Group` "Matched_Control",
+    in the same format as `get_nearest_neighbors` (including the column `index` with the original index).
+    """
+
+    covariates = covariates or MATCHING_COLUMNS + [baseline_column]
+    df = df_input
+
+    df_obs = _post_code_rows(df)
+
+    if matching_index is None:
+        matching_index = get_matching_index(df_obs[df_obs['Treatment'] == 0], covariates, cache_dir=cache_dir, standardize=standardize)
+
+    positions, _ = matching_index.query(df_obs[df_obs['Treatment'] == 1], num_neighbors=num_neighbors)
+
+    df_matched = gather_matched_rows(df, matching_index.post_codes[positions.ravel()])
+
+    return pd.concat([df, df_matched]).reset_index()
+
+
+def nearest_neighbors_by_city(df_input: pd.DataFrame,
+                              treatment_areas: list,
+                              num_neighbors: int=1,
+                              num_quarter_before: int=12,
+                              num_quarter_after: int=12,
+                              baseline_column: str='order_value_firstQ',
+                              covariates: list=None,
+                              cache_dir: str=None,
+                              standardize: bool=True) -> dict:
+    """
+    This function does `get_before_after_opening_quarters` and the nearest neighbor matching for several `treatment_areas` at once.
+    The control pool (`Treatment` == 0) is the same for all treatment areas, so the `MatchingIndex` is built (or loaded from `cache_dir`) only once
+    and the treated postal codes of all treatment areas are matched in one batched query.
+    It returns a dictionary {treatment_area: DataFrame} in the format of `add_nearest_neighbors`.
+    """
+
+    covariates = covariates or MATCHING_COLUMNS + [baseline_column]
+
+    # 1. One Index and One Query for All Treatment Areas
+    ## matching covariates are time-invariant, so one row per postal code of the earliest quarter is used
+    df_obs = _post_code_rows(df_input)
+    df_treated = df_obs[(df_obs['Treatment'] == 1) & df_obs['treatment_store'].isin(treatment_areas)]
+
+    matching_index = get_matching_index(df_obs[df_obs['Treatment'] == 0], covariates, cache_dir=cache_dir, standardize=standardize)
+    positions, _ = matching_index.query(df_treated, num_neighbors=num_neighbors)
+    matched_post_codes = pd.DataFrame(matching_index.post_codes[positions], index=df_treated['treatment_store'].to_numpy())
+
+    # 2. Treatment Area Frames with Gathered Matches
+    results = {}
+    for treatment_area in treatment_areas:
+        df = get_before_after_opening_quarters(df_input, treatment_area, num_quarter_before=num_quarter_before, num_quarter_after=num_quarter_after)
+
+        matches = matched_post_codes.loc[[treatment_area]].to_numpy().ravel() if treatment_area in matched_post_codes.index else []
+        results[treatment_area] = pd.concat([df, gather_matched_rows(df, matches)]).reset_index()
+
+    return results
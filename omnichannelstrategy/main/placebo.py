@@ -0,0 +1,313 @@
+import os
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+from SyntheticControlMethods import Synth
+
+from omnichannelstrategy.main.scmsolver import fit_synthetic_control
+
+# arrays attached to the shared memory blocks in each worker process (set by `_attach_shared_arrays`)
+_SHARED = {}
+
+
+def _to_shared_memory(array: np.ndarray) -> tuple:
+    # copies an array into a new shared memory block and returns the block and its description for the workers
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach_shared_arrays(descriptions: dict):
+    # initializer of the worker processes: attaches the shared memory blocks (no copies, read-only views)
+    for key, (name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        array.flags.writeable = False
+        _SHARED[key] = (block, array)
+
+
+def placebo_matrices(control_outcome_all: np.ndarray, control_covariates: np.ndarray, unit: int) -> tuple:
+    """
+    This function returns the matrices for fitting a synthetic control to the control unit at position `unit` with all other control units as donors,
+    in the same format as `in_space_placebo` of SyntheticControlMethods:
+    treated outcome (periods x 1), treated covariates (covariates x 1), control outcome (periods x controls-1) and control covariates (covariates x controls-1),
+    with covariates rescaled to unit variance.
+    """
+
+    n_covariates = control_covariates.shape[0]
+
+    treated_outcome = control_outcome_all[:, unit].reshape(-1, 1)
+    control_outcome = np.delete(control_outcome_all, unit, axis=1)
+
+    ## rescale covariates to be unit variance (as `_rescale_covariate_variance`)
+    covariates = np.concatenate((control_covariates[:, [unit]], np.delete(control_covariates, unit, axis=1)), axis=1)
+    covariates = covariates / np.apply_along_axis(np.std, 0, covariates)
+
+    return treated_outcome, covariates[:, 0].reshape(n_covariates, 1), control_outcome, covariates[:, 1:]
+
+
+def _fit_in_space_placebo(unit: int, periods_pre_treatment: int, n_optim: int, random_seed: int, solver: str="library") -> tuple:
+    # executed in the worker processes: fits the synthetic control of one placebo unit with the optimizer of SyntheticControlMethods
+    # (or with `fit_synthetic_control` if `solver` is "native")
+    control_outcome_all = _SHARED['control_outcome_all'][1]
+    control_covariates = _SHARED['control_covariates'][1]
+
+    treated_outcome, treated_covariates, control_outcome, control_covariates = placebo_matrices(control_outcome_all, control_covariates, unit)
+
+    ## random restarts are drawn from a generator seeded per unit,
+    ## so the result of a unit does not depend on the order in which the workers process the units
+    rng = np.random.default_rng([random_seed, unit])
+
+    if solver == "native":
+        result = fit_synthetic_control(treated_outcome[:periods_pre_treatment], treated_covariates,
+                                       control_outcome[:periods_pre_treatment], control_covariates,
+                                       treated_covariates - control_covariates,
+                                       pen="auto", n_optim=n_optim, rng=rng, broadcast_covariates=True)
+
+        return unit, result['w']
+
+    ## minimal Synth instance for `optimize`
+    model = Synth.__new__(Synth)
+    model.method = "SC"
+    model.original_data = SimpleNamespace(rng=rng)
+    data = SimpleNamespace(n_covariates=treated_covariates.shape[0], fail_count=0, in_space_placebo_w=None)
+
+    model.optimize(treated_outcome[:periods_pre_treatment], treated_covariates,
+                   control_outcome[:periods_pre_treatment], control_covariates,
+                   treated_covariates - control_covariates,
+                   data, "in-space", "auto", n_optim)
+
+    return unit, data.in_space_placebo_w
+
+
+def run_in_space_placebos(model,
+                          n_optim: int=3,
+                          num_workers: int=None,
+                          alpha: float=None,
+                          progress_every: int=10,
+                          random_seed: int=0,
+                          solver: str=None):
+    """
+    This function runs the in-space placebo test of a fitted `CustomSynth` (or `Synth`) model in parallel:
+    a synthetic control is fitted to each control unit (with all other control units as donors) in a `ProcessPoolExecutor` with `num_workers` processes.
+    The control outcome and covariate matrices are put into shared memory once instead of being pickled for every unit.
+    Progress is printed every `progress_every` finished units.
+    If `alpha` is given, the test stops early as soon as it is decided whether the treated unit's post/pre RMSPE ratio ranks within the top `alpha`
+    (permutation p-value = rank / (number of units)). The remaining units are not fitted: their rows of `in_space_placebos` and their RMSPEs
+    in `rmspe_df` are NaN, so drop them (eg. `rmspe_df.dropna()`) before ranking or plotting, and note that which units are left out
+    depends on the order in which the workers finish.
+    The results are stored like `in_space_placebo` (`in_space_placebos`, `rmspe_df` of the model's `original_data`), so `custom_plot` keeps working.
+    Unlike the serial `in_space_placebo`, which draws the random restarts of all units one after another from the model's generator,
+    the random restarts of each unit use their own seed (`random_seed`, unit). The results are reproducible and independent of `num_workers`,
+    but in general they differ from the weights of the serial `in_space_placebo`.
+    `solver` is "library" (cvxpy-based `optimize` of SyntheticControlMethods) or "native" (`fit_synthetic_control`), default: the `solver` of the model.
+    """
+
+    data = model.original_data
+    solver = solver or getattr(model, 'solver', 'library')
+    num_workers = num_workers or os.cpu_count()
+
+    n_controls, periods_all, periods_pre_treatment = data.n_controls, data.periods_all, data.periods_pre_treatment
+
+    # 1. Treated Unit
+    ## post/pre RMSPE ratio of the treated unit (first row of `rmspe_df`), units at least as extreme count towards its rank
+    treated_ratio = data.rmspe_df["post/pre"].iloc[0]
+    num_units = n_controls + 1
+    num_extreme, num_finished = 0, 0
+
+    # 2. Shared Memory
+    outcome_block, outcome_description = _to_shared_memory(np.ascontiguousarray(data.control_outcome_all, dtype='float64'))
+    covariates_block, covariates_description = _to_shared_memory(np.ascontiguousarray(data.control_covariates, dtype='float64'))
+
+    placebo_outcomes = [np.full((1, periods_all), np.nan) for _ in range(n_controls)]
+
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_attach_shared_arrays,
+                                 initargs=({'control_outcome_all': outcome_description, 'control_covariates': covariates_description},)) as executor:
+
+            futures = [executor.submit(_fit_in_space_placebo, unit, periods_pre_treatment, n_optim, random_seed, solver) for unit in range(n_controls)]
+
+            # 3. Collect Results (in order of completion)
+            for future in as_completed(futures):
+                unit, w = future.result()
+
+                placebo_outcomes[unit] = w.T @ np.delete(data.control_outcome_all, unit, axis=1).T
+                num_finished += 1
+
+                post_rmspe, pre_rmspe = model._pre_post_rmspe(placebo_outcomes[unit], data.control_outcome_all[:, unit].T, placebo=True)
+                num_extreme += int(post_rmspe / pre_rmspe >= treated_ratio)
+
+                if progress_every and (num_finished % progress_every == 0 or num_finished == n_controls):
+                    print(f"In-space placebos: {num_finished}/{n_controls} units fitted ({num_extreme} at least as extreme as {data.treated_unit}).")
+
+                # 4. Early Stopping
+                ## rank of the treated unit is 1 + number of units at least as extreme, the remaining units can only increase it
+                if alpha is not None:
+                    min_p_value = (1 + num_extreme) / num_units
+                    max_p_value = (1 + num_extreme + n_controls - num_finished) / num_units
+
+                    if min_p_value > alpha or max_p_value <= alpha:
+                        if num_finished < n_controls:
+                            print(f"In-space placebos stopped early after {num_finished}/{n_controls} units: p-value {'>' if min_p_value > alpha else '<='} {alpha}.")
+                        for pending in futures:
+                            pending.cancel()
+                        break
+
+    finally:
+        for block in (outcome_block, covariates_block):
+            block.close()
+            block.unlink()
+
+    # 5. Store Results (same structures as `in_space_placebo`)
+    ## `rmspe_df` is reset to the treated unit first, so the runner can be called repeatedly
+    data.rmspe_df = data.rmspe_df.iloc[:1].reset_index(drop=True)
+    data.pre_post_rmspe_ratio = model._pre_post_rmspe_ratios(placebo_outcomes)
+    data.in_space_placebos = model._normalize_placebos(placebo_outcomes)
+
+    return data.rmspe_df
+
+
+def sweep_matrices(dataset: pd.DataFrame, outcome_var: str, id_var: str, time_var: str, treated_unit: str, exclude_columns: list=[]) -> dict:
+    """
+    This function builds the matrices for all candidate treatment periods of an in-time placebo sweep at once:
+    the outcome of all units (periods x units, treated unit first) and the cumulative sums of the covariates over the periods
+    (periods x covariates x units), so the pre-treatment covariate means of any treatment period are a single slice (see `in_time_placebo_matrices`).
+    As in `CustomSynth` (`_process_input_data`), all columns except `id_var`, `time_var` and `exclude_columns` are covariates (including the outcome).
+    """
+
+    covariates = [column for column in dataset.columns if column not in [id_var, time_var] and column not in exclude_columns]
+
+    ## balanced panel sorted by unit and period, treated unit first (control units in order of appearance, as in `CustomSynth`)
+    units = [treated_unit] + [unit for unit in dataset[id_var].unique() if unit != treated_unit]
+    periods = np.sort(dataset[time_var].unique())
+
+    df = dataset.set_index([id_var, time_var]).reindex(pd.MultiIndex.from_product([units, periods], names=[id_var, time_var]))
+
+    if len(df) != len(dataset):
+        raise ValueError("The in-time placebo sweep needs a balanced panel with exactly one row per unit and period.")
+
+    values = df[covariates].to_numpy(dtype='float64').reshape(len(units), len(periods), len(covariates))
+
+    return {'units': units,
+            'periods': periods,
+            'outcome_all': df[outcome_var].to_numpy(dtype='float64').reshape(len(units), len(periods)).T,
+            'covariate_sums': np.cumsum(values, axis=1).transpose(1, 2, 0)}
+
+
+def in_time_placebo_matrices(outcome_all: np.ndarray, covariate_sums: np.ndarray, periods_pre_treatment: int) -> tuple:
+    """
+    This function returns the matrices for fitting a synthetic control with the first `periods_pre_treatment` periods as pre-treatment period
+    from the output of `sweep_matrices`, in the same format as `CustomSynth`:
+    treated outcome (periods_pre_treatment x 1), treated covariates (covariates x 1), control outcome (periods_pre_treatment x controls)
+    and control covariates (covariates x controls), with covariates rescaled to unit variance (as `_rescale_covariate_variance`).
+    """
+
+    covariates = covariate_sums[periods_pre_treatment - 1] / periods_pre_treatment
+    covariates = covariates / np.std(covariates, axis=0)
+
+    return outcome_all[:periods_pre_treatment, [0]], covariates[:, [0]], outcome_all[:periods_pre_treatment, 1:], covariates[:, 1:]
+
+
+def _fit_in_time_placebos(placebo_periods: list, pen, n_optim: int, random_seed: int, arrays: dict=None) -> list:
+    # fits the synthetic control for each (placebo_period, periods_pre_treatment) in the given order, each fit warm-started from the previous one
+    # (executed in the worker processes with the arrays in shared memory, or in the main process with `arrays`)
+    arrays = arrays or {key: array for key, (_, array) in _SHARED.items()}
+
+    results, warm_start = [], {}
+    for placebo_period, periods_pre_treatment in placebo_periods:
+        treated_outcome, treated_covariates, control_outcome, control_covariates = in_time_placebo_matrices(arrays['outcome_all'], arrays['covariate_sums'], periods_pre_treatment)
+
+        result = fit_synthetic_control(treated_outcome, treated_covariates, control_outcome, control_covariates, treated_covariates - control_covariates,
+                                       pen=pen, n_optim=n_optim, rng=np.random.default_rng([random_seed, periods_pre_treatment]),
+                                       v0=warm_start.get('v'), w0=warm_start.get('w'))
+
+        ## warm start of the neighbouring period: weights and V-matrix (and penalty if it is fitted as well)
+        warm_start = {'w': result['w'], 'v': np.append(result['v'], result['pen']) if pen == "auto" else result['v']}
+        results.append((placebo_period, periods_pre_treatment, result))
+
+    return results
+
+
+def in_time_placebo_sweep(dataset: pd.DataFrame,
+                          outcome_var: str,
+                          id_var: str,
+                          time_var: str,
+                          treated_unit: str,
+                          placebo_periods: list,
+                          treatment_period=None,
+                          pen=0,
+                          n_optim: int=10,
+                          exclude_columns: list=[],
+                          num_workers: int=None,
+                          random_seed: int=0) -> pd.DataFrame:
+    """
+    This function runs in-time placebo tests for several fake treatment periods (`placebo_periods`, values of `time_var`)
+    without refitting `CustomSynth` from scratch for each of them:
+    the outcome and covariate matrices are built once for the whole window (`sweep_matrices`) and sliced per placebo period,
+    and the synthetic control of each placebo period (same loss, covariates and `pen` as `CustomSynth`, solved with `fit_synthetic_control`)
+    is warm-started from the weights of the neighbouring (next later) placebo period.
+    With `num_workers` > 1 the placebo periods are split into contiguous blocks that are fitted in a `ProcessPoolExecutor`
+    (the matrices are put into shared memory once, warm starts are used within each block).
+    The post-treatment period of a placebo ends before the actual `treatment_period` (if given), so the real treatment does not enter the placebo effect.
+    It returns a tidy DataFrame with one row per placebo period: `placebo_period`, `periods_pre_treatment`, `pre_rmspe`, `post_rmspe`, `post/pre`
+    and `effect` (mean difference of treated unit and synthetic control in the post-treatment period of the placebo).
+    """
+
+    matrices = sweep_matrices(dataset, outcome_var, id_var, time_var, treated_unit, exclude_columns=exclude_columns)
+    periods, outcome_all = matrices['periods'], matrices['outcome_all']
+
+    # 1. Placebo Periods
+    ## latest placebo period first, so each fit is warm-started from the neighbouring period
+    periods_end = np.searchsorted(periods, treatment_period) if treatment_period is not None else len(periods)
+    placebo_periods = sorted(set(placebo_periods), reverse=True)
+
+    for placebo_period in placebo_periods:
+        if not (periods[0] < placebo_period) or np.searchsorted(periods, placebo_period) >= periods_end:
+            raise ValueError(f"Placebo period {placebo_period} has to be after the first period {periods[0]} and before the treatment period {treatment_period}.")
+
+    placebo_periods = [(placebo_period, int(np.searchsorted(periods, placebo_period))) for placebo_period in placebo_periods]
+
+    # 2. Fits (serial or in contiguous blocks in parallel)
+    if num_workers and num_workers > 1 and len(placebo_periods) > 1:
+        blocks = [list(block) for block in np.array_split(np.array(placebo_periods, dtype=object), min(num_workers, len(placebo_periods)))]
+
+        outcome_block, outcome_description = _to_shared_memory(np.ascontiguousarray(outcome_all))
+        covariates_block, covariates_description = _to_shared_memory(np.ascontiguousarray(matrices['covariate_sums']))
+
+        try:
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=_attach_shared_arrays,
+                                     initargs=({'outcome_all': outcome_description, 'covariate_sums': covariates_description},)) as executor:
+
+                futures = [executor.submit(_fit_in_time_placebos, [tuple(placebo) for placebo in block], pen, n_optim, random_seed) for block in blocks]
+                results = [result for future in futures for result in future.result()]
+
+        finally:
+            for block in (outcome_block, covariates_block):
+                block.close()
+                block.unlink()
+
+    else:
+        results = _fit_in_time_placebos(placebo_periods, pen, n_optim, random_seed, arrays=matrices)
+
+    # 3. Tidy Table
+    rows = []
+    for placebo_period, periods_pre_treatment, result in results:
+        gap = outcome_all[:, 0] - outcome_all[:, 1:] @ result['w'].ravel()
+        gap_pre, gap_post = gap[:periods_pre_treatment], gap[periods_pre_treatment:periods_end]
+
+        rows.append({'placebo_period': placebo_period,
+                     'periods_pre_treatment': periods_pre_treatment,
+                     'pre_rmspe': np.sqrt(np.mean(gap_pre ** 2)),
+                     'post_rmspe': np.sqrt(np.mean(gap_post ** 2)),
+                     'effect': np.mean(gap_post),
+                     'pen': result['pen']})
+
+    df = pd.DataFrame(rows)
+    df.insert(4, 'post/pre', df['post_rmspe'] / df['pre_rmspe'])
+
+    return df.sort_values('placebo_period').reset_index(drop=True)
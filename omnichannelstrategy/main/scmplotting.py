@@ -5,6 +5,9 @@ import matplotlib.pyplot as plt
 from SyntheticControlMethods import Synth
 from SyntheticControlMethods.main import SynthBase
 
+from omnichannelstrategy.main.placebo import run_in_space_placebos, in_time_placebo_sweep
+from omnichannelstrategy.main.scmsolver import NativeOptimize
+
 # Class from SyntheticControlMethod altered to return the Figure of the Plot (everything else untouched)
 class CustomPlot(object):
     '''This class is responsible for all plotting functionality'''
@@ -218,15 +221,21 @@ class CustomPlot(object):
         return fig
 
 
-class CustomSynth(CustomPlot, Synth):
+class CustomSynth(CustomPlot, NativeOptimize, Synth):
+  """
+  Synth with the altered plot (`custom_plot`). With `solver="native"` the weights are fitted with the in-package solver
+  (see `scmsolver.fit_synthetic_control`) instead of the library's cvxpy-based `optimize`, also for the placebo tests.
+  """
 
   def __init__(self, dataset,
             outcome_var, id_var, time_var,
             treatment_period, treated_unit,
             n_optim=10, pen=0, exclude_columns=[], random_seed=0,
+            solver="library",
             **kwargs):
 
     self.method = "SC"
+    self.solver = solver
 
     original_checked_input = self._process_input_data(
         dataset, outcome_var, id_var, time_var, treatment_period, treated_unit, pen,
@@ -247,6 +256,29 @@ class CustomSynth(CustomPlot, Synth):
     self.original_data.weight_df = self._get_weight_df(self.original_data)
     self.original_data.comparison_df = self._get_comparison_df(self.original_data)
 
+  def parallel_in_space_placebo(self, n_optim=3, num_workers=None, alpha=None, progress_every=10):
+    """
+    Parallel version of `in_space_placebo` (see `run_in_space_placebos`): fits the placebo units in a process pool,
+    with optional early stopping once the rank of the treated unit's post/pre RMSPE ratio is decided for significance level `alpha`.
+    The placebo units are fitted with the `solver` of the model.
+    """
+
+    return run_in_space_placebos(self, n_optim=n_optim, num_workers=num_workers, alpha=alpha, progress_every=progress_every,
+                                 solver=self.solver)
+
+  def in_time_placebo_sweep(self, placebo_periods, n_optim=10, num_workers=None, random_seed=0):
+    """
+    In-time placebo tests for several fake treatment periods before the treatment period of the model (see `placebo.in_time_placebo_sweep`),
+    with the same dataset, covariates and penalty as the model. Returns a tidy DataFrame with pre/post RMSPE and effect per placebo period.
+    """
+
+    data = self.original_data
+    dataset = data.dataset[[data.id, data.time] + data.covariates]
+
+    return in_time_placebo_sweep(dataset, data.outcome_var, data.id, data.time, data.treated_unit, placebo_periods,
+                                 treatment_period=data.treatment_period, pen=data.pen, n_optim=n_optim, num_workers=num_workers,
+                                 random_seed=random_seed)
+
 
 def beautify_scm_plot(fig,
                       df_stores: pd.DataFrame,
@@ -0,0 +1,351 @@
+import numpy as np
+
+from itertools import combinations
+from scipy.optimize import minimize
+
+# relative tolerance of the pre-treatment loss of `fit_synthetic_control` compared with the library's `optimize` (see `loss_within_tolerance`)
+LOSS_TOLERANCE = 1e-3
+
+
+def project_to_simplex(x: np.ndarray) -> np.ndarray:
+    """
+    This function returns the euclidean projection of the vector `x` onto the probability simplex (all entries non-negative, sum of one).
+    """
+
+    u = np.sort(x)[::-1]
+    cumulative_sum = np.cumsum(u) - 1
+    rho = np.flatnonzero(u - cumulative_sum / np.arange(1, len(x) + 1) > 0)[-1]
+
+    return np.maximum(x - cumulative_sum[rho] / (rho + 1), 0)
+
+
+def simplex_weights(control_covariates: np.ndarray,
+                    target: np.ndarray,
+                    v: np.ndarray,
+                    linear: np.ndarray=None,
+                    scale: float=1.0,
+                    w0: np.ndarray=None,
+                    ridge: float=1e-8,
+                    max_iter: int=10_000,
+                    tol: float=1e-12,
+                    polish_every: int=25,
+                    gap_tol: float=1e-6) -> np.ndarray:
+    """
+    This function solves the inner problem of the synthetic control method for the donor weights w (simplex: w >= 0, sum(w) == 1):
+    minimize `scale` * sum_k v_k * ((control_covariates @ w)_k - target_k)^2 + linear @ w + ridge * sum(w^2)
+    with accelerated projected gradient descent (FISTA with adaptive restart), polished by an exact solve on the support of the iterate.
+    `w0` is the starting point (eg. the solution for a similar `v`), default: equal weights.
+    A small `ridge` makes the solution unique if more donors than covariates can reproduce the target (eg. without penalty).
+    It returns the weights as 1-d array.
+    """
+
+    n_controls = control_covariates.shape[1]
+    linear = np.zeros(n_controls) if linear is None else linear
+    w = np.full(n_controls, 1 / n_controls) if w0 is None else project_to_simplex(np.asarray(w0, dtype='float64').ravel())
+
+    # 1. Step Size
+    ## Lipschitz constant of the gradient: 2 * scale * largest eigenvalue of X0' V X0 (computed on the small covariates x covariates matrix)
+    weighted_covariates = np.sqrt(np.maximum(v, 0))[:, np.newaxis] * control_covariates
+    lipschitz = 2 * scale * np.linalg.eigvalsh(weighted_covariates @ weighted_covariates.T)[-1] + 2 * ridge
+    step = 1 / max(lipschitz, 1e-12)
+
+    def gradient(x):
+        return 2 * scale * (control_covariates.T @ (v * (control_covariates @ x - target))) + linear + 2 * ridge * x
+
+    # 2. Accelerated Projected Gradient
+    y, momentum = w.copy(), 1.0
+    for iteration in range(max_iter):
+        grad = gradient(y)
+        w_next = project_to_simplex(y - step * grad)
+
+        ## restart the momentum if it points uphill (only after an extrapolated step, a plain projected gradient step never goes uphill)
+        if momentum > 1 and grad @ (w_next - w) > 0:
+            y, momentum = w.copy(), 1.0
+            continue
+
+        momentum_next = (1 + np.sqrt(1 + 4 * momentum ** 2)) / 2
+        y = w_next + ((momentum - 1) / momentum_next) * (w_next - w)
+
+        converged = np.max(np.abs(w_next - w)) < tol
+        w, momentum = w_next, momentum_next
+
+        if converged:
+            break
+
+        # 3. Active-Set Polishing
+        ## projected gradient converges slowly along the edges of the simplex: every `polish_every` iterations,
+        ## solve the equality-constrained problem on the current support exactly and stop if it fulfills the KKT conditions
+        ## if the optimum is not unique (more donors on the optimal face than covariates), stop once the duality gap
+        ## (= gradient @ w - smallest gradient entry, an upper bound of the distance to the optimal objective) is negligible
+        if iteration % polish_every == polish_every - 1:
+            polished = _polish_on_support(w, control_covariates, target, v, linear, scale, ridge)
+            if polished is not None:
+                return polished
+
+            grad_w = gradient(w)
+            if grad_w @ w - grad_w.min() < gap_tol * max(1, np.abs(grad_w).max()):
+                break
+
+    return w
+
+
+def _polish_on_support(w: np.ndarray, control_covariates: np.ndarray, target: np.ndarray, v: np.ndarray, linear: np.ndarray, scale: float, ridge: float,
+                       tol: float=1e-10, max_changes: int=10):
+    # solves the KKT system [H + 2 ridge I, 1; 1' 0] [w_S; mu] = [2 scale X0_S' V target - linear_S; 1] on the support S of `w`,
+    # if the support is off by a few donors, donors with negative weights are dropped and the donor with the most negative multiplier is added (up to `max_changes` times),
+    # returns the solution if it is non-negative and the multipliers of the weights outside S are non-negative, otherwise None
+    support = np.flatnonzero(w > 0)
+
+    for _ in range(max_changes):
+        covariates_support = control_covariates[:, support]
+
+        kkt = np.zeros((len(support) + 1, len(support) + 1))
+        kkt[:-1, :-1] = 2 * scale * covariates_support.T @ (v[:, np.newaxis] * covariates_support) + 2 * ridge * np.eye(len(support))
+        kkt[:-1, -1] = kkt[-1, :-1] = 1
+        rhs = np.append(2 * scale * covariates_support.T @ (v * target) - linear[support], 1)
+
+        solution = np.linalg.lstsq(kkt, rhs, rcond=None)[0]
+        if not np.allclose(kkt @ solution, rhs, atol=tol):
+            return None
+
+        if (solution[:-1] < 0).any():
+            support = support[solution[:-1] > 0]
+            continue
+
+        polished = np.zeros_like(w)
+        polished[support] = solution[:-1]
+
+        ## multipliers of the non-negativity constraints: gradient + mu >= 0
+        gradient = 2 * scale * (control_covariates.T @ (v * (control_covariates @ polished - target))) + linear + 2 * ridge * polished
+        multipliers = gradient + solution[-1]
+
+        if (multipliers < -tol * max(1, np.abs(gradient).max())).any():
+            support = np.append(support, np.argmin(multipliers))
+            continue
+
+        return polished
+
+    return None
+
+
+def _least_loss_weights(control_covariates: np.ndarray, v: np.ndarray, control_outcome: np.ndarray, treated_outcome: np.ndarray, w: np.ndarray,
+                        ridge: float, max_iter: int=50, tol: float=1e-8) -> np.ndarray:
+    # tie-break of the inner problem without penalty: the optimal synthetic covariates A @ w (A = sqrt(v) X0) are unique, but many w can reproduce them,
+    # so the w with the lowest pre-treatment loss subject to A @ w == A @ `w` is selected (augmented Lagrangian, each step solved with `simplex_weights`),
+    # returns `w` if the constraint is not met within `tol` (relative) after `max_iter` steps or the loss does not decrease
+    constraint_matrix = np.sqrt(np.maximum(v, 0))[:, np.newaxis] * control_covariates
+    constraint_target = constraint_matrix @ w
+
+    ## penalty parameter of the same order as the curvature of the pre-treatment loss
+    rho = 20 * max(np.linalg.norm(control_outcome, 2) ** 2, 1e-12) / max(np.linalg.norm(constraint_matrix, 2) ** 2, 1e-12)
+    stacked_covariates = np.vstack((constraint_matrix, control_outcome))
+    stacked_target = np.concatenate((constraint_target, treated_outcome))
+    stacked_v = np.concatenate((np.full(len(constraint_target), rho / 2), np.ones(len(treated_outcome))))
+
+    def loss(x):
+        residual = treated_outcome - control_outcome @ x
+        return residual @ residual
+
+    multiplier, candidate = np.zeros(len(constraint_target)), w
+    for _ in range(max_iter):
+        candidate = simplex_weights(stacked_covariates, stacked_target, stacked_v, linear=constraint_matrix.T @ multiplier, w0=candidate, ridge=ridge)
+        violation = constraint_matrix @ candidate - constraint_target
+
+        if np.linalg.norm(violation) <= tol * max(1.0, np.linalg.norm(constraint_target)):
+            return candidate if loss(candidate) < loss(w) else w
+
+        multiplier = multiplier + rho * violation
+
+    return w
+
+
+def fit_synthetic_control(treated_outcome: np.ndarray,
+                          treated_covariates: np.ndarray,
+                          control_outcome: np.ndarray,
+                          control_covariates: np.ndarray,
+                          pairwise_difference: np.ndarray,
+                          pen=0,
+                          n_optim: int=10,
+                          rng: np.random.Generator=None,
+                          broadcast_covariates: bool=True,
+                          ridge: float=1e-8,
+                          v0: np.ndarray=None,
+                          w0: np.ndarray=None,
+                          max_supports: int=63) -> dict:
+    """
+    This function fits the synthetic control weights like `optimize` of SyntheticControlMethods, with the in-package solver `simplex_weights`
+    instead of building and solving a cvxpy problem for every evaluation:
+    the outer loop minimizes the pre-treatment outcome loss (treated_outcome - control_outcome @ w)^2 over the covariate weights v (V-matrix diagonal,
+    and the penalty if `pen` == "auto") with L-BFGS-B and `n_optim` starting points (equal weights first, then Dirichlet samples from `rng`),
+    the inner loop solves for w given v, warm-started from the previous solution.
+    With `broadcast_covariates` the covariate loss is the same as in SyntheticControlMethods for the synthetic control and in-space placebos,
+    where the (1 x covariates) treated covariates are broadcast against the (covariates x 1) synthetic covariates
+    (= each synthetic covariate is compared with every treated covariate), otherwise (in-time placebos) covariates are compared one by one.
+    `ridge` (tiny) makes the inner solution unique if the covariate loss is minimized by several donor combinations.
+    Without penalty (`pen` == 0) the covariates can typically be reproduced exactly by many donor combinations, the library's solver returns
+    an arbitrary one of them and its weights cannot be compared: here the combination with the lowest pre-treatment loss is selected
+    (see `_least_loss_weights`), and as the loss then only depends on which covariates have a positive weight in v, every support of v
+    (at most `max_supports`, otherwise each single covariate and all covariates) is evaluated instead of the flat L-BFGS-B search.
+    The result is deterministic and its loss is at most the loss of the library's weights plus `LOSS_TOLERANCE` (see `loss_within_tolerance`).
+    `v0` and `w0` warm-start the first run (eg. with the solution of a neighbouring period or placebo unit).
+    If no run finds a valid v (eg. all evaluations at v = 0 or NaN losses), the projected warm start `w0` (default: equal weights) is returned.
+    It returns a dictionary with the best `w` (controls x 1), the normalized `v`, `pen` and the pre-treatment `loss`.
+    """
+
+    rng = rng if rng is not None else np.random.default_rng(0)
+    n_covariates = control_covariates.shape[0]
+    treated_covariates = np.asarray(treated_covariates, dtype='float64').ravel()
+
+    # 1. Covariate Loss
+    ## broadcast version: sum_k v_k sum_l (X1_l - (X0 w)_k)^2 = n_covariates * sum_k v_k ((X0 w)_k - mean(X1))^2 + constant
+    if broadcast_covariates:
+        target, scale = np.full(n_covariates, treated_covariates.mean()), n_covariates
+    else:
+        target, scale = treated_covariates, 1.0
+
+    squared_difference = np.asarray(pairwise_difference, dtype='float64') ** 2
+    treated_outcome = np.asarray(treated_outcome, dtype='float64').ravel()
+
+    best = {'loss': np.inf, 'w': None, 'v': None, 'pen': None}
+    warm_w = w0
+
+    def total_loss(x):
+        nonlocal warm_w
+
+        v, pen_coef = (x[:-1], x[-1]) if pen == "auto" else (x, pen)
+
+        ## NaN losses lead L-BFGS-B to NaN covariate weights, which do not define a synthetic control either
+        if not np.isfinite(x).all():
+            return np.inf
+
+        w = simplex_weights(control_covariates, target, v, linear=pen_coef * (v @ squared_difference), scale=scale, w0=warm_w, ridge=ridge)
+
+        ## without penalty, the covariates can often be reproduced by many w: select the one with the lowest pre-treatment loss among them
+        if pen == 0:
+            w = _least_loss_weights(control_covariates, v, control_outcome, treated_outcome, w, ridge)
+
+        warm_w = w
+
+        residual = treated_outcome - control_outcome @ w
+        loss = residual @ residual
+
+        ## v = 0 (all covariates ignored) is on the boundary of the search space but does not define a synthetic control
+        if loss < best['loss'] and np.sum(v) > 0:
+            best.update(loss=loss, w=w, v=v / np.sum(v), pen=pen_coef)
+
+        return loss
+
+    # 2. Supports of V without Penalty
+    ## if the covariates can be reproduced, the optimal w (and the loss) only depend on which covariates have a positive weight, not on the weights,
+    ## so the loss is flat in v and the gradient-based outer loop cannot improve it: every support (at most `max_supports`) is evaluated instead
+    reproducible = False
+    if pen == 0:
+        supports = [support for size in range(1, n_covariates + 1) for support in combinations(range(n_covariates), size)]
+        supports = supports if len(supports) <= max_supports else [(covariate,) for covariate in range(n_covariates)] + [tuple(range(n_covariates))]
+
+        for support in supports:
+            v = np.zeros(n_covariates)
+            v[list(support)] = 1 / len(support)
+            total_loss(v)
+
+        w = simplex_weights(control_covariates, target, np.full(n_covariates, 1 / n_covariates), scale=scale, ridge=ridge)
+        reproducible = np.linalg.norm(control_covariates @ w - target) <= 1e-6 * max(1.0, np.linalg.norm(target))
+
+    # 3. Outer Loop over V (and Penalty)
+    bounds = [(0, 1)] * n_covariates + ([(0, 20)] if pen == "auto" else [])
+
+    for step in range(0 if reproducible else n_optim):
+        if step == 0:
+            x0 = np.full(n_covariates, 1 / n_covariates) if v0 is None else np.asarray(v0, dtype='float64').ravel()[:n_covariates]
+            x0 = np.append(x0, 0) if pen == "auto" else x0
+        else:
+            x0 = rng.dirichlet(np.ones(n_covariates))
+            x0 = np.append(x0, rng.lognormal(1.5, 1)) if pen == "auto" else x0
+
+        minimize(total_loss, x0, method='L-BFGS-B', bounds=bounds, options={'gtol': 1e-8})
+
+    # 4. Fallback without Valid Run
+    ## projected warm start (or equal weights) with equal covariate weights
+    if best['w'] is None:
+        n_controls = control_outcome.shape[1]
+        w = np.full(n_controls, 1 / n_controls) if w0 is None else project_to_simplex(np.asarray(w0, dtype='float64').ravel())
+        residual = treated_outcome - control_outcome @ w
+        best.update(loss=residual @ residual, w=w, v=np.full(n_covariates, 1 / n_covariates), pen=0 if pen == "auto" else pen)
+
+    best['w'] = best['w'].reshape(-1, 1)
+
+    return best
+
+
+def loss_within_tolerance(loss: float, reference_loss: float, tolerance: float=None) -> bool:
+    """
+    This function checks whether the pre-treatment `loss` of `fit_synthetic_control` is at most the `reference_loss` (eg. of the library's weights)
+    plus the relative `tolerance` (default: `LOSS_TOLERANCE`). A lower loss is always within tolerance.
+    """
+
+    tolerance = LOSS_TOLERANCE if tolerance is None else tolerance
+
+    return bool(loss <= reference_loss + tolerance * max(1.0, abs(reference_loss)))
+
+
+def same_donors(control_outcome: np.ndarray, other_control_outcome: np.ndarray) -> bool:
+    """
+    This function checks whether two control outcome matrices (periods x controls) belong to the same donors, in the same order.
+    Donors are identified by their outcome columns in the periods of both matrices (eg. the shorter pre-treatment period of an in-time placebo).
+    """
+
+    periods = min(control_outcome.shape[0], other_control_outcome.shape[0])
+
+    return control_outcome.shape[1] == other_control_outcome.shape[1] and np.array_equal(control_outcome[:periods], other_control_outcome[:periods], equal_nan=True)
+
+
+class NativeOptimize():
+    """
+    Mixin for `CustomSynth` that replaces `optimize` of SyntheticControlMethods with `fit_synthetic_control` if `self.solver` is "native"
+    (also for `in_space_placebo` and `in_time_placebo`), otherwise it calls the library's `optimize`.
+    The results are written to the same attributes (`w`, `v`, `pen`, `synth_outcome`, ..., `in_space_placebo_w`, `in_time_placebo_w`).
+    The last weights are kept in `self.warm_start` and used as starting point of the inner solver in the next fit with the same donors
+    (eg. an in-time placebo after the fit of the model), but not in the in-space placebos, where each placebo unit has a different donor set.
+    """
+
+    def optimize(self,
+                 treated_outcome, treated_covariates,
+                 control_outcome, control_covariates,
+                 pairwise_difference,
+                 data,
+                 placebo,
+                 pen, steps=8,
+                 verbose=False):
+
+        if getattr(self, 'solver', 'library') != 'native':
+            return super().optimize(treated_outcome, treated_covariates, control_outcome, control_covariates,
+                                    pairwise_difference, data, placebo, pen, steps, verbose)
+
+        warm_start = getattr(self, 'warm_start', None)
+        if warm_start is not None and not same_donors(warm_start['control_outcome'], control_outcome):
+            warm_start = None
+
+        result = fit_synthetic_control(treated_outcome, treated_covariates, control_outcome, control_covariates, pairwise_difference,
+                                       pen=pen, n_optim=steps, rng=self.original_data.rng, broadcast_covariates=(placebo != "in-time"),
+                                       w0=warm_start['w'] if warm_start else None)
+        self.warm_start = dict(result, control_outcome=control_outcome)
+
+        if verbose:
+            print(f"Native solver: loss {float(result['loss']):.6g}")
+
+        if not placebo:
+            if result['loss'] < data.min_loss:
+                data.min_loss = np.array([[result['loss']]])
+                data.w = result['w']
+                data.v = result['v']
+                data.pen = result['pen']
+                data.synth_outcome = data.w.T @ data.control_outcome_all.T
+                data.synth_covariates = data.control_covariates @ data.w
+
+        elif placebo == "in-space":
+            data.in_space_placebo_w = result['w']
+
+        elif placebo == "in-time":
+            data.in_time_placebo_w = result['w']
+
+        return
@@ -11,6 +11,11 @@ def table_schema_generator(table_types: pd.Series, force_types: dict={}) -> dict
   mask = {np.dtype("O"):'STRING',
           np.dtype("float64"):"FLOAT",
           np.dtype("int64"):"INTEGER",
+          # lean data types (see `vectorized_basic_cleaning`)
+          np.dtype("float32"):"FLOAT",
+          np.dtype("int32"):"INTEGER",
+          np.dtype("int16"):"INTEGER",
+          np.dtype("int8"):"INTEGER",
           # np.dtype("datetime64"):"DATETIME" # does not seem to work, so it has to be specified manually
           }
 
@@ -37,3 +42,16 @@ def substitute_order_value_on_return(row):
       row["net_order_value_euros"] = 0
 
   return row
+
+
+def substitute_order_values_on_return(df: pd.DataFrame) -> pd.DataFrame:
+  """
+  DataFrame-wise version of `substitute_order_value_on_return`:
+  sets the column `net_order_value_euros` to 0 for all rows
+  where the column `return_quantity` contains a 1.
+  """
+
+  df = df.copy()
+  df['net_order_value_euros'] = df['net_order_value_euros'].where(df['return_quantity'] != 1.0, 0)
+
+  return df
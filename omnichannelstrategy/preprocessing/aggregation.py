@@ -1,10 +1,10 @@
 import numpy as np
 import pandas as pd
 
-# for `df.complete` method?
-# import janitor
+# for `df.complete` method (used by `aggregate_treated_df`)
+import janitor
 
-from omnichannelstrategy.main.utils import substitute_order_value_on_return
+from omnichannelstrategy.main.utils import substitute_order_value_on_return, substitute_order_values_on_return
 
 # Function to Aggregate the Treated Data over Postal Code and Order Date Quarter
 def aggregate_treated_df(df: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFrame:
@@ -16,19 +16,8 @@ def aggregate_treated_df(df: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFr
     """
 
     # 1 Drop Obsolete Columns & Rows
-    ## drop obsolete column
-    df = df.drop(columns=['Treatment_store_2'])
-
-    ## drop orders that are too close to Swiss border
-    df = df[df['Treatment_store_1'] != "Schaffhausen"]
-    df = df[df['Treatment_store_1'] != "Basel"]
-    df = df[df['Treatment_store_1'] != "Zurich"]
-
     # 2 Time-Invariant Data
-    ## create auxiliary dataframe with all columns that are time-invariant
-    df_temp = df[['shipping_post_code', 'Treatment_store_opening_date', 'Treatment_store_distance', 'Treatment_store_1', 'Treatment', 'Group']]
-    df_temp = df_temp.drop_duplicates().reset_index(drop=True)
-    assert pd.Series(df_temp["shipping_post_code"]).is_unique # checks if each shipping post code exists only once - true
+    df, df_temp = _split_time_invariant(df)
 
     # 3 Balanced Panel - Complete Dataset
     ## ensure balanced panel by shipping_post_code and year_quarter
@@ -46,6 +35,157 @@ def aggregate_treated_df(df: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFr
                                                                             'item_line_number': 'count',
                                                                             'Post': 'max'}).reset_index()
     # 6 Merge Time-Variant and Time-Invariant
+    # 7 Clean Up
+    # 8 Time Difference
+    return _merge_time_invariant(df, df_temp, df_stores)
+
+
+# Function to Aggregate the Treated Data (Group First, then Balance the Panel)
+def vectorized_aggregate_treated_df(df: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFrame:
+    """
+    Faster version of `aggregate_treated_df` with identical output.
+    Instead of completing the order-level DataFrame (which inserts empty rows into millions of order lines)
+    and substituting returned order values row by row, it zeroes out returned order values with a vectorized `where`,
+    aggregates the existing orders first and only then reindexes the much smaller aggregated result
+    on all combinations of `shipping_post_code` and `year_quarter` (`MultiIndex.from_product`), filling empty cells with zeros.
+    """
+
+    # 1 Drop Obsolete Columns & Rows
+    # 2 Time-Invariant Data
+    df, df_temp = _split_time_invariant(df)
+
+    # 3 Adjustment of Order Value
+    # 4 Time-Variant Data = Aggregation of Post Code and Quarter
+    # 5 Balanced Panel
+    df = _aggregate_balanced(df)
+
+    # 6 Merge Time-Variant and Time-Invariant
+    # 7 Clean Up
+    # 8 Time Difference
+    return _merge_time_invariant(df, df_temp, df_stores)
+
+
+# Function to Refresh an Existing Panel with New Orders (Incremental Aggregation)
+def incremental_aggregate_treated_df(df_panel: pd.DataFrame,
+                                     df_new: pd.DataFrame,
+                                     df_stores: pd.DataFrame,
+                                     df_history: pd.DataFrame=None,
+                                     order_key: list=['order_number', 'item_line_number']) -> pd.DataFrame:
+    """
+    This function refreshes a persisted panel (output of `vectorized_aggregate_treated_df`) with new treated order lines `df_new`
+    (same format as the input of `vectorized_aggregate_treated_df`) instead of re-aggregating the full order history.
+    Only the quarters that occur in `df_new` are aggregated, the `q_since_open_{city}` columns are computed for these rows only
+    and all other rows of `df_panel` are kept as they are.
+    New postal codes are added to the panel with zero-filled rows for all existing quarters.
+    If `df_new` contains order lines of quarters that are already in the panel (eg. late returns), these quarters are re-aggregated
+    from `df_history` (the treated order lines of at least these quarters), where order lines of `df_new` replace order lines
+    of `df_history` with the same `order_key`. A ValueError is raised if such quarters exist and `df_history` is None.
+    The result is the same as a full rebuild with `vectorized_aggregate_treated_df` on all order lines.
+    """
+
+    # 1 Drop Obsolete Columns & Rows
+    # 2 Time-Invariant Data
+    df_new, df_temp_new = _split_time_invariant(df_new)
+
+    # 3 Affected Quarters
+    ## new quarters are appended, quarters that are already in the panel (late orders or returns) are re-aggregated from the history
+    panel_quarters = pd.PeriodIndex(df_panel['year_quarter'].unique(), freq='Q')
+    new_data_quarters = pd.PeriodIndex(df_new['year_quarter'].unique(), freq='Q')
+    late_quarters = new_data_quarters[new_data_quarters.isin(panel_quarters)]
+
+    if len(late_quarters) > 0:
+        if df_history is None:
+            raise ValueError(f"New orders in quarters that are already in the panel ({', '.join(late_quarters.sort_values().astype(str))}), `df_history` is needed to re-aggregate them.")
+
+        df_history, _ = _split_time_invariant(df_history[df_history['year_quarter'].isin(late_quarters)])
+        df_new = pd.concat([df_history, df_new], ignore_index=True).drop_duplicates(subset=order_key, keep='last')
+
+    # 4 Time-Invariant Data of Panel and New Postal Codes
+    ## the time-invariant columns of the panel are renamed back to the names used in `_split_time_invariant`
+    df_temp = df_panel[['shipping_post_code', 'treatment_store_opening_date', 'treatment_store_distance', 'treatment_store', 'Treatment', 'Group']]
+    df_temp = df_temp.drop_duplicates(subset='shipping_post_code').rename(columns={'treatment_store_opening_date': 'Treatment_store_opening_date',
+                                                                                   'treatment_store_distance': 'Treatment_store_distance',
+                                                                                   'treatment_store': 'Treatment_store_1'})
+    new_post_codes = ~df_temp_new['shipping_post_code'].isin(df_temp['shipping_post_code'])
+    df_temp = pd.concat([df_temp, df_temp_new[new_post_codes]], ignore_index=True)
+
+    # 5 Aggregation of Affected Quarters and New Postal Codes
+    ## all postal codes x new and late quarters
+    post_codes = pd.Index(df_temp['shipping_post_code']).sort_values()
+    df_delta = _aggregate_balanced(df_new, post_codes=post_codes, quarters=new_data_quarters.sort_values())
+
+    ## new postal codes x quarters of the panel that are not re-aggregated (no orders, so only zero-filled rows)
+    untouched_quarters = panel_quarters[~panel_quarters.isin(new_data_quarters)].sort_values()
+    df_fill = _aggregate_balanced(df_new.iloc[:0], post_codes=df_temp_new.loc[new_post_codes, 'shipping_post_code'].sort_values(), quarters=untouched_quarters)
+
+    # 6 Merge Time-Variant and Time-Invariant
+    # 7 Clean Up
+    # 8 Time Difference
+    df_delta = _merge_time_invariant(pd.concat([df_delta, df_fill], ignore_index=True), df_temp, df_stores)
+
+    # 9 Combine with Untouched Rows of the Panel
+    df = pd.concat([df_panel[df_panel['year_quarter'].isin(untouched_quarters)], df_delta], ignore_index=True)
+    df = df.sort_values(by=['shipping_post_code', 'year_quarter'], kind='mergesort').reset_index(drop=True)
+
+    return df
+
+
+def _aggregate_balanced(df: pd.DataFrame, post_codes=None, quarters=None) -> pd.DataFrame:
+    # 3 Adjustment of Order Value
+    ## sets net_order_value to 0 if return=1
+    df = substitute_order_values_on_return(df)
+
+    # 4 Time-Variant Data = Aggregation of Post Code and Quarter
+    ## order lines with a missing postal code or quarter are kept in their own groups (`dropna=False` like in `aggregate_treated_df`)
+    df = df.groupby(['shipping_post_code', 'year_quarter'], dropna=False).aggregate({'return_quantity': 'sum',
+                                                                                    'net_order_value_euros' : 'sum',
+                                                                                    'order_number': 'nunique',
+                                                                                    'item_line_number': 'count',
+                                                                                    'Post': 'max'})
+
+    ## groups with a missing key are not completed by `df.complete` either, they are added back after the reindexing
+    missing_key = df.index.get_level_values(0).isna() | df.index.get_level_values(1).isna()
+    df_missing_key = df[missing_key]
+
+    # 5 Balanced Panel
+    ## reindex on all combinations of postal codes and quarters (like `df.complete`, default: all postal codes and quarters with orders)
+    ## empty cells are zero (sums, counts) except `Post`, which is NaN like in `aggregate_treated_df`
+    post_codes = df.index.levels[0].dropna() if post_codes is None else post_codes
+    quarters = df.index.levels[1].dropna() if quarters is None else quarters
+
+    full_index = pd.MultiIndex.from_product([post_codes, quarters], names=['shipping_post_code', 'year_quarter'])
+    df = df[~missing_key].reindex(full_index)
+
+    if len(df_missing_key) > 0:
+        df = pd.concat([df, df_missing_key]).sort_index(na_position='last')
+
+    df[['return_quantity', 'net_order_value_euros']] = df[['return_quantity', 'net_order_value_euros']].fillna(0)
+    df[['order_number', 'item_line_number']] = df[['order_number', 'item_line_number']].fillna(0).astype('int64')
+
+    return df.reset_index()
+
+
+def _split_time_invariant(df: pd.DataFrame) -> tuple:
+    # 1 Drop Obsolete Columns & Rows
+    ## drop obsolete column
+    df = df.drop(columns=['Treatment_store_2'])
+
+    ## drop orders that are too close to Swiss border
+    df = df[df['Treatment_store_1'] != "Schaffhausen"]
+    df = df[df['Treatment_store_1'] != "Basel"]
+    df = df[df['Treatment_store_1'] != "Zurich"]
+
+    # 2 Time-Invariant Data
+    ## create auxiliary dataframe with all columns that are time-invariant
+    df_temp = df[['shipping_post_code', 'Treatment_store_opening_date', 'Treatment_store_distance', 'Treatment_store_1', 'Treatment', 'Group']]
+    df_temp = df_temp.drop_duplicates().reset_index(drop=True)
+    assert pd.Series(df_temp["shipping_post_code"]).is_unique # checks if each shipping post code exists only once - true
+
+    return df, df_temp
+
+
+def _merge_time_invariant(df: pd.DataFrame, df_temp: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFrame:
+    # 6 Merge Time-Variant and Time-Invariant
     ## merge back time-invariant_df
     df = pd.merge(df, df_temp, how='left', on='shipping_post_code')
 
@@ -74,47 +214,35 @@ def aggregate_treated_df(df: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFr
 def add_time_difference(df_input: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFrame:
     """
     This function takes a dataframe as input and calculates the time difference between the opening of a store and an order quarter.
-    It returns the dataframe with one additional column for each store. Those columns contain the time difference in days.
+    It returns the dataframe with one additional column for each store (`q_since_open_{city}`). Those columns contain the time difference in quarters.
     The second argument is the dataframe containing the store information for calculating the time differences.
+    The differences are computed on integer quarter ordinals (`PeriodIndex.asi8`) in one broadcast subtraction for all stores.
+    Notice: the columns are int16 (int64 before). If `year_quarter` or the opening date of a store is missing (NaT), the columns are nullable `Int16` with <NA> in these cells.
     """
 
     df = df_input.copy()
 
-    # 1 Store Opening Dates
-    ## load store opening dates from df_stores
-    store_openings = df_stores.opening_date.str.split("/").apply(lambda x: '-'.join(reversed(x)))
-    store_openings = {idx:[store_openings.loc[idx]] for idx in store_openings.index}
-
-    store_column_list = []
-
-    # 2 New Columns for Time Difference
-    ## create new columns for time diff
-    ## store `q_since_open_{city}` column name in store_column_name for easier access
-    for city in store_openings.keys():
-        store_column_name = f"q_since_open_{city}"
-        df[store_column_name] = ""
-        store_column_list.append(store_column_name)
-    df['year_quarter_dt'] = np.nan;
-
-    # 3 Transformation Into Quarters
-    ## transform year_quarter into Period-Q object (for subtraction)
-    df['year_quarter_dt'] = pd.PeriodIndex(df.year_quarter, freq='Q')
-
-    df_quarters = pd.DataFrame.from_dict(store_openings).T.reset_index()
-    df_quarters.columns = ["city", "date"]
-
-    df_quarters['quarter'] = pd.PeriodIndex(df_quarters.date, freq='Q')
-    df_quarters = df_quarters.drop("date", axis=1)
-
-    # 4 Calculation of Time Difference
-    ## for each city in df_stores (stored in store_column_list) calculate time diff
-    for col in store_column_list:
-        city_name = col.split('_')[-1]
-        city_q = df_quarters[df_quarters.city == city_name].quarter.iloc[0]
-        df[col] = df.year_quarter_dt - city_q
-
-    ## some necessary transformation of the data type
-    for col in store_column_list:
-        df[col] = df[col].apply(lambda x: x.n)
+    # 1 Store Opening Quarters
+    ## parse store opening dates from df_stores once and convert them to quarters
+    store_opening_quarters = pd.PeriodIndex(pd.to_datetime(df_stores.opening_date, format="%d/%m/%Y"), freq='Q')
+
+    # 2 Transformation Into Quarters
+    ## transform year_quarter into Period-Q object and quarter ordinals
+    year_quarter_dt = pd.PeriodIndex(df.year_quarter, freq='Q')
+
+    # 3 Calculation of Time Difference
+    ## one (rows x stores) matrix of quarter differences, one `q_since_open_{city}` column per store
+    time_difference = (year_quarter_dt.asi8[:, np.newaxis] - store_opening_quarters.asi8[np.newaxis, :]).astype('int16')
+
+    ## the ordinal of NaT is the smallest int64, these cells are masked instead
+    missing = year_quarter_dt.isna()[:, np.newaxis] | store_opening_quarters.isna()[np.newaxis, :]
+
+    for idx, city in enumerate(df_stores.index):
+        if missing.any():
+            df[f"q_since_open_{city}"] = pd.arrays.IntegerArray(time_difference[:, idx], mask=missing[:, idx])
+        else:
+            df[f"q_since_open_{city}"] = time_difference[:, idx]
+
+    df['year_quarter_dt'] = year_quarter_dt
 
     return df
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 def basic_cleaning(df: pd.DataFrame) -> pd.DataFrame:
@@ -79,3 +80,94 @@ def basic_cleaning(df: pd.DataFrame) -> pd.DataFrame:
     df = df[columns]
 
     return df
+
+
+## data types of the cleaned columns with `lean_dtypes=True`
+LEAN_DTYPES = {'webshop_country': pd.CategoricalDtype(['DE', 'AT', 'CH']),
+               'return_quantity': 'int32',
+               'order_number': 'int64',
+               'net_order_value_euros': 'float32'}
+
+
+def vectorized_basic_cleaning(df: pd.DataFrame, lean_dtypes: bool=False) -> pd.DataFrame:
+    """
+    Vectorized version of `basic_cleaning` for large (chunks of the) order_data dataset.
+    Instead of filtering and copying the DataFrame step by step, this function builds one combined validity mask
+    from column-level vectorized operations and applies it only once.
+    With `lean_dtypes=False` the output is identical to `basic_cleaning`.
+    With `lean_dtypes=True` `webshop_country` is returned as category (fixed categories DE, AT, CH), `return_quantity` as int32,
+    `order_number` as int64 and `net_order_value_euros` as float32 (values are rounded to whole euros, so float32 is exact).
+    The lean data types do not depend on the values of the chunk, so cleaned chunks can be written into one file with the same schema.
+    """
+
+    # 1. Cancelled orders & 3. Country
+    ## `FH` is the old specification of `DE`, everything else than DACH (incl. UNKNOWN) is dropped
+    mask = ((df['cancellation_flag'] == False) & df['webshop_country'].isin(['DE', 'AT', 'CH', 'FH'])).to_numpy()
+
+    # 4. Non-numeric values in numeric columns
+    ## convert only the rows that survived the first filters (keeps the resulting dtypes equal to `basic_cleaning`)
+    should_be_numeric_cols = ['order_number', 'item_line_number', 'net_order_value_euros']
+    numeric = {col: pd.to_numeric(df[col].to_numpy()[mask], errors='coerce') for col in should_be_numeric_cols}
+    numeric_mask = np.logical_and.reduce([pd.notna(values) for values in numeric.values()])
+
+    # 5. Postal Code
+    ## strip, drop NULL and check the length criteria per country (see `basic_cleaning`)
+    country = df['webshop_country'].to_numpy()[mask]
+    post_code = df['shipping_post_code'][mask].str.strip()
+    post_code_length = post_code.str.len().to_numpy()
+    is_de = np.isin(country, ['DE', 'FH'])
+    post_code_mask = post_code.notna().to_numpy() & (
+        (is_de & (post_code_length == 5)) |
+        (~is_de & (post_code_length == 4) & ~post_code.str.startswith("0").fillna(True).to_numpy().astype(bool))
+    )
+
+    # 6. Order values
+    ## round the order values and drop all order values of zero or less
+    ## the comparison with NaN (non-numeric) is False, those rows are already dropped by `numeric_mask`
+    order_value = numeric['net_order_value_euros'].astype('float').round(0)
+    value_mask = order_value > 0
+
+    # Combined Mask
+    ## position of the rows to keep in the subset (after step 1. & 3.) and in the original DataFrame
+    keep = numeric_mask & post_code_mask & value_mask
+    rows = np.flatnonzero(mask)[keep]
+
+    # 7. Redundant columns & 9. Column Order
+    ## select all kept rows once and overwrite the transformed columns
+    columns = ['order_number', 'item_line_number', 'webshop_country', 'order_date', 'shipping_post_code', 'net_order_value_euros', 'return_quantity']
+    df = df.iloc[rows, df.columns.get_indexer(columns)]
+
+    df['order_number'] = numeric['order_number'][keep]
+    df['item_line_number'] = numeric['item_line_number'][keep]
+    df['webshop_country'] = np.where(country[keep] == 'FH', 'DE', country[keep]).astype(object)
+    df['shipping_post_code'] = post_code.to_numpy()[keep]
+    df['net_order_value_euros'] = order_value[keep]
+
+    # 2. Returned items
+    df['return_quantity'] = df['return_quantity'].fillna(0).astype('int')
+
+    # 8. Datetimes
+    df['order_date'] = pd.to_datetime(df['order_date'])
+    df['year_quarter'] = pd.PeriodIndex(df['order_date'], freq='Q')
+    df['year_month'] = pd.PeriodIndex(df['order_date'], freq='M')
+    df = df.sort_values(by='order_date')
+
+    # 10. Lean Data Types
+    ## optionally reduce memory footprint of the cleaned dataset
+    ## fixed data types (no downcasting per chunk), see `save_local_parquet_batches`
+    if lean_dtypes:
+        df = df.astype(LEAN_DTYPES)
+
+    return df
+
+
+def iter_basic_cleaning(chunks, cleaning_function=vectorized_basic_cleaning, **kwargs):
+    """
+    Generator that applies the basic cleaning to each chunk of the original order_data dataset (eg. parquet record batches)
+    and yields the cleaned chunks one by one, so only one chunk has to be held in memory at a time.
+    `cleaning_function` can be `basic_cleaning` or `vectorized_basic_cleaning` (default), kwargs are passed on to it.
+    Notice: the cleaned chunks are sorted by `order_date` within each chunk only.
+    """
+
+    for chunk in chunks:
+        yield cleaning_function(chunk, **kwargs)
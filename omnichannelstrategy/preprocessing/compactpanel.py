@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+
+KEY_COLUMNS = ['shipping_post_code', 'year_quarter']
+
+## time-invariant columns of the aggregated panel (`aggregate_treated_df`) and of the postal code data merged onto it
+ATTRIBUTE_COLUMNS = ['treatment_store_opening_date', 'treatment_store_distance', 'treatment_store', 'Treatment', 'Group',
+                     'latitude', 'longitude', 'credit_score', 'population_density_per_sqkm']
+
+## columns that only depend on the quarter (`add_time_difference`)
+QUARTER_COLUMN_PREFIXES = ['q_since_open_']
+
+
+class CompactPanel():
+    """
+    Compact representation of the balanced postal code x quarter panel (output of `aggregate_treated_df`).
+    Instead of one row per postal code and quarter, it keeps
+    (1) `attributes`: time-invariant columns (eg. `treatment_store`, `Group`, `credit_score`) once per postal code (DataFrame indexed by `shipping_post_code`),
+    (2) `quarter_columns`: columns that only depend on the quarter (eg. `q_since_open_{city}`) once per quarter (1-d arrays) and
+    (3) `measures`: time-varying columns (eg. `order_value`, `number_of_orders`) as arrays of shape (postal codes x quarters),
+    stored as sparse COO matrices if only few cells are non-zero.
+    A long DataFrame in the format of the original panel is only materialized on request (`to_long`).
+    `scm_preprocessing` and `did_preprocessing` accept a CompactPanel instead of the long DataFrame.
+    """
+
+    def __init__(self, post_codes, quarters, attributes: pd.DataFrame, measures: dict, quarter_columns: dict={}, columns: list=None):
+
+        self.post_codes = pd.Index(post_codes, name='shipping_post_code')
+        self.quarters = pd.PeriodIndex(quarters, freq='Q', name='year_quarter')
+        self.attributes = attributes.set_axis(self.post_codes, axis=0)
+        self.measures = dict(measures)
+        self.quarter_columns = dict(quarter_columns)
+
+        # column order of the long DataFrame
+        self.columns = columns or KEY_COLUMNS + list(self.attributes.columns) + list(self.measures) + list(self.quarter_columns)
+
+
+    @classmethod
+    def from_long(cls, df: pd.DataFrame, attribute_columns: list=None, quarter_columns: list=None, density_threshold: float=0.25):
+        """
+        Builds a CompactPanel from a balanced long panel (one row for each combination of `shipping_post_code` and `year_quarter`).
+        The `attribute_columns` (default: the columns of `ATTRIBUTE_COLUMNS` in `df`) are stored once per postal code and the `quarter_columns`
+        (default: the columns starting with `QUARTER_COLUMN_PREFIXES`, eg. `q_since_open_{city}`) once per quarter, all other columns become measures.
+        A ValueError is raised if an attribute column is not constant for each postal code or a quarter column is not constant for each quarter.
+        Numeric measures without NaN are stored as sparse COO matrices if the share of non-zero cells is below `density_threshold`.
+        """
+
+        post_codes = pd.Index(df['shipping_post_code'].unique()).sort_values()
+        quarters = pd.PeriodIndex(df['year_quarter'].unique(), freq='Q').sort_values()
+        num_post_codes, num_quarters = len(post_codes), len(quarters)
+
+        # 1. Cell Positions
+        ## position of each row in the (postal codes x quarters) grid, every cell has to occur exactly once
+        rows = post_codes.get_indexer(df['shipping_post_code'])
+        cols = quarters.get_indexer(df['year_quarter'])
+        cells = rows * num_quarters + cols
+
+        if len(df) != num_post_codes * num_quarters or len(np.unique(cells)) != len(df):
+            raise ValueError("CompactPanel needs a balanced panel with exactly one row per shipping_post_code and year_quarter.")
+
+        ## row order that sorts the DataFrame by postal code and quarter (postal code major)
+        order = np.argsort(cells, kind='stable')
+        df = df.iloc[order].reset_index(drop=True)
+
+        value_columns = [column for column in df.columns if column not in KEY_COLUMNS]
+
+        # 2. Column Types
+        ## known columns of the panel schema, the values are checked instead of guessing the column types from them
+        if attribute_columns is None:
+            attribute_columns = [column for column in value_columns if column in ATTRIBUTE_COLUMNS]
+
+        if quarter_columns is None:
+            quarter_columns = [column for column in value_columns if column.startswith(tuple(QUARTER_COLUMN_PREFIXES))]
+
+        for column in attribute_columns:
+            if not _is_constant(df[column], np.repeat(np.arange(0, len(df), num_quarters), num_quarters)):
+                raise ValueError(f"Attribute column {column} is not constant for each shipping_post_code.")
+
+        for column in quarter_columns:
+            if column in attribute_columns or not _is_constant(df[column], np.tile(np.arange(num_quarters), num_post_codes)):
+                raise ValueError(f"Quarter column {column} is not constant for each year_quarter (or also an attribute column).")
+
+        measure_columns = [column for column in value_columns if column not in attribute_columns and column not in quarter_columns]
+
+        # 3. Compact Storage
+        attributes = df[attribute_columns].iloc[::num_quarters].reset_index(drop=True)
+        quarter_values = {column: df[column].array[:num_quarters] for column in quarter_columns}
+
+        measures = {}
+        for column in measure_columns:
+            values = df[column].to_numpy().reshape(num_post_codes, num_quarters)
+
+            if pd.api.types.is_numeric_dtype(values.dtype) and not np.isnan(values).any() and np.count_nonzero(values) < density_threshold * values.size:
+                values = sparse.coo_matrix(values)
+
+            measures[column] = values
+
+        return cls(post_codes, quarters, attributes, measures, quarter_values, columns=list(df.columns))
+
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.post_codes), len(self.quarters))
+
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate memory usage in bytes (attributes, quarter columns and measures).
+        """
+
+        measure_bytes = sum(values.data.nbytes + values.row.nbytes + values.col.nbytes if sparse.issparse(values) else values.nbytes for values in self.measures.values())
+
+        return int(self.attributes.memory_usage(deep=True).sum() + measure_bytes + sum(np.asarray(values).nbytes for values in self.quarter_columns.values()))
+
+
+    def _positions(self, post_codes=None, quarters=None) -> tuple:
+        # integer positions of the requested postal codes and quarters (default: all)
+        post_code_positions = np.arange(len(self.post_codes)) if post_codes is None else self.post_codes.get_indexer(post_codes)
+        quarter_positions = np.arange(len(self.quarters)) if quarters is None else self.quarters.get_indexer(pd.PeriodIndex(quarters, freq='Q'))
+
+        if (post_code_positions < 0).any() or (quarter_positions < 0).any():
+            raise KeyError("Postal codes or quarters are not in the panel.")
+
+        return post_code_positions, quarter_positions
+
+
+    def measure(self, column: str, post_codes=None, quarters=None) -> np.ndarray:
+        """
+        Returns a measure as dense array of shape (postal codes x quarters), optionally only for the given `post_codes` and `quarters`.
+        """
+
+        post_code_positions, quarter_positions = self._positions(post_codes, quarters)
+        values = self.measures[column]
+
+        if sparse.issparse(values):
+            return values.tocsr()[post_code_positions][:, quarter_positions].toarray()
+
+        return values[np.ix_(post_code_positions, quarter_positions)]
+
+
+    def wide(self, column: str) -> pd.DataFrame:
+        """
+        Returns a measure as wide DataFrame (index: `shipping_post_code`, columns: `year_quarter`).
+        """
+
+        return pd.DataFrame(self.measure(column), index=self.post_codes, columns=self.quarters)
+
+
+    def subset(self, post_codes=None, quarters=None):
+        """
+        Returns a new CompactPanel with only the given `post_codes` and `quarters` (default: all).
+        """
+
+        post_code_positions, quarter_positions = self._positions(post_codes, quarters)
+
+        measures = {column: sparse.coo_matrix(values.tocsr()[post_code_positions][:, quarter_positions]) if sparse.issparse(values) else values[np.ix_(post_code_positions, quarter_positions)]
+                    for column, values in self.measures.items()}
+        quarter_values = {column: values[quarter_positions] for column, values in self.quarter_columns.items()}
+
+        return CompactPanel(self.post_codes[post_code_positions], self.quarters[quarter_positions],
+                            self.attributes.iloc[post_code_positions], measures, quarter_values, columns=self.columns)
+
+
+    def dropna(self, subset: list):
+        """
+        Returns a new CompactPanel without the postal codes that have NaN in one of the attribute columns in `subset`.
+        """
+
+        return self.subset(post_codes=self.post_codes[self.attributes[subset].notna().all(axis=1).to_numpy()])
+
+
+    def with_attributes(self, df_attributes: pd.DataFrame):
+        """
+        Returns a new CompactPanel with the columns of `df_attributes` (indexed by `shipping_post_code`) added to
+        (or replacing existing columns of) the attributes. Postal codes missing in `df_attributes` get NaN.
+        New columns are appended to the column order of the long DataFrame.
+        """
+
+        attributes = self.attributes.copy()
+        df_attributes = df_attributes.reindex(self.post_codes)
+
+        for column in df_attributes.columns:
+            attributes[column] = df_attributes[column].to_numpy()
+
+        columns = self.columns + [column for column in df_attributes.columns if column not in self.columns]
+
+        return CompactPanel(self.post_codes, self.quarters, attributes, self.measures, self.quarter_columns, columns=columns)
+
+
+    def to_long(self, columns: list=None, post_codes=None, quarters=None) -> pd.DataFrame:
+        """
+        Materializes the long DataFrame (one row per postal code and quarter, sorted by `shipping_post_code` and `year_quarter`)
+        in the column order of the original panel, optionally only with the given `columns`, `post_codes` and `quarters`.
+        """
+
+        post_code_positions, quarter_positions = self._positions(post_codes, quarters)
+        num_quarters = len(quarter_positions)
+
+        row_positions = np.repeat(post_code_positions, num_quarters)
+        col_positions = np.tile(quarter_positions, len(post_code_positions))
+
+        data = {}
+        for column in (columns or self.columns):
+            if column == 'shipping_post_code':
+                data[column] = self.post_codes[row_positions]
+
+            elif column == 'year_quarter':
+                data[column] = self.quarters[col_positions]
+
+            elif column in self.attributes.columns:
+                data[column] = self.attributes[column].array.take(row_positions)
+
+            elif column in self.quarter_columns:
+                data[column] = self.quarter_columns[column].take(col_positions)
+
+            else:
+                data[column] = self.measure(column, post_codes=self.post_codes[post_code_positions], quarters=self.quarters[quarter_positions]).ravel()
+
+        return pd.DataFrame(data)
+
+
+def _is_constant(values: pd.Series, first_positions: np.ndarray) -> bool:
+    # checks if each value equals the value at `first_positions` (NaN equals NaN), eg. the first row of its postal code
+    return values.reset_index(drop=True).equals(values.iloc[first_positions].reset_index(drop=True))
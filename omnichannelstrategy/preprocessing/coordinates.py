@@ -2,64 +2,147 @@ import os
 import googlemaps
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 import geopandas as gpd
 import pgeocode
-import haversine as hs
 
+from functools import lru_cache, partial
 
-# Function for Aggregation and Adding GeoCoordinates from GoogleMaps API
-def extract_unique_post_codes_and_add_coordinates(df: pd.DataFrame) -> pd.DataFrame:
+from omnichannelstrategy.preprocessing.geocache import cached_geocode
+from omnichannelstrategy.preprocessing.spatialindex import EARTH_RADIUS_KM
+
+
+# Function for Geocoding a Postal Code with GoogleMaps API
+def get_gmaps_coordinates(country_code, postal_code, gmaps_client):
     """
-    This function takes a dataframe, extracts unique `shipping_post_codes` for the DACH countries,
-    and retrieves the geographic coordinates and address of that post code from google maps api.
-    For this function to work an active account and token for google maps API is required.
-    The function returns the dataframe of countries' unique postal codes with added geographic coordinates and address.
+    This function retrieves latitude, longitude and address of a postal code from google maps api (or any client with the same `geocode` method).
+    It returns a tuple (latitude, longitude, address), coordinates are NaN if nothing (or only the country) is found.
     """
 
-    # definition of function for actual API access
-    def get_gmaps_coordinates(country_code, postal_code, gmaps_client):
-        country_encoder = {"DE": "Germany",
-                            "AT": "Austria",
-                            "CH": "Switzerland"}
+    country_encoder = {"DE": "Germany",
+                        "AT": "Austria",
+                        "CH": "Switzerland"}
+
+    gmaps_query = f'Postal Code {postal_code} {country_encoder.get(country_code, "")}'
+    geocode_result = gmaps_client.geocode(gmaps_query)
 
-        gmaps_query = f'Postal Code {postal_code} {country_encoder.get(country_code, "")}'
-        geocode_result = gmaps_client.geocode(gmaps_query)
+    # quick fix for empty results, may have to look into later
+    if geocode_result == [] :
+        return np.nan, np.nan, country_encoder.get(country_code, "")
 
-        # quick fix for empty results, may have to look into later
-        if geocode_result == [] :
-            return np.nan, np.nan, country_encoder.get(country_code, "")
+    gmaps_coordinates = geocode_result[0]['geometry']['location']
+    gmaps_address = geocode_result[0]['formatted_address']
 
-        gmaps_coordinates = geocode_result[0]['geometry']['location']
-        gmaps_address = geocode_result[0]['formatted_address']
+    if geocode_result[0]['address_components'][0]['short_name'] == country_code:
+        gmaps_coordinates = {'lat': np.nan, 'lng': np.nan}
 
-        if geocode_result[0]['address_components'][0]['short_name'] == country_code:
-            gmaps_coordinates = {'lat': np.nan, 'lng': np.nan}
+    return gmaps_coordinates['lat'], gmaps_coordinates['lng'], gmaps_address
 
-        return gmaps_coordinates['lat'], gmaps_coordinates['lng'], gmaps_address
+
+# Function for Aggregation and Adding GeoCoordinates from GoogleMaps API
+def extract_unique_post_codes_and_add_coordinates(df: pd.DataFrame,
+                                                  gmaps_client=None,
+                                                  cache_path: str=None,
+                                                  max_workers: int=8,
+                                                  requests_per_second: float=40,
+                                                  pgeocode_coordinates: bool=True,
+                                                  df_spo: pd.DataFrame=None) -> pd.DataFrame:
+    """
+    This function takes a dataframe, extracts unique `shipping_post_codes` for the DACH countries,
+    and retrieves the geographic coordinates and address of that post code from google maps api (`gmaps_lat`, `gmaps_lng`, `gmaps_address`)
+    and, if `pgeocode_coordinates` is True, the coordinates from pgeocode (`geopd_lat`, `geopd_lng`, one query per country, see `get_lat_lng_batch`).
+    `df_spo` are the coordinates from suche-postleitzahl.org (`webshop_country`, `shipping_post_code`, `spo_lat`, `spo_lng`), if available.
+    The final `latitude` and `longitude` are taken from the first valid source (`coordinate_source`, see `reconcile_coordinates`).
+    For this function to work an active account and token for google maps API is required (unless another `gmaps_client` is passed,
+    eg. a local fake geocoder with the same `geocode` method for testing).
+    Results are cached in a SQLite file at `cache_path` (no cache if None), only postal codes missing in the cache are queried,
+    with `max_workers` concurrent requests limited to `requests_per_second` (see `geocache.cached_geocode`).
+    The function returns the dataframe of countries' unique postal codes with added geographic coordinates and address
+    (with the same columns, but no rows, if `df` has no postal codes).
+    """
 
     # Extract Unique Postal Codes per Country with GroupBy
     unique_postal_codes = df.groupby(["webshop_country", "shipping_post_code"]).size().reset_index().drop(columns=0)
 
-    # apply function to unique postal code dataframe
-    gmaps_api_key = os.getenv("GMAPS_API_KEY")
+    # Google Maps client from API key (if no other client is passed and there are postal codes to geocode)
+    if gmaps_client is None and len(unique_postal_codes) > 0:
+        gmaps_api_key = os.getenv("GMAPS_API_KEY")
+        gmaps_client = googlemaps.Client(key=gmaps_api_key)
 
-    gmaps = googlemaps.Client(key=gmaps_api_key)
+    keys = list(zip(unique_postal_codes['webshop_country'], unique_postal_codes['shipping_post_code']))
 
-    unique_postal_codes[["gmaps_lat", "gmaps_lng", "gmaps_address"]] = unique_postal_codes.apply(lambda row: get_gmaps_coordinates(country_code=row['webshop_country'], postal_code=row['shipping_post_code'], gmaps_client=gmaps), axis='columns', result_type='expand')
+    results = cached_geocode(keys,
+                             geocode_function=partial(get_gmaps_coordinates, gmaps_client=gmaps_client),
+                             cache_path=cache_path,
+                             max_workers=max_workers,
+                             requests_per_second=requests_per_second)
+
+    ## explicit columns, so an input without postal codes results in empty columns
+    unique_postal_codes[["gmaps_lat", "gmaps_lng", "gmaps_address"]] = pd.DataFrame([results[key] for key in keys], index=unique_postal_codes.index,
+                                                                                    columns=["gmaps_lat", "gmaps_lng", "gmaps_address"])
+
+    # Coordinates from pgeocode (offline postal code files)
+    if pgeocode_coordinates:
+        unique_postal_codes["geopd_lat"], unique_postal_codes["geopd_lng"] = get_lat_lng_batch(unique_postal_codes['webshop_country'], unique_postal_codes['shipping_post_code'])
+
+    # Coordinates from suche-postleitzahl.org
+    ## (without postal codes, the empty columns are added below, a merge would reorder the columns)
+    if df_spo is not None and len(unique_postal_codes) > 0:
+        df_spo = df_spo[["webshop_country", "shipping_post_code", "spo_lat", "spo_lng"]].drop_duplicates(subset=["webshop_country", "shipping_post_code"])
+        unique_postal_codes = pd.merge(unique_postal_codes, df_spo, how='left', on=["webshop_country", "shipping_post_code"])
+
+    # Reconciled Coordinates
+    ## sources that are not used count as missing
+    for column in ["geopd_lat", "geopd_lng", "spo_lat", "spo_lng"]:
+        if column not in unique_postal_codes.columns:
+            unique_postal_codes[column] = np.nan
+
+    return reconcile_coordinates(unique_postal_codes)
+
+# Function for Getting a (Cached) `pgeocode` Nominatim Instance per Country
+@lru_cache(maxsize=None)
+def get_nominatim(country: str) -> pgeocode.Nominatim:
+    """
+    This function returns the `pgeocode.Nominatim` instance of a country.
+    The instance (which loads the whole postal code file of the country) is created only once per country and process.
+    """
+
+    return pgeocode.Nominatim(country)
 
-    return unique_postal_codes
 
 # Function for Getting `pgeocode` Coordinates (Latitude, Longitude)
 def get_lan_lng(country: str, post_code: str) -> tuple:
     """
     This function retrieves the latitude and longitude for a given postal code from pgeocode and returns it as tuple
     """
-    nomi = pgeocode.Nominatim(country)
-    lat = nomi.query_postal_code([post_code]).latitude[0]
-    lng = nomi.query_postal_code([post_code]).longitude[0]
+    result = get_nominatim(country).query_postal_code([post_code])
 
-    return lat, lng
+    return result.latitude[0], result.longitude[0]
+
+
+# Function for Getting `pgeocode` Coordinates for Many Postal Codes
+def get_lat_lng_batch(countries, post_codes) -> tuple:
+    """
+    This function retrieves latitudes and longitudes from pgeocode for arrays of (country, postal code) pairs.
+    It issues one vectorized query per country (with the cached Nominatim instance, see `get_nominatim`)
+    and returns two numpy arrays (latitudes, longitudes) aligned with the input (NaN if not found).
+    """
+
+    countries = np.asarray(countries, dtype=object)
+    post_codes = np.asarray(post_codes, dtype=object)
+
+    latitudes = np.full(len(post_codes), np.nan)
+    longitudes = np.full(len(post_codes), np.nan)
+
+    for country in pd.unique(countries):
+        rows = np.flatnonzero(countries == country)
+        result = get_nominatim(country).query_postal_code(list(post_codes[rows]))
+
+        latitudes[rows] = result.latitude.to_numpy(dtype='float')
+        longitudes[rows] = result.longitude.to_numpy(dtype='float')
+
+    return latitudes, longitudes
 
 
 # Function for Retrieving Correct Geographic Coordinates (filter out nonsense addresses from google maps)
@@ -69,6 +152,8 @@ def choose_correct_coordinates(row) -> tuple:
     This function returns gmaps_lat and gmaps_lng as long as it is identified as German adress.
     Otherwise this function returns geopd_lat and geopd_lng.
     If both fail, it returns spo_lat and spo_lng.
+    Notice: the pgeocode check (`!= np.nan`) is always true, so spo_lat and spo_lng are never returned.
+    `extract_unique_post_codes_and_add_coordinates` uses the vectorized `reconcile_coordinates` instead.
     """
     if not row["gmaps_address"]:
         # random fill of na to ble excluded later
@@ -92,36 +177,160 @@ def choose_correct_coordinates(row) -> tuple:
     return latitude, longitude
 
 
+# Function for Reconciling the Geographic Coordinates of all Sources (DataFrame-wise)
+def reconcile_coordinates(df: pd.DataFrame, countries: list=["Germany", "Switzerland", "Austria"]) -> pd.DataFrame:
+    """
+    Vectorized version of `choose_correct_coordinates` for the whole postal code table.
+    It takes the three coordinate sources as columns (`gmaps_lat`/`gmaps_lng` with `gmaps_address`, `geopd_lat`/`geopd_lng`, `spo_lat`/`spo_lng`)
+    and picks per postal code the first valid source:
+    (1) gmaps, if the address ends with one of the `countries` and both coordinates are given,
+    (2) pgeocode, if both coordinates are given,
+    (3) suche-postleitzahl.org, otherwise.
+    It returns the DataFrame with the columns `latitude`, `longitude` and `coordinate_source` (`gmaps`, `pgeocode`, `spo` or NaN if no source is valid).
+    Notice: unlike `choose_correct_coordinates`, missing pgeocode coordinates fall back to the third source.
+    """
+
+    df = df.copy()
+
+    # valid country suffix of the google maps address (missing addresses are not valid)
+    address_country = df['gmaps_address'].astype('object').str.rsplit(",", n=1).str[-1].str.strip()
+    gmaps_valid = address_country.isin(countries) & df['gmaps_lat'].notna() & df['gmaps_lng'].notna()
+    geopd_valid = df['geopd_lat'].notna() & df['geopd_lng'].notna()
+    spo_valid = df['spo_lat'].notna() & df['spo_lng'].notna()
+
+    conditions = [gmaps_valid.to_numpy(), geopd_valid.to_numpy(), spo_valid.to_numpy()]
+
+    df['latitude'] = np.select(conditions, [df['gmaps_lat'], df['geopd_lat'], df['spo_lat']], np.nan)
+    df['longitude'] = np.select(conditions, [df['gmaps_lng'], df['geopd_lng'], df['spo_lng']], np.nan)
+    df['coordinate_source'] = np.select(conditions, ['gmaps', 'pgeocode', 'spo'], None)
+
+    return df
+
+
+# Function for Calculating the Haversine Distance Matrix
+def haversine_distance_matrix(latitudes, longitudes, store_latitudes, store_longitudes) -> np.ndarray:
+    """
+    This function computes the haversine distance (in kilometers, mean earth radius `EARTH_RADIUS_KM` as in the `haversine` package)
+    between every location (eg. postal code) and every store with numpy broadcasting.
+    Inputs are in degrees. It returns a float64 matrix of shape (locations x stores).
+    Missing or invalid coordinates (outside of [-90, 90] latitude or [-180, 180] longitude) result in NaN.
+    """
+
+    lat = np.radians(np.asarray(latitudes, dtype='float'))[:, np.newaxis]
+    lng = np.radians(np.asarray(longitudes, dtype='float'))[:, np.newaxis]
+    store_lat = np.radians(np.asarray(store_latitudes, dtype='float'))[np.newaxis, :]
+    store_lng = np.radians(np.asarray(store_longitudes, dtype='float'))[np.newaxis, :]
+
+    d = np.sin((lat - store_lat) * 0.5) ** 2 + np.cos(store_lat) * np.cos(lat) * np.sin((lng - store_lng) * 0.5) ** 2
+    distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(d))
+
+    ## NaN for invalid coordinates (`haversine` raises a ValueError for those)
+    invalid = (np.abs(lat) > np.pi / 2) | (np.abs(lng) > np.pi) | (np.abs(store_lat) > np.pi / 2) | (np.abs(store_lng) > np.pi)
+    distances[invalid] = np.nan
+
+    return distances
+
+
 # Function for Calculating Distance to Stores
 def map_store_distance(df: pd.DataFrame,
                        df_stores: pd.DataFrame) -> pd.DataFrame:
     """
     Function computes distances between the order shipping adresses' postal codes and the location of the stores.
-    The distance computed is the haversine distance (in kilometers)
-    The function fills the previously created empty columns
+    The distance computed is the haversine distance (in kilometers, rounded to full kilometers and stored as float32).
+    The whole distance matrix (rows x stores) is computed in one call of `haversine_distance_matrix`,
+    each store's column is filled as `dist_{city}`. Rows without latitude/longitude get NaN.
+    """
+
+    distances = haversine_distance_matrix(df['latitude'], df['longitude'], df_stores['store_latitude'], df_stores['store_longitude'])
+    distances = np.round(distances).astype('float32')
+
+    for idx, city in enumerate(df_stores.city):
+        df[f"dist_{city}"] = distances[:, idx]
+
+    return df
+
+
+# Offline Postal Code Geodata Store (Arrow IPC File, Memory-Mapped)
+COUNTRY_KEYS = {"DE": 1, "AT": 2, "CH": 3}
+
+
+def post_code_key(countries, post_codes) -> np.ndarray:
+    """
+    This function maps (country, postal code) pairs to an integer key: country number (DE=1, AT=2, CH=3) * 100000 + postal code.
+    Eg. ("DE", "04109") -> 104109, ("AT", "1010") -> 201010. Pairs that are not DACH or whose postal code is not a string of 1 to 5 digits
+    (eg. "1e3", "12.5", " 123" or "123456", which would collide with the keys of another country) get the key -1.
     """
 
-    def apply_haversine(store_coordinates, row):
-        # takes coordinates and a row from a dataframe
-        # extracts coordinates from the row
-        # calculates and returns distance between both coordinates
-        # returns NaN if no distance can be calculated (because row has no longitude/latitude)
+    country_numbers = pd.Series(countries, dtype='object').map(COUNTRY_KEYS).to_numpy(dtype='float')
+
+    post_codes = pd.Series(post_codes, dtype='object')
+    is_digits = post_codes.str.fullmatch(r'[0-9]{1,5}').fillna(False).to_numpy(dtype=bool)
+    post_code_numbers = pd.to_numeric(post_codes.where(is_digits), errors='coerce').to_numpy(dtype='float')
+
+    keys = country_numbers * 100000 + post_code_numbers
+
+    return np.where(np.isnan(keys), -1, keys).astype('int64')
+
+
+def save_geodata_store(df_coordinates: pd.DataFrame, df_stores: pd.DataFrame, file_path: str) -> pa.Table:
+    """
+    This function writes the postal code geodata store: an uncompressed Arrow IPC file with one row per postal code,
+    sorted by the integer `post_code_key` (see `post_code_key`), with the float32 columns `latitude`, `longitude`,
+    `credit_score` and `population_density_per_sqkm` (if available in `df_coordinates`) and the precomputed store distances `dist_{city}`.
+    `df_coordinates` is the final geo-coordinate dataset (with `webshop_country`, `shipping_post_code`, `latitude` and `longitude`).
+    The file is written to a temporary file first and then moved into place. Open it with `open_geodata_store`.
+    """
+
+    df = df_coordinates.copy()
+    df = map_store_distance(df, df_stores)
+
+    df['post_code_key'] = post_code_key(df['webshop_country'], df['shipping_post_code'])
+    df = df[df['post_code_key'] >= 0].drop_duplicates(subset=['post_code_key']).sort_values(by='post_code_key')
+
+    value_columns = [column for column in ['latitude', 'longitude', 'credit_score', 'population_density_per_sqkm'] if column in df.columns]
+    value_columns.extend(f"dist_{city}" for city in df_stores.city)
+
+    table = pa.table({'post_code_key': df['post_code_key'].to_numpy(),
+                      **{column: df[column].to_numpy(dtype='float32') for column in value_columns}})
+
+    temp_file_path = f"{file_path}.tmp"
+    with pa.OSFile(temp_file_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_file_path, file_path)
+
+    return table
+
+
+def open_geodata_store(file_path: str) -> pa.Table:
+    """
+    This function opens the postal code geodata store (see `save_geodata_store`) with memory mapping.
+    The returned Arrow table references the file directly (zero-copy), so opening it is nearly free in every process (eg. pool workers).
+    """
+
+    return pa.ipc.open_file(pa.memory_map(file_path, 'r')).read_all()
+
+
+def lookup_geodata(table: pa.Table, countries, post_codes, columns: list=None) -> pd.DataFrame:
+    """
+    This function looks up (country, postal code) pairs in the postal code geodata store (see `open_geodata_store`)
+    with a binary search on the sorted `post_code_key` column and returns the requested `columns` (default: all) as DataFrame
+    aligned with the input. Postal codes that are not in the store get NaN.
+    """
 
-        delivery_coordinates = (row['latitude'], row['longitude'])
+    columns = columns or [column for column in table.column_names if column != 'post_code_key']
 
-        try:
-            return round(hs.haversine(store_coordinates, delivery_coordinates))
-        except:
-            return np.nan
+    store_keys = table.column('post_code_key').to_numpy()
+    keys = post_code_key(countries, post_codes)
 
-    # for each city in df_stores get the coordinates and create a new column in df
-    # fill that new column then with the distance using `apply_haversine` which is defined in this function as well
-    for city in df_stores.city:
+    ## empty store: nothing can be found (and there is no row to take)
+    if len(store_keys) == 0:
+        return pd.DataFrame(np.nan, index=np.arange(len(keys)), columns=columns, dtype='float32')
 
-        store_latitude = df_stores.set_index(keys="city").loc[city].store_latitude
-        store_longitude = df_stores.set_index(keys="city").loc[city].store_longitude
-        store_coordinates = (store_latitude, store_longitude)
+    positions = np.clip(np.searchsorted(store_keys, keys), 0, len(store_keys) - 1)
+    found = store_keys[positions] == keys
 
-        df[f"dist_{city}"] = df.apply(lambda row: apply_haversine(store_coordinates, row), axis=1)
+    df = table.select(columns).take(pa.array(positions)).to_pandas()
+    df.loc[~found, :] = np.nan
 
     return df
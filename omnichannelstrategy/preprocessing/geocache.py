@@ -0,0 +1,164 @@
+import time
+import sqlite3
+import threading
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
+
+
+class GeocodeCache():
+    """
+    Persistent geocode cache in a local SQLite file, keyed by (country, postal code).
+    Each entry stores latitude, longitude and address of a geocode result. Empty results (NaN coordinates) are cached as well,
+    so they are not queried again on the next run.
+    """
+
+    def __init__(self, file_path: str):
+
+        self.file_path = file_path
+
+        with self._connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS geocode (
+                                    country TEXT NOT NULL,
+                                    post_code TEXT NOT NULL,
+                                    latitude REAL,
+                                    longitude REAL,
+                                    address TEXT,
+                                    PRIMARY KEY (country, post_code))""")
+
+
+    @contextmanager
+    def _connect(self):
+        # commits on success and always closes the connection
+        with closing(sqlite3.connect(self.file_path)) as connection:
+            with connection:
+                yield connection
+
+
+    def get_many(self, keys: list, batch_size: int=400) -> dict:
+        """
+        Returns a dictionary {(country, post_code): (latitude, longitude, address)} of all `keys` that are in the cache.
+        Only the requested keys are queried, in batches of `batch_size` keys (2 SQL variables per key, below the SQLite limit of 999).
+        """
+
+        keys = list(dict.fromkeys(keys))
+        rows = []
+
+        with self._connect() as connection:
+            for start in range(0, len(keys), batch_size):
+                batch = keys[start:start + batch_size]
+                placeholders = ", ".join(["(?, ?)"] * len(batch))
+                rows += connection.execute(f"SELECT country, post_code, latitude, longitude, address FROM geocode WHERE (country, post_code) IN (VALUES {placeholders})",
+                                           [value for key in batch for value in key]).fetchall()
+
+        return {(country, post_code): (_to_float(lat), _to_float(lng), address) for country, post_code, lat, lng, address in rows}
+
+
+    def put_many(self, results: dict):
+        """
+        Writes a dictionary {(country, post_code): (latitude, longitude, address)} into the cache (existing entries are replaced).
+        """
+
+        rows = [(country, post_code, _to_sql(lat), _to_sql(lng), address) for (country, post_code), (lat, lng, address) in results.items()]
+
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def _to_sql(value):
+    # NaN is stored as NULL
+    return None if value is None or np.isnan(value) else float(value)
+
+
+def _to_float(value):
+    return np.nan if value is None else value
+
+
+class TokenBucket():
+    """
+    Thread-safe token bucket rate limiter: allows on average `rate` calls per second with bursts of up to `capacity` calls.
+    `acquire` blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: int=1):
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def cached_geocode(keys: list,
+                   geocode_function,
+                   cache_path: str=None,
+                   max_workers: int=8,
+                   requests_per_second: float=None) -> dict:
+    """
+    This function geocodes a list of (country, post_code) `keys` with `geocode_function(country, post_code)`,
+    which has to return a tuple (latitude, longitude, address).
+    Only keys that are not in the SQLite cache at `cache_path` are geocoded (no cache if `cache_path` is None),
+    the new results are written to the cache.
+    The cache misses are dispatched to a thread pool of `max_workers` threads, limited to `requests_per_second` (token bucket, no limit if None).
+    If requests fail, the results of all other requests are still written to the cache before the first error is raised.
+    It returns a dictionary {(country, post_code): (latitude, longitude, address)} for all keys.
+    """
+
+    keys = list(dict.fromkeys(keys))
+
+    cache = GeocodeCache(cache_path) if cache_path else None
+    results = cache.get_many(keys) if cache else {}
+
+    misses = [key for key in keys if key not in results]
+    print(f"Geocoding {len(misses)} of {len(keys)} postal codes ({len(keys) - len(misses)} cached).")
+
+    rate_limiter = TokenBucket(rate=requests_per_second, capacity=max_workers) if requests_per_second else None
+
+    def geocode(key):
+        if rate_limiter:
+            rate_limiter.acquire()
+        return geocode_function(*key)
+
+    new_results, errors = {}, {}
+
+    # requests are collected in order of completion and failures are caught per key,
+    # so all results that arrived are written to the cache, even if a request fails (or the run is interrupted)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(geocode, key): key for key in misses}
+
+            for future in as_completed(futures):
+                try:
+                    new_results[futures[future]] = future.result()
+                except Exception as error:
+                    errors[futures[future]] = error
+    finally:
+        if cache and new_results:
+            cache.put_many(new_results)
+
+    ## the first failing request (in the order of `keys`) is raised after the results were cached
+    if errors:
+        print(f"Geocoding failed for {len(errors)} of {len(misses)} postal codes ({len(new_results)} new results cached).")
+        raise errors[next(key for key in misses if key in errors)]
+
+    results.update(new_results)
+
+    return {key: results[key] for key in keys}
@@ -0,0 +1,164 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from omnichannelstrategy.preprocessing.cleaning import vectorized_basic_cleaning
+from omnichannelstrategy.preprocessing.coordinates import map_store_distance
+from omnichannelstrategy.preprocessing.treatment import vectorized_apply_treat_control
+
+
+# Functions for Passing DataFrames between Processes as Arrow Buffers
+def dataframe_to_arrow_buffer(df: pd.DataFrame) -> pa.Buffer:
+    """
+    This function serializes a pandas DataFrame into an Arrow IPC stream buffer (the index is not kept).
+    Object columns that contain pandas Periods (eg. `Treatment_store_opening_date`) are cast to a Period dtype first,
+    because Arrow cannot infer a type for Period objects.
+    Object columns with mixed types (eg. raw `order_number` with numbers and strings) are cast to strings (missing values are kept).
+    """
+
+    df = df.reset_index(drop=True)
+
+    for column in df.columns[df.dtypes == object]:
+        inferred_type = pd.api.types.infer_dtype(df[column], skipna=True)
+
+        if inferred_type == "period":
+            df[column] = pd.PeriodIndex(df[column]).to_series(index=df.index)
+
+        elif inferred_type.startswith("mixed"):
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue()
+
+
+def arrow_buffer_to_dataframe(buffer: pa.Buffer) -> pd.DataFrame:
+    """
+    This function deserializes an Arrow IPC stream buffer (see `dataframe_to_arrow_buffer`) back into a pandas DataFrame.
+    """
+
+    return pa.ipc.open_stream(buffer).read_all().to_pandas()
+
+
+# Function for Sharding the Order Data by Postal Code
+def shard_by_post_code(df: pd.DataFrame, num_shards: int) -> list:
+    """
+    This function splits a DataFrame into `num_shards` shards by the hash of `shipping_post_code`.
+    All rows of a postal code end up in the same shard and the assignment does not depend on the row order.
+    Rows keep their original order within each shard. It returns the list of shards (some may be empty).
+    """
+
+    post_codes = df['shipping_post_code'].astype(str)
+    shard_ids = (pd.util.hash_pandas_object(post_codes, index=False).to_numpy() % num_shards).astype(np.int64)
+
+    return [df.iloc[np.flatnonzero(shard_ids == shard_id)] for shard_id in range(num_shards)]
+
+
+def add_coordinates(df: pd.DataFrame, df_coordinates: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function adds `latitude` and `longitude` from the geo-coordinate dataset (one row per `shipping_post_code`) to the order data.
+    It is needed before `map_store_distance` if the order data does not contain coordinates yet.
+    """
+
+    return pd.merge(df, df_coordinates[['shipping_post_code', 'latitude', 'longitude']], how='left', on='shipping_post_code')
+
+
+# stages of `run_sharded` in each worker process (set once per worker by `_set_functions`)
+_FUNCTIONS = []
+
+
+def _set_functions(functions: list):
+    # initializer of the worker processes: the stages and the reference frames bound to them (eg. `df_stores`, `df_coordinates`)
+    # are sent once per worker instead of being pickled with every shard
+    _FUNCTIONS[:] = functions
+
+
+def _run_shard(buffer: pa.Buffer) -> pa.Buffer:
+    # executed in the worker processes: deserialize shard, apply all stages in order, serialize result
+    df = arrow_buffer_to_dataframe(buffer)
+
+    for function in _FUNCTIONS:
+        df = function(df)
+
+    return dataframe_to_arrow_buffer(df)
+
+
+# Function for Running Preprocessing Stages in Parallel
+def run_sharded(df: pd.DataFrame,
+                functions: list,
+                num_workers: int=None,
+                num_shards: int=None,
+                sort_column: str='order_date') -> pd.DataFrame:
+    """
+    This function runs a list of preprocessing `functions` (each takes and returns a DataFrame) on shards of the order data
+    in a `ProcessPoolExecutor` with `num_workers` processes (default: number of CPUs).
+    The data is sharded by the hash of `shipping_post_code` into `num_shards` shards (default: 4 per worker),
+    so every function must work per postal code (like cleaning, store distances and treatment assignment).
+    The shards are passed to and from the worker processes as Arrow buffers instead of pickled DataFrames,
+    the functions (and the reference frames bound to them) are sent only once to each worker process by the pool initializer.
+    Functions must be picklable, i.e. module-level functions or `functools.partial` of them.
+    The results are reassembled deterministically in shard order and stable-sorted by `sort_column` (if present).
+    """
+
+    num_workers = num_workers or os.cpu_count()
+    num_shards = num_shards or 4 * num_workers
+
+    buffers = [dataframe_to_arrow_buffer(shard) for shard in shard_by_post_code(df, num_shards) if not shard.empty]
+
+    # `map` returns the results in the order of the shards, independent of which worker finishes first
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_set_functions, initargs=(functions,)) as executor:
+        results = [arrow_buffer_to_dataframe(buffer) for buffer in executor.map(_run_shard, buffers)]
+
+    results = [result for result in results if not result.empty]
+    if not results:
+        return pd.DataFrame()
+
+    df = pd.concat(results, ignore_index=True)
+
+    if sort_column in df.columns:
+        df = df.sort_values(by=sort_column, kind='mergesort').reset_index(drop=True)
+
+    return df
+
+
+def parallel_order_preprocessing(df: pd.DataFrame,
+                                 df_stores: pd.DataFrame,
+                                 df_coordinates: pd.DataFrame=None,
+                                 num_workers: int=None,
+                                 num_shards: int=None,
+                                 cleaning: bool=True,
+                                 treat_dist: int=50,
+                                 early_store_date: list=[2013,4,1],
+                                 drop_cities: list=[],
+                                 country_list: list=["DE"],
+                                 multiple_stores: str="nearest") -> pd.DataFrame:
+    """
+    This function runs the order-level preprocessing stages in parallel (see `run_sharded`):
+    (1) basic cleaning (`vectorized_basic_cleaning`, skipped if `cleaning=False`),
+    (2) adding coordinates from `df_coordinates` (skipped if None, then the order data needs `latitude`/`longitude`),
+    (3) store distances (`map_store_distance`) and
+    (4) treatment assignment (`vectorized_apply_treat_control`, see there for `multiple_stores`).
+    The result is the same as running the stages serially and stable-sorting by `order_date` (rows with the same `order_date` can be in another order).
+    """
+
+    functions = []
+
+    if cleaning:
+        functions.append(vectorized_basic_cleaning)
+
+    if df_coordinates is not None:
+        functions.append(partial(add_coordinates, df_coordinates=df_coordinates))
+
+    functions.append(partial(map_store_distance, df_stores=df_stores))
+    functions.append(partial(vectorized_apply_treat_control, df_stores=df_stores, treat_dist=treat_dist, early_store_date=early_store_date,
+                             drop_cities=drop_cities, country_list=country_list, multiple_stores=multiple_stores))
+
+    return run_sharded(df, functions=functions, num_workers=num_workers, num_shards=num_shards)
@@ -0,0 +1,147 @@
+import os
+import hashlib
+import joblib
+import numpy as np
+import pandas as pd
+
+from sklearn.neighbors import BallTree
+
+# mean earth radius in kilometers (as in the `haversine` package and `haversine_distance_matrix`)
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _to_radians(latitudes, longitudes) -> np.ndarray:
+    # BallTree with haversine metric expects [latitude, longitude] in radians
+    return np.radians(np.column_stack([np.asarray(latitudes, dtype='float'), np.asarray(longitudes, dtype='float')]))
+
+
+class PostCodeIndex():
+    """
+    Spatial index (haversine BallTree) over the postal code coordinates of the geo-coordinate dataset (see `coordinates.py`).
+    It answers "stores within R km of each postal code" and "k nearest stores of each postal code" without computing
+    a dense distance column for every store. Postal codes without (valid) coordinates are not part of the tree.
+    Postal codes are identified by (`webshop_country`, `shipping_post_code`), as the same code can exist in several countries (eg. 8010 in DE, AT and CH).
+    Stores are identified by the index of `df_stores` (city), like in `treatment.nearest_store`.
+    If a postal code appears several times in `df_coordinates`, only its first row is used.
+    The index can be saved to and loaded from disk, see `get_post_code_index`.
+    """
+
+    def __init__(self, df_coordinates: pd.DataFrame, leaf_size: int=40):
+
+        self.fingerprint = coordinates_fingerprint(df_coordinates)
+
+        ## one point per (country, postal code), so the results can be indexed by it
+        df_coordinates = df_coordinates.drop_duplicates(subset=['webshop_country', 'shipping_post_code'])
+        valid = df_coordinates['latitude'].between(-90, 90) & df_coordinates['longitude'].between(-180, 180)
+
+        self.countries = df_coordinates.loc[valid, 'webshop_country'].to_numpy()
+        self.post_codes = df_coordinates.loc[valid, 'shipping_post_code'].to_numpy()
+        self.tree = BallTree(_to_radians(df_coordinates.loc[valid, 'latitude'], df_coordinates.loc[valid, 'longitude']), leaf_size=leaf_size, metric='haversine')
+
+
+    def stores_within(self, df_stores: pd.DataFrame, radius: float=50) -> pd.DataFrame:
+        """
+        Returns a long DataFrame with one row for each combination of postal code (`webshop_country`, `shipping_post_code`) and store (`city`) within `radius` km,
+        with the haversine `distance` in km. Postal codes without any store in range are not in the result.
+        """
+
+        store_points = _to_radians(df_stores['store_latitude'], df_stores['store_longitude'])
+        indices, distances = self.tree.query_radius(store_points, r=radius / EARTH_RADIUS_KM, return_distance=True)
+
+        return pd.DataFrame({'webshop_country': self.countries[np.concatenate(indices)],
+                             'shipping_post_code': self.post_codes[np.concatenate(indices)],
+                             'city': np.repeat(df_stores.index.to_numpy(), [len(idx) for idx in indices]),
+                             'distance': np.concatenate(distances) * EARTH_RADIUS_KM})
+
+
+    def nearest_stores(self, df_stores: pd.DataFrame, k: int=1) -> pd.DataFrame:
+        """
+        Returns a long DataFrame with the `k` nearest stores (`city`) of each postal code (`webshop_country`, `shipping_post_code`) in the index,
+        their `rank` (1 = nearest) and the haversine `distance` in km.
+        The stores are indexed in a small BallTree of their own that is queried with all postal codes at once.
+        """
+
+        store_tree = BallTree(_to_radians(df_stores['store_latitude'], df_stores['store_longitude']), metric='haversine')
+        distances, indices = store_tree.query(np.asarray(self.tree.data), k=k)
+
+        return pd.DataFrame({'webshop_country': np.repeat(self.countries, k),
+                             'shipping_post_code': np.repeat(self.post_codes, k),
+                             'rank': np.tile(np.arange(1, k+1), len(self.post_codes)),
+                             'city': df_stores.index.to_numpy()[indices.ravel()],
+                             'distance': distances.ravel() * EARTH_RADIUS_KM})
+
+
+    def nearest_store(self, df_stores: pd.DataFrame, drop_cities: list=[], k_ties: int=3) -> pd.DataFrame:
+        """
+        Returns the nearest store of each postal code in the same format as `treatment.nearest_store`
+        (`nearest_store`, `nearest_store_distance` rounded to full km like `map_store_distance`, `nearest_store_opening_dt`),
+        indexed by (`webshop_country`, `shipping_post_code`). This lets the treatment assignment run without `dist_{city}` columns.
+        Like with the `dist_{city}` columns, ties of the rounded distances go to the store that comes first in `df_stores`
+        (ties are resolved among the `k_ties` nearest stores).
+        """
+
+        df_stores = df_stores[~df_stores.index.isin(drop_cities)]
+        k = min(k_ties, len(df_stores))
+
+        # rounded distances of the k nearest stores, then the first store (in `df_stores` order) with the minimal rounded distance
+        df_nearest = self.nearest_stores(df_stores, k=k)
+        store_positions = df_stores.index.get_indexer(df_nearest['city']).reshape(-1, k)
+        distances = np.round(df_nearest['distance'].to_numpy()).reshape(-1, k)
+
+        candidates = np.where(distances == distances[:, [0]], store_positions, len(df_stores))
+        nearest = candidates.min(axis=1)
+
+        opening_dates = pd.to_datetime(df_stores['opening_date'], format="%d/%m/%Y").to_numpy()
+
+        return pd.DataFrame({'nearest_store': df_stores.index.to_numpy()[nearest],
+                             'nearest_store_distance': distances[:, 0],
+                             'nearest_store_opening_dt': opening_dates[nearest]},
+                            index=pd.MultiIndex.from_arrays([self.countries, self.post_codes], names=['webshop_country', 'shipping_post_code']))
+
+
+    def save(self, file_path: str):
+        """
+        Saves the index to `file_path` (joblib). The file is written to a temporary file first and then moved into place.
+        """
+
+        temp_file_path = f"{file_path}.tmp"
+        joblib.dump(self, temp_file_path)
+        os.replace(temp_file_path, file_path)
+
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Loads an index saved with `save`.
+        """
+
+        return joblib.load(file_path)
+
+
+def coordinates_fingerprint(df_coordinates: pd.DataFrame) -> str:
+    """
+    This function returns a fingerprint (hash) of the countries, postal codes and coordinates of the geo-coordinate dataset (including the order of the rows).
+    It is used to detect if a saved index still belongs to the coordinate dataset.
+    """
+
+    hashes = pd.util.hash_pandas_object(df_coordinates[['webshop_country', 'shipping_post_code', 'latitude', 'longitude']], index=False)
+
+    return f"{len(hashes)}-{hashlib.sha256(hashes.values.tobytes()).hexdigest()}"
+
+
+def get_post_code_index(df_coordinates: pd.DataFrame, file_path: str) -> PostCodeIndex:
+    """
+    This function loads the postal code index from `file_path` if it was built for the same coordinate dataset.
+    Otherwise it builds the index and saves it to `file_path`, so it is built only once per coordinate dataset.
+    """
+
+    if os.path.exists(file_path):
+        post_code_index = PostCodeIndex.load(file_path)
+
+        if post_code_index.fingerprint == coordinates_fingerprint(df_coordinates):
+            return post_code_index
+
+    post_code_index = PostCodeIndex(df_coordinates)
+    post_code_index.save(file_path)
+
+    return post_code_index
@@ -1,5 +1,11 @@
+import numpy as np
 import pandas as pd
-from scipy.stats.mstats import winsorize
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from omnichannelstrategy.data_sources.local_disk import get_local_partitioned_parquet
+from omnichannelstrategy.preprocessing.compactpanel import CompactPanel
 
 # Function to Reduce Data to Specific Time Frame before x Quarters and after x Quarter in Relation to the Treatment
 def get_before_after_opening_quarters(df: pd.DataFrame,
@@ -34,6 +40,46 @@ def get_before_after_opening_quarters(df: pd.DataFrame,
 
     return df
 
+# Function to Create Filters for Loading only the Partitions of the Panel that are Needed for Synthetic Control
+def scm_panel_filters(df_stores: pd.DataFrame,
+                      treatment_area: str,
+                      num_quarter_before: int=12,
+                      num_quarter_after: int=12,
+                      earliest_quarter='2013Q2') -> list:
+    """
+    This function returns filters (DNF format, see `load_data` and `load_scm_panel`) for loading the aggregated panel needed by `scm_preprocessing` for one `treatment_area`:
+    the quarters from `num_quarter_before` quarters before until `num_quarter_after` quarters after the store opening
+    for the control groups (`Non_Store`, `Early_Store`) and the postal codes of the `treatment_area`,
+    as well as the `earliest_quarter` (baseline `order_value`) for all postal codes.
+    With the panel partitioned by `year_quarter` and `Group`, only the matching partitions are read.
+    """
+
+    opening_quarter = pd.Period(pd.to_datetime(df_stores.loc[treatment_area, 'opening_date'], format="%d/%m/%Y"), freq='Q')
+    window = [('year_quarter', '>=', opening_quarter - num_quarter_before), ('year_quarter', '<=', opening_quarter + num_quarter_after)]
+
+    return [window + [('Group', 'in', ['Non_Store', 'Early_Store'])],
+            window + [('treatment_store', '=', treatment_area)],
+            [('year_quarter', '=', pd.Period(earliest_quarter, freq='Q'))]]
+
+# Function to Load only the Part of the Partitioned Panel that is Needed for Synthetic Control
+def load_scm_panel(target_path: str,
+                   df_stores: pd.DataFrame,
+                   treatment_area: str,
+                   num_quarter_before: int=12,
+                   num_quarter_after: int=12,
+                   earliest_quarter='2013Q2',
+                   columns: list=None) -> pd.DataFrame:
+    """
+    This function loads the rows of the aggregated panel (saved with `save_data` / `save_local_partitioned_parquet` in `target_path`)
+    that `scm_preprocessing` needs for one `treatment_area` (see `scm_panel_filters`), optionally only the given `columns`.
+    `scm_preprocessing` returns the same DataFrame for the loaded rows as for the whole panel.
+    """
+
+    filters = scm_panel_filters(df_stores, treatment_area, num_quarter_before=num_quarter_before,
+                                num_quarter_after=num_quarter_after, earliest_quarter=earliest_quarter)
+
+    return get_local_partitioned_parquet(target_path, columns=columns, filters=filters)
+
 # Function for Transformation of DataFrame in Preparation for Applying Synthetic Control
 def scm_preprocessing(df_input: pd.DataFrame,
                       treatment_area: str,
@@ -48,22 +94,54 @@ def scm_preprocessing(df_input: pd.DataFrame,
     It aggregates all postal codes that are assigned to have received treatment by the treatment_area to one single postal code and designates this as the treatment_area
     The function also takes additional columns and how they should be aggregated for the treatment_area. This is a way of introducing more flexibility to the functionality.
     With using `get_before_after_opening_quarters` the resulting DataFrame will only contain data for the treated area and non-treated areas.
+    Instead of a DataFrame, `df_input` can be a `CompactPanel`, then only the postal codes and quarters needed for the treatment_area are materialized.
+    To prepare several treatment areas, use `batch_scm_preprocessing` (steps 0 and 1 are only done once).
+    To read only the rows needed for one treatment_area from a partitioned panel, load it with `load_scm_panel`.
     """
 
-    df = df_input.copy()
+    # 0. Drop NaN
+    # 1. Additional Outcome Variables
+    df = _scm_base(df_input, treatment_areas=[treatment_area], dropna=dropna, num_quarter_before=num_quarter_before,
+                   num_quarter_after=num_quarter_after, earliest_quarter=earliest_quarter)
 
-    q_since_open_treatment = f'q_since_open_{treatment_area}'
+    # 2. Treatment, Control Groups and Time Frame of Analysis/Observation
+    ## keep only treated area and designate control group (all other areas where treatment=0, therefore also early stores)
+    ## keep only within certain time frame (x quarters before and y quarters after store opening)
+    df = get_before_after_opening_quarters(df, treatment_area=treatment_area, num_quarter_before=num_quarter_before, num_quarter_after=num_quarter_after)
 
-    # 0. Drop NaN
-    ## drop postal codes where there is not latitude/longitude because they might be wrong but be assigned to control group "Non_Store"
-    if dropna:
-        df.dropna(subset=["latitude"], inplace=True)
+    # 3. Shipping Post Code of Treatment
+    # 4. Transform Time Frame
+    # 5. Column Selection
+    # 6. Sorting
+    return _scm_treatment_area_frame(df, treatment_area=treatment_area, earliest_quarter=earliest_quarter, additional_columns=additional_columns)
 
-    # 1. Additional Outcome Variables
-    ## create earliest `order_value` as constant variable
-    temp_df = df[df['year_quarter'] == earliest_quarter][['shipping_post_code', 'order_value']].reset_index(drop=True)
-    temp_df = temp_df.rename(columns={'order_value': f'order_value_{earliest_quarter}'})
-    df = pd.merge(df, temp_df, how='inner', on='shipping_post_code')
+
+def _scm_base(df_input: pd.DataFrame,
+              treatment_areas: list,
+              dropna: bool,
+              num_quarter_before: int,
+              num_quarter_after: int,
+              earliest_quarter) -> pd.DataFrame:
+    # steps 0 and 1 of `scm_preprocessing`, independent of the treatment area
+
+    if isinstance(df_input, CompactPanel):
+        ## on a compact panel both steps are done once per postal code, then only the rows needed for the treatment_areas are materialized
+        df = _compact_scm_rows(df_input, treatment_areas=treatment_areas, dropna=dropna, num_quarter_before=num_quarter_before,
+                               num_quarter_after=num_quarter_after, earliest_quarter=earliest_quarter)
+
+    else:
+        df = df_input.copy()
+
+        # 0. Drop NaN
+        ## drop postal codes where there is not latitude/longitude because they might be wrong but be assigned to control group "Non_Store"
+        if dropna:
+            df.dropna(subset=["latitude"], inplace=True)
+
+        # 1. Additional Outcome Variables
+        ## create earliest `order_value` as constant variable
+        temp_df = df[df['year_quarter'] == earliest_quarter][['shipping_post_code', 'order_value']].reset_index(drop=True)
+        temp_df = temp_df.rename(columns={'order_value': f'order_value_{earliest_quarter}'})
+        df = pd.merge(df, temp_df, how='inner', on='shipping_post_code')
 
     ## create return_rate outcome variable
     df['return_rate'] = df['number_of_returned_items']/df['number_of_items']
@@ -71,10 +149,13 @@ def scm_preprocessing(df_input: pd.DataFrame,
     ## need to fill nan because of division by 0
     df.return_rate.fillna(0.0, inplace=True)
 
-    # 2. Treatment, Control Groups and Time Frame of Analysis/Observation
-    ## keep only treated area and designate control group (all other areas where treatment=0, therefore also early stores)
-    ## keep only within certain time frame (x quarters before and y quarters after store opening)
-    df = get_before_after_opening_quarters(df, treatment_area=treatment_area, num_quarter_before=num_quarter_before, num_quarter_after=num_quarter_after)
+    return df
+
+
+def _scm_treatment_area_frame(df: pd.DataFrame, treatment_area: str, earliest_quarter, additional_columns: dict={}) -> pd.DataFrame:
+    # steps 3 to 6 of `scm_preprocessing` on the output of `get_before_after_opening_quarters`
+
+    q_since_open_treatment = f'q_since_open_{treatment_area}'
 
     # 3. Shipping Post Code of Treatment
     ## replace shipping post code with treatment_store if treatment_store == treatment_area
@@ -127,28 +208,287 @@ def scm_preprocessing(df_input: pd.DataFrame,
 
     return df
 
-def scm_scaler(df_input: pd.DataFrame, column_scaling: dict={}, column_winsor: dict={}) -> pd.DataFrame:
-  """
-  Take DataFrame and dictionary of column names (keys) and method for scaling them (values).
-  For each column the dictionary must contain a list of scaling methods. The following methods are valid inputs: `minmax`, `mean_normal`, `standard`.
-  The function also takes a dictionary, if the scaled columns should also be winsorised. The dictionary keys are the column names as well as
-  """
+def _compact_scm_rows(panel: CompactPanel,
+                      treatment_areas: list,
+                      dropna: bool,
+                      num_quarter_before: int,
+                      num_quarter_after: int,
+                      earliest_quarter) -> pd.DataFrame:
+    # steps 0 and 1 of `scm_preprocessing` on a CompactPanel: drop NaN and add the earliest `order_value` per postal code (no merge on the long panel),
+    # then materialize only the postal codes of the treatment_areas and the control group and (if possible) only the quarters of their time frames
+    if dropna:
+        panel = panel.dropna(subset=["latitude"])
+
+    if pd.Period(earliest_quarter, freq='Q') not in panel.quarters:
+        raise ValueError(f"Earliest quarter {earliest_quarter} is not in the panel.")
+
+    earliest_order_value = panel.measure('order_value', quarters=[earliest_quarter])[:, 0]
+    panel = panel.with_attributes(pd.DataFrame({f'order_value_{earliest_quarter}': earliest_order_value}, index=panel.post_codes))
+
+    post_codes = panel.post_codes[(panel.attributes['treatment_store'].isin(treatment_areas) | (panel.attributes['Treatment'] == 0)).to_numpy()]
+
+    quarters = None
+    q_since_open_columns = [f'q_since_open_{treatment_area}' for treatment_area in treatment_areas]
+    if all(column in panel.quarter_columns for column in q_since_open_columns):
+        in_time_frame = np.zeros(len(panel.quarters), dtype=bool)
+        for column in q_since_open_columns:
+            q_since_open = np.asarray(panel.quarter_columns[column])
+            in_time_frame |= (q_since_open >= (-1 * num_quarter_before)) & (q_since_open <= num_quarter_after)
+        quarters = panel.quarters[in_time_frame]
+
+    return panel.to_long(post_codes=post_codes, quarters=quarters)
+
+# Class for Preparing Several Treatment Areas for Synthetic Control with Shared Work
+class SCMBatchPreprocessor():
+    """
+    Batch version of `scm_preprocessing` for several treatment areas (eg. all stores).
+    The work that does not depend on the treatment area is done only once per `earliest_quarter`:
+    drop NaN, earliest `order_value`, `return_rate`, grouping the treated postal codes by `treatment_store`
+    and sorting the control pool (`Treatment` == 0) by quarter, so the time frame of each treatment area is a slice of it.
+    The frames of the treatment areas are memoized by (treatment_area, num_quarter_before, num_quarter_after, earliest_quarter, additional_columns)
+    and are identical to the output of `scm_preprocessing`.
+    A CompactPanel `df_input` is only materialized for the `treatment_areas` (default: all), other areas raise a ValueError.
+    """
+
+    def __init__(self, df_input: pd.DataFrame, dropna: bool=True, treatment_areas: list=None):
+
+        self.df_input = df_input
+        self.dropna = dropna
+        self.treatment_areas = treatment_areas
+        self._bases = {}
+        self._frames = {}
+
+
+    def _base(self, earliest_quarter) -> tuple:
+        # shared work per earliest_quarter: treated rows grouped by `treatment_store` and control pool sorted by quarter
+        if earliest_quarter not in self._bases:
+
+            ## a CompactPanel is materialized for all treatment_areas (all quarters, because the time frames can vary between calls)
+            treatment_areas = self.treatment_areas if self.treatment_areas is not None else []
+            if isinstance(self.df_input, CompactPanel) and self.treatment_areas is None:
+                treatment_areas = list(self.df_input.attributes['treatment_store'].dropna().unique())
+
+            df = _scm_base(self.df_input, treatment_areas=treatment_areas, dropna=self.dropna, num_quarter_before=np.inf,
+                           num_quarter_after=np.inf, earliest_quarter=earliest_quarter)
+
+            treated_rows = df.groupby('treatment_store', sort=False).indices
 
-  df = df_input.copy()
+            ## stable sort keeps the row order within each quarter (same aggregation order as in `scm_preprocessing`)
+            df_zero = df[df['Treatment'] == 0]
+            df_zero = df_zero.iloc[np.argsort(pd.PeriodIndex(df_zero['year_quarter'], freq='Q').asi8, kind='stable')]
 
-  for column, scaling in column_scaling.items():
-    for scaler in scaling:
-      if scaler == 'minmax':
-        df[f'{column}_minmax'] = (df[column] - df[column].min()) / (df[column].max() - df[column].min())
+            self._bases[earliest_quarter] = (df, treated_rows, df_zero)
 
-      if scaler == 'meannormal':
-        df[f'{column}_meannormal'] = (df[column] - df[column].mean()) / (df[column].max() - df[column].min())
+        return self._bases[earliest_quarter]
 
-      if scaler == 'standard':
-        df[f'{column}_standard'] = (df[column] - df[column].mean()) / df[column].std()
 
-      if column in column_winsor.keys():
-        limits = column_winsor.get(column, [0.05, 0.05])
-        df[f'{column}_{scaler}_winsor'] = winsorize(df[f'{column}_{scaler}'], limits=limits)
+    def _before_after_opening_quarters(self, treatment_area: str, num_quarter_before: int, num_quarter_after: int, earliest_quarter) -> pd.DataFrame:
+        # same as `get_before_after_opening_quarters`, but the control pool is sliced instead of filtered
+        ## a CompactPanel is only materialized for the given treatment_areas, the postal codes of other areas would be missing silently
+        if isinstance(self.df_input, CompactPanel) and self.treatment_areas is not None and treatment_area not in self.treatment_areas:
+            raise ValueError(f"Treatment area {treatment_area} is not in the treatment_areas of the batch: {', '.join(self.treatment_areas)}")
+
+        df, treated_rows, df_zero = self._base(earliest_quarter)
+        q_since_open_treatment = f"q_since_open_{treatment_area}"
+
+        df_store = df.iloc[treated_rows.get(treatment_area, [])]
+        df_store = df_store[df_store[q_since_open_treatment].between(-1 * num_quarter_before, num_quarter_after)]
+
+        ## `q_since_open_{treatment_area}` increases with the quarter, so the time frame is a contiguous block of the sorted control pool
+        q_since_open = df_zero[q_since_open_treatment].to_numpy()
+        start, end = np.searchsorted(q_since_open, -1 * num_quarter_before, side='left'), np.searchsorted(q_since_open, num_quarter_after, side='right')
+
+        df = pd.concat([df_store, df_zero.iloc[start:end]], join="inner")
+        df.loc[(df.treatment_store != treatment_area),'treatment_store']=f'control_{treatment_area}'
+
+        return df
+
+
+    def city_frame(self,
+                   treatment_area: str,
+                   num_quarter_before: int=12,
+                   num_quarter_after: int=12,
+                   earliest_quarter='2013Q2',
+                   additional_columns: dict={}) -> pd.DataFrame:
+        """
+        Returns the SCM-ready DataFrame of one `treatment_area` (see `scm_preprocessing`), memoized.
+        """
+
+        key = _frame_key(treatment_area, num_quarter_before, num_quarter_after, earliest_quarter, additional_columns)
+
+        if key not in self._frames:
+            df = self._before_after_opening_quarters(treatment_area, num_quarter_before, num_quarter_after, earliest_quarter)
+            self._frames[key] = _scm_treatment_area_frame(df, treatment_area=treatment_area, earliest_quarter=earliest_quarter, additional_columns=additional_columns)
+
+        return self._frames[key].copy()
+
+
+    def iter_city_frames(self,
+                         treatment_areas: list,
+                         num_quarter_before: int=12,
+                         num_quarter_after: int=12,
+                         earliest_quarter='2013Q2',
+                         additional_columns: dict={},
+                         num_workers: int=None):
+        """
+        Yields (treatment_area, DataFrame) for all `treatment_areas` in the given order.
+        With `num_workers` > 1, the frames that are not memoized yet are prepared in a `ProcessPoolExecutor`
+        (only the rows of each treatment area and its time frame are sent to the worker processes).
+        """
+
+        if num_workers and num_workers > 1:
+            missing = [treatment_area for treatment_area in dict.fromkeys(treatment_areas)
+                       if _frame_key(treatment_area, num_quarter_before, num_quarter_after, earliest_quarter, additional_columns) not in self._frames]
+
+            frames = (self._before_after_opening_quarters(treatment_area, num_quarter_before, num_quarter_after, earliest_quarter) for treatment_area in missing)
+
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = executor.map(partial(_scm_treatment_area_frame, earliest_quarter=earliest_quarter, additional_columns=additional_columns), frames, missing)
+
+                for treatment_area, df in zip(missing, results):
+                    self._frames[_frame_key(treatment_area, num_quarter_before, num_quarter_after, earliest_quarter, additional_columns)] = df
+
+        for treatment_area in treatment_areas:
+            yield treatment_area, self.city_frame(treatment_area, num_quarter_before=num_quarter_before, num_quarter_after=num_quarter_after,
+                                                  earliest_quarter=earliest_quarter, additional_columns=additional_columns)
+
+
+def _frame_key(treatment_area: str, num_quarter_before: int, num_quarter_after: int, earliest_quarter, additional_columns: dict) -> tuple:
+    return (treatment_area, num_quarter_before, num_quarter_after, str(earliest_quarter), tuple(sorted(additional_columns.items())))
+
+
+def batch_scm_preprocessing(df_input: pd.DataFrame,
+                            treatment_areas: list,
+                            dropna: bool=True,
+                            num_quarter_before=12,
+                            num_quarter_after=12,
+                            earliest_quarter='2013Q2',
+                            additional_columns: dict={},
+                            num_workers: int=None) -> dict:
+    """
+    This function applies `scm_preprocessing` to several `treatment_areas` and returns a dictionary {treatment_area: DataFrame}.
+    The work that is independent of the treatment area (drop NaN, earliest `order_value`, `return_rate`, control pool) is done only once
+    (see `SCMBatchPreprocessor`), the treatment areas can be prepared in `num_workers` processes.
+    """
+
+    batch = SCMBatchPreprocessor(df_input, dropna=dropna, treatment_areas=treatment_areas)
+
+    return dict(batch.iter_city_frames(treatment_areas, num_quarter_before=num_quarter_before, num_quarter_after=num_quarter_after,
+                                       earliest_quarter=earliest_quarter, additional_columns=additional_columns, num_workers=num_workers))
+
+# Class for Scaling (and Winsorizing) Columns with Fitted Statistics
+class SCMScaler():
+    """
+    Fit/transform version of `scm_scaler`. It takes a dictionary of column names (keys) and lists of scaling methods (values)
+    with the valid methods `minmax`, `meannormal` and `standard`, and a dictionary of winsor limits ([lower, upper]) per column.
+    `fit` computes min, max, mean and std (ddof=1, NaN skipped like pandas) of all columns in one vectorized pass over a NumPy block
+    and the winsor bounds of the scaled columns (positions as in `scipy.stats.mstats.winsorize`: NaN sorted last and counted,
+    so NaN values are set to the upper bound when the upper limit is above 0).
+    `transform` only applies the cached parameters, so data of other cities (eg. placebo runs) can be scaled with the statistics of the fitted data.
+    The new columns (`{column}_{scaler}` and `{column}_{scaler}_winsor`) are the same as in `scm_scaler`.
+    """
+
+    SCALERS = ['minmax', 'meannormal', 'standard']
+
+    def __init__(self, column_scaling: dict={}, column_winsor: dict={}):
+
+        for column, scaling in column_scaling.items():
+            for scaler in scaling:
+                if scaler not in self.SCALERS:
+                    raise ValueError(f"Unknown scaling method {scaler} for column {column}, valid methods: {', '.join(self.SCALERS)}")
+
+        self.column_scaling = column_scaling
+        self.column_winsor = column_winsor
+        self.params = None
+
+
+    def fit(self, df: pd.DataFrame):
+        """
+        Computes and caches the scaling parameters (`params`: shift and scale of each column and scaler) and winsor bounds.
+        """
+
+        columns = list(self.column_scaling)
+        block = df[columns].to_numpy(dtype='float64')
+
+        # 1. Statistics of All Columns in One Pass
+        with np.errstate(invalid='ignore', divide='ignore'):
+            minimum, maximum = np.nanmin(block, axis=0), np.nanmax(block, axis=0)
+            mean = np.nanmean(block, axis=0)
+            std = np.nanstd(block, axis=0, ddof=1)
+
+        # 2. Shift and Scale per Scaler: scaled = (value - shift) / scale
+        params = {'minmax': (minimum, maximum - minimum),
+                  'meannormal': (mean, maximum - minimum),
+                  'standard': (mean, std)}
+
+        self.params = {(column, scaler): (params[scaler][0][idx], params[scaler][1][idx])
+                       for idx, column in enumerate(columns) for scaler in self.column_scaling[column]}
+
+        # 3. Winsor Bounds
+        ## bounds of the scaled column at the positions used by `winsorize`: NaN is sorted last and counted in the number of values,
+        ## a limit of 0 does not clip, scaled values keep the order of the raw values
+        self.winsor_bounds = {}
+        for column in columns:
+            if column not in self.column_winsor:
+                continue
+
+            values = np.sort(block[:, columns.index(column)])
+            lower_limit, upper_limit = self.column_winsor.get(column, [0.05, 0.05])
+            num_values = len(values)
+
+            lower_value = values[int(lower_limit * num_values)] if lower_limit else -np.inf
+            upper_value = values[num_values - int(num_values * upper_limit) - 1] if upper_limit else np.inf
+            ## upper position within the NaN values: `winsorize` only replaces NaN by NaN
+            upper_value = np.inf if np.isnan(upper_value) else upper_value
+
+            for scaler in self.column_scaling[column]:
+                shift, scale = self.params[(column, scaler)]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    self.winsor_bounds[(column, scaler)] = ((lower_value - shift) / scale, (upper_value - shift) / scale)
+
+        return self
+
+
+    def transform(self, df_input: pd.DataFrame) -> pd.DataFrame:
+        """
+        Returns a copy of `df_input` with the scaled (and winsorized) columns, using the fitted parameters.
+        """
+
+        if self.params is None:
+            raise ValueError("SCMScaler has to be fitted before transform.")
+
+        new_columns = {}
+        for (column, scaler), (shift, scale) in self.params.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                new_columns[f'{column}_{scaler}'] = (df_input[column].to_numpy(dtype='float64') - shift) / scale
+
+            if (column, scaler) in self.winsor_bounds:
+                lower, upper = self.winsor_bounds[(column, scaler)]
+                winsor = np.clip(new_columns[f'{column}_{scaler}'], lower, upper)
+                ## NaN counts as the largest value in `winsorize`, so it is set to a finite upper bound
+                if np.isfinite(upper):
+                    winsor[np.isnan(winsor)] = upper
+                new_columns[f'{column}_{scaler}_winsor'] = winsor
+
+        df = df_input.copy()
+        for column, values in new_columns.items():
+            df[column] = values
+
+        return df
+
+
+    def fit_transform(self, df_input: pd.DataFrame) -> pd.DataFrame:
+
+        return self.fit(df_input).transform(df_input)
+
+
+def scm_scaler(df_input: pd.DataFrame, column_scaling: dict={}, column_winsor: dict={}) -> pd.DataFrame:
+  """
+  Take DataFrame and dictionary of column names (keys) and method for scaling them (values).
+  For each column the dictionary must contain a list of scaling methods. The following methods are valid inputs: `minmax`, `meannormal`, `standard`.
+  The function also takes a dictionary, if the scaled columns should also be winsorised. The dictionary keys are the column names as well as
+  the limits of winsorisation (eg. [0.05, 0.05]) as values.
+  The statistics are computed on `df_input` itself, use `SCMScaler` to fit them once and apply them to other DataFrames.
+  """
 
-  return df
+  return SCMScaler(column_scaling=column_scaling, column_winsor=column_winsor).fit_transform(df_input)
@@ -143,3 +143,248 @@ def apply_treat_control(df: pd.DataFrame, df_stores: pd.DataFrame, treat_dist: i
     df = df[base_columns]
 
     return df
+
+
+# Columnar Treatment Assignment
+TREATMENT_BASE_COLUMNS = ['order_number', 'item_line_number', 'webshop_country', 'order_date',
+       'shipping_post_code', 'net_order_value_euros', 'return_quantity',
+       'year_quarter', 'year_month']
+
+TREATMENT_COLUMNS = ['Post', 'Treatment', 'Group',
+      'Treatment_store_1', 'Treatment_store_2', 'Treatment_store_distance',
+      'non_treated_store_distance', 'Treatment_store_opening_date']
+
+# postal codes are only unique within a country (eg. 8010 in DE, AT and CH)
+POST_CODE_KEY = ['webshop_country', 'shipping_post_code']
+
+
+def nearest_store(df: pd.DataFrame, df_stores: pd.DataFrame, drop_cities: list=[], multiple_stores: str="nearest", treat_dist: int=None) -> pd.DataFrame:
+    """
+    This function takes a DataFrame with `dist_{city}` columns (order or postal code level) and returns a DataFrame with the same index
+    and the closest store of each row (`nearest_store`), its distance (`nearest_store_distance`, NaN if no distance is known)
+    and its opening date (`nearest_store_opening_dt`).
+    The closest store is found with an argmin over the matrix of `dist_{city}` columns (if several stores have the same distance, the first one in `df_stores` is taken).
+    The closest store within any treatment distance is the closest store overall, so this only has to be computed once for any number of treatment distances.
+    With `multiple_stores="legacy"` the store of rows with several stores within `treat_dist` is chosen like in `treat_control_assignment` instead:
+    the closer of the first and the last of these stores (in the order of `df_stores`). This differs from the closest store only with three or more stores within `treat_dist`.
+    """
+
+    if multiple_stores not in ["nearest", "legacy"]:
+        raise ValueError(f"Unknown multiple_stores {multiple_stores}, valid options: nearest, legacy")
+
+    # parse the opening dates once; one matrix column per store in the order of `df_stores`
+    stores = [store for store in df_stores.index if store not in drop_cities]
+    store_opening_dates = pd.to_datetime(df_stores.loc[stores, 'opening_date'], format="%d/%m/%Y").to_numpy()
+
+    distances = df[[f'dist_{store}' for store in stores]].to_numpy(dtype='float')
+    distances = np.where(np.isnan(distances), np.inf, distances)
+    nearest = distances.argmin(axis=1)
+
+    ## legacy: closer of the first and the last store within treat_dist (the first one if both have the same distance)
+    if multiple_stores == "legacy":
+        rows = np.arange(len(df))
+        in_range = distances < treat_dist
+        first = in_range.argmax(axis=1)
+        last = len(stores) - 1 - in_range[:, ::-1].argmax(axis=1)
+        legacy = np.where(distances[rows, first] <= distances[rows, last], first, last)
+        nearest = np.where(in_range.any(axis=1), legacy, nearest)
+
+    nearest_distance = distances[np.arange(len(df)), nearest]
+
+    return pd.DataFrame({'nearest_store': np.array(stores, dtype=object)[nearest],
+                         'nearest_store_distance': np.where(np.isinf(nearest_distance), np.nan, nearest_distance),
+                         'nearest_store_opening_dt': store_opening_dates[nearest]},
+                        index=df.index)
+
+
+def treatment_from_nearest_store(df_nearest: pd.DataFrame, treat_dist: int=50, early_store_date: list=[2013,4,1]) -> pd.DataFrame:
+    """
+    This function derives the treatment columns (everything in `treat_control_assignment` except `Post`) from the output of `nearest_store`.
+    It returns a DataFrame with the same index and the columns `Treatment`, `Group`, `Treatment_store_1`, `Treatment_store_2`, `Treatment_store_distance`,
+    `non_treated_store_distance`, `Treatment_store_opening_date` and `Treatment_store_opening_dt` (opening date as datetime, needed for `Post`).
+    """
+
+    # 1. Treatment Store
+    ## closest store if it is within treat_dist (NaN distances are never within treat_dist)
+    treated = (df_nearest['nearest_store_distance'] < treat_dist).to_numpy()
+
+    treatment_store = np.where(treated, df_nearest['nearest_store'].to_numpy(), "")
+    treatment_store_distance = np.where(treated, df_nearest['nearest_store_distance'].to_numpy(), np.nan)
+    treatment_store_opening = np.where(treated, df_nearest['nearest_store_opening_dt'].to_numpy(), np.datetime64('NaT'))
+
+    # 2. (Control) Group
+    ## stores that opened before early_store_date are no treatment (Early_Store), locations without store nearby are Non_Store
+    early_store = treated & (treatment_store_opening < np.datetime64(date(*early_store_date)))
+    treatment = treated & ~early_store
+
+    return pd.DataFrame({'Treatment': treatment.astype('float'),
+                         'Group': np.select([early_store, treatment], ["Early_Store", "Treatment_Store"], "Non_Store"),
+                         'Treatment_store_1': treatment_store,
+                         'Treatment_store_2': "",
+                         'Treatment_store_distance': np.where(treatment, treatment_store_distance, np.nan),
+                         'non_treated_store_distance': np.where(early_store, treatment_store_distance, np.nan),
+                         'Treatment_store_opening_date': pd.PeriodIndex(pd.DatetimeIndex(treatment_store_opening), freq='Q'),
+                         'Treatment_store_opening_dt': treatment_store_opening},
+                        index=df_nearest.index)
+
+
+def assign_treatment_store(df: pd.DataFrame, df_stores: pd.DataFrame, treat_dist: int=50, early_store_date: list=[2013,4,1], drop_cities: list=[], multiple_stores: str="nearest") -> pd.DataFrame:
+    """
+    This function is the columnar core of the treatment assignment (everything in `treat_control_assignment` except `Post`).
+    It takes a DataFrame with `dist_{city}` columns (order or postal code level) and returns the treatment columns with the same index
+    (see `nearest_store` and `treatment_from_nearest_store`).
+    """
+
+    df_nearest = nearest_store(df, df_stores, drop_cities=drop_cities, multiple_stores=multiple_stores, treat_dist=treat_dist)
+
+    return treatment_from_nearest_store(df_nearest, treat_dist=treat_dist, early_store_date=early_store_date)
+
+
+def _prepare_treat_control(df: pd.DataFrame, drop_cities: list, country_list: list) -> pd.DataFrame:
+    # drop distance columns of the specified cities (could be stores in cities with multiple stores)
+    drop_columns = [f'dist_{city}' for city in drop_cities]
+    df = df.drop(columns=[column for column in drop_columns if column in df.columns])
+
+    # drop all orders outside of the country list (ToBeDropped in `treat_control_assignment`)
+    return df[df['webshop_country'].isin(country_list)].copy()
+
+
+def _finish_treat_control(df: pd.DataFrame, df_treatment: pd.DataFrame) -> pd.DataFrame:
+    # add treatment columns, derive `Post` (order after opening of the treatment store) and ensure correct order of columns (for saving)
+    opening_dates = df_treatment.pop('Treatment_store_opening_dt').to_numpy()
+
+    df['Post'] = (df['order_date'].to_numpy() > opening_dates).astype('float')
+    for column in df_treatment.columns:
+        df[column] = df_treatment[column].array
+
+    dist_columns = [column for column in df.columns if column.startswith('dist_')]
+
+    return df[TREATMENT_BASE_COLUMNS + dist_columns + TREATMENT_COLUMNS]
+
+
+def vectorized_apply_treat_control(df: pd.DataFrame, df_stores: pd.DataFrame, treat_dist: int=50, early_store_date: list=[2013,4,1], drop_cities: list=[], country_list: list=["DE"], multiple_stores: str="nearest") -> pd.DataFrame:
+    """
+    Columnar version of `apply_treat_control` that returns the same columns without calling `treat_control_assignment` on every row.
+    The store opening dates are parsed once, the treatment store is found with an argmin over the `dist_{city}` columns (see `assign_treatment_store`)
+    and `Post` is derived from one vectorized date comparison.
+    Notice: with three or more stores within `treat_dist` this takes the closest one (`multiple_stores="nearest"`), `treat_control_assignment` compares
+    only the first and the last store found. `multiple_stores="legacy"` reproduces that rule, then the result is the same as `apply_treat_control`.
+    Notice: the `dist_{city}` columns of `drop_cities` are dropped and these stores are never assigned. `apply_treat_control` builds the column names
+    as `dit_{city}`, so it ignores `drop_cities` (same result as `drop_cities=[]`).
+    """
+
+    df = _prepare_treat_control(df, drop_cities=drop_cities, country_list=country_list)
+
+    df_treatment = assign_treatment_store(df, df_stores, treat_dist=treat_dist, early_store_date=early_store_date, drop_cities=drop_cities,
+                                          multiple_stores=multiple_stores)
+
+    return _finish_treat_control(df, df_treatment)
+
+
+def _nearest_store_by_post_code(df_post_codes: pd.DataFrame, df_stores: pd.DataFrame, drop_cities: list, post_code_index, multiple_stores: str="nearest", treat_dist: int=None) -> pd.DataFrame:
+    # closest store of each unique postal code, either from the `dist_{city}` columns or from a spatial index (see `spatialindex.PostCodeIndex`)
+    if post_code_index is None:
+        return nearest_store(df_post_codes, df_stores, drop_cities=drop_cities, multiple_stores=multiple_stores, treat_dist=treat_dist).reset_index(drop=True)
+
+    if multiple_stores != "nearest":
+        raise ValueError(f"A spatial index (post_code_index) only finds the closest store, multiple_stores={multiple_stores} needs the dist_{{city}} columns.")
+
+    df_nearest = post_code_index.nearest_store(df_stores, drop_cities=drop_cities)
+
+    return df_nearest.reindex(pd.MultiIndex.from_frame(df_post_codes[POST_CODE_KEY])).reset_index(drop=True)
+
+
+def _post_code_positions(df_post_codes: pd.DataFrame, df: pd.DataFrame) -> np.ndarray:
+    # hash join: position of each order's (country, postal code) in `df_post_codes`
+    return pd.MultiIndex.from_frame(df_post_codes[POST_CODE_KEY]).get_indexer(pd.MultiIndex.from_frame(df[POST_CODE_KEY]))
+
+
+def post_code_treatment_table(df: pd.DataFrame, df_stores: pd.DataFrame, treat_dist: int=50, early_store_date: list=[2013,4,1], drop_cities: list=[], post_code_index=None) -> pd.DataFrame:
+    """
+    This function computes the treatment dimension table: one row per unique (`webshop_country`, `shipping_post_code`) with all treatment columns except `Post`
+    (these only depend on the postal code and the stores, see `assign_treatment_store`). The country is part of the key, as the same postal code
+    can exist in several countries (eg. 8010 in DE, AT and CH).
+    The input can be the order data or the geo-coordinate dataset, as long as it contains `webshop_country`, `shipping_post_code` and the `dist_{city}` columns.
+    If a spatial index (`spatialindex.PostCodeIndex`) is passed as `post_code_index`, the closest stores are taken from the index and no `dist_{city}` columns are needed.
+    """
+
+    df_post_codes = df.drop_duplicates(subset=POST_CODE_KEY)
+
+    df_nearest = _nearest_store_by_post_code(df_post_codes, df_stores, drop_cities=drop_cities, post_code_index=post_code_index)
+
+    df_treatment = treatment_from_nearest_store(df_nearest, treat_dist=treat_dist, early_store_date=early_store_date)
+    df_treatment.insert(0, 'webshop_country', df_post_codes['webshop_country'].to_numpy())
+    df_treatment.insert(1, 'shipping_post_code', df_post_codes['shipping_post_code'].to_numpy())
+
+    return df_treatment
+
+
+def apply_treat_control_by_post_code(df: pd.DataFrame, df_stores: pd.DataFrame, treat_dist: int=50, early_store_date: list=[2013,4,1], drop_cities: list=[], country_list: list=["DE"], df_treatment: pd.DataFrame=None, post_code_index=None) -> pd.DataFrame:
+    """
+    Postal code level version of `vectorized_apply_treat_control` (same output columns).
+    The treatment dimension table is computed once per unique (`webshop_country`, `shipping_post_code`) (see `post_code_treatment_table`)
+    and attached to the orders with a hash join on both columns. Only `Post` is computed on the order level.
+    A precomputed treatment table (with the same parameters) can be passed as `df_treatment`,
+    a spatial index as `post_code_index` (then the orders need no `dist_{city}` columns, see `post_code_treatment_table`).
+    """
+
+    df = _prepare_treat_control(df, drop_cities=drop_cities, country_list=country_list)
+
+    if df_treatment is None:
+        df_treatment = post_code_treatment_table(df, df_stores, treat_dist=treat_dist, early_store_date=early_store_date, drop_cities=drop_cities, post_code_index=post_code_index)
+
+    # hash join: position of each order's (country, postal code) in the treatment table
+    positions = _post_code_positions(df_treatment, df)
+
+    if (positions < 0).any():
+        missing = df.loc[positions < 0, POST_CODE_KEY].drop_duplicates()
+        raise ValueError(f"{len(missing)} postal codes of the orders are not in the treatment table: "
+                         f"{', '.join(f'{country} {post_code}' for country, post_code in missing.itertuples(index=False))}")
+
+    df_treatment = df_treatment.drop(columns=POST_CODE_KEY).iloc[positions]
+
+    return _finish_treat_control(df, df_treatment)
+
+
+def treat_control_sweep(df: pd.DataFrame, df_stores: pd.DataFrame, treat_dists: list=[50], early_store_dates: list=[[2013,4,1]], drop_cities: list=[], country_list: list=["DE"], long_format: bool=False, post_code_index=None, multiple_stores: str="nearest"):
+    """
+    This function runs the treatment assignment for every combination of `treat_dists` and `early_store_dates` (robustness checks) in one pass.
+    The closest store of each unique (`webshop_country`, `shipping_post_code`) is computed only once (see `nearest_store`, with `multiple_stores="legacy"` once per `treat_dist`).
+    Each configuration then only needs a threshold on the distance and a comparison of the opening dates.
+    It returns a dictionary with one treatment table per configuration (one row per unique (`webshop_country`, `shipping_post_code`), see `post_code_treatment_table`),
+    keyed by a `config_id` like `50km_2013-04-01`. The orders are not copied for each configuration, the treated orders of one configuration
+    (same columns as `vectorized_apply_treat_control`, ready for `aggregate_treated_df`) are joined on demand with `apply_treat_control_by_post_code(df, df_stores, df_treatment=...)`.
+    With `long_format=True` it returns one long treatment table with the additional columns `config_id`, `treat_dist` and `early_store_date` instead.
+    The closest stores can also be taken from a spatial index (`post_code_index`, see `post_code_treatment_table`, only with `multiple_stores="nearest"`).
+    """
+
+    df = _prepare_treat_control(df, drop_cities=drop_cities, country_list=country_list)
+    df_post_codes = df.drop_duplicates(subset=POST_CODE_KEY)
+
+    # closest store per unique (country, postal code), the legacy rule depends on the treat_dist
+    df_nearest = None
+    treatment_tables = {}
+
+    for treat_dist in treat_dists:
+        if df_nearest is None or multiple_stores == "legacy":
+            df_nearest = _nearest_store_by_post_code(df_post_codes, df_stores, drop_cities=drop_cities, post_code_index=post_code_index,
+                                                     multiple_stores=multiple_stores, treat_dist=treat_dist)
+
+        for early_store_date in early_store_dates:
+            config_id = f"{treat_dist}km_{date(*early_store_date).isoformat()}"
+
+            df_treatment = treatment_from_nearest_store(df_nearest, treat_dist=treat_dist, early_store_date=early_store_date)
+            df_treatment.insert(0, 'webshop_country', df_post_codes['webshop_country'].to_numpy())
+            df_treatment.insert(1, 'shipping_post_code', df_post_codes['shipping_post_code'].to_numpy())
+
+            if long_format:
+                df_treatment['config_id'] = config_id
+                df_treatment['treat_dist'] = treat_dist
+                df_treatment['early_store_date'] = date(*early_store_date)
+
+            treatment_tables[config_id] = df_treatment
+
+    if long_format:
+        return pd.concat(treatment_tables.values(), ignore_index=True)
+
+    return treatment_tables
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.preprocessing.aggregation import add_time_difference, aggregate_treated_df, vectorized_aggregate_treated_df, incremental_aggregate_treated_df
+from omnichannelstrategy.preprocessing.treatment import vectorized_apply_treat_control
+from tests.test_treatment import DF_STORES as DF_STORES_TREATMENT, make_orders as make_treatment_orders
+
+
+DF_STORES = pd.DataFrame({'opening_date': ['15/02/2019', '01/10/2019']}, index=pd.Index(['city1', 'city2'], name='city'))
+
+POST_CODES = {'04109': ('city1', 12.5, 1, 'Treatment'),
+              '04155': ('city1', 18.0, 1, 'Treatment'),
+              '80331': ('city2', 95.0, 0, 'Control')}
+
+
+def make_orders(rows: list) -> pd.DataFrame:
+    # treated order lines (format of the output of `apply_treat_control_by_post_code`) from (post code, quarter, order number, item line, value, return)
+    records = []
+    for post_code, quarter, order_number, item_line_number, value, returned in rows:
+        store, distance, treatment, group = POST_CODES[post_code]
+        records.append({'shipping_post_code': post_code, 'year_quarter': pd.Period(quarter, freq='Q'),
+                        'order_number': order_number, 'item_line_number': item_line_number,
+                        'net_order_value_euros': value, 'return_quantity': float(returned), 'Post': int(quarter >= '2019Q1'),
+                        'Treatment_store_1': store, 'Treatment_store_2': None, 'Treatment_store_distance': distance,
+                        'Treatment_store_opening_date': DF_STORES.loc[store, 'opening_date'], 'Treatment': treatment, 'Group': group})
+
+    return pd.DataFrame(records)
+
+
+@pytest.fixture
+def df_history() -> pd.DataFrame:
+    return make_orders([('04109', '2018Q3', 1, 1, 20.0, 0),
+                        ('04109', '2018Q3', 1, 2, 35.0, 1),
+                        ('04155', '2018Q3', 2, 1, 50.0, 0),
+                        ('04109', '2018Q4', 3, 1, 10.0, 0),
+                        ('80331', '2018Q4', 4, 1, 80.0, 0),
+                        ('80331', '2018Q4', 4, 2, 15.0, 0),
+                        ('04155', '2019Q1', 5, 1, 60.0, 0),
+                        ('80331', '2019Q1', 6, 1, 25.0, 0)])
+
+
+def full_rebuild(df_history: pd.DataFrame, df_new: pd.DataFrame) -> pd.DataFrame:
+    # order lines of `df_new` replace order lines of the history with the same order number and item line
+    df_all = pd.concat([df_history, df_new], ignore_index=True).drop_duplicates(subset=['order_number', 'item_line_number'], keep='last')
+
+    return vectorized_aggregate_treated_df(df_all, DF_STORES)
+
+
+def test_incremental_new_quarter(df_history):
+    df_panel = vectorized_aggregate_treated_df(df_history, DF_STORES)
+    df_new = make_orders([('04109', '2019Q2', 7, 1, 40.0, 0),
+                          ('04109', '2019Q2', 7, 2, 5.0, 1),
+                          ('80331', '2019Q2', 8, 1, 30.0, 0)])
+
+    assert_frame_equal(incremental_aggregate_treated_df(df_panel, df_new, DF_STORES), full_rebuild(df_history, df_new))
+
+
+def test_incremental_late_return_in_old_quarter(df_history):
+    df_panel = vectorized_aggregate_treated_df(df_history, DF_STORES)
+    df_new = make_orders([('04109', '2018Q3', 1, 1, 20.0, 1),
+                          ('04155', '2019Q2', 9, 1, 70.0, 0)])
+
+    df = incremental_aggregate_treated_df(df_panel, df_new, DF_STORES, df_history=df_history)
+
+    assert_frame_equal(df, full_rebuild(df_history, df_new))
+    assert df.loc[(df['shipping_post_code'] == '04109') & (df['year_quarter'] == pd.Period('2018Q3', freq='Q')), 'order_value'].item() == 0
+
+
+def test_incremental_new_post_code(df_history):
+    ## 04155 has no orders in the panel, its first orders arrive in a new and in an old quarter
+    df_history = df_history[df_history['shipping_post_code'] != '04155']
+    df_panel = vectorized_aggregate_treated_df(df_history, DF_STORES)
+    df_new = make_orders([('04155', '2019Q2', 10, 1, 45.0, 0),
+                          ('04155', '2018Q4', 11, 1, 12.0, 0),
+                          ('04109', '2019Q2', 12, 1, 8.0, 0)])
+
+    assert_frame_equal(incremental_aggregate_treated_df(df_panel, df_new, DF_STORES, df_history=df_history), full_rebuild(df_history, df_new))
+
+
+def test_incremental_late_quarter_without_history(df_history):
+    df_panel = vectorized_aggregate_treated_df(df_history, DF_STORES)
+    df_new = make_orders([('04109', '2018Q4', 13, 1, 10.0, 0)])
+
+    with pytest.raises(ValueError, match="2018Q4"):
+        incremental_aggregate_treated_df(df_panel, df_new, DF_STORES)
+
+
+def test_vectorized_keeps_missing_keys_like_legacy(df_history):
+    ## an order line without postal code and one without quarter
+    df = df_history.copy()
+    df.loc[6, 'shipping_post_code'] = np.nan
+    df.loc[5, 'year_quarter'] = pd.NaT
+
+    df_vectorized = vectorized_aggregate_treated_df(df, DF_STORES)
+
+    assert_frame_equal(df_vectorized, aggregate_treated_df(df, DF_STORES))
+    assert df_vectorized['shipping_post_code'].isna().sum() == 1 and df_vectorized['year_quarter'].isna().sum() == 1
+
+
+@pytest.mark.parametrize('random_seed', [0, 1])
+def test_vectorized_matches_legacy_full_panel(random_seed):
+    df = vectorized_apply_treat_control(make_treatment_orders(num_orders=300, random_seed=random_seed), DF_STORES_TREATMENT, treat_dist=50)
+
+    df_vectorized = vectorized_aggregate_treated_df(df, DF_STORES_TREATMENT)
+
+    assert len(df_vectorized) == df['shipping_post_code'].nunique() * df['year_quarter'].nunique()
+    assert_frame_equal(df_vectorized, aggregate_treated_df(df, DF_STORES_TREATMENT))
+
+
+def legacy_add_time_difference(df_input: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFrame:
+    # Period subtraction per cell (implementation of `add_time_difference` before the integer quarter ordinals)
+    df = df_input.copy()
+
+    for city, opening_date in df_stores['opening_date'].items():
+        opening_quarter = pd.Period(pd.to_datetime(opening_date, format="%d/%m/%Y"), freq='Q')
+        df[f"q_since_open_{city}"] = (pd.PeriodIndex(df.year_quarter, freq='Q').to_series(index=df.index) - opening_quarter).apply(lambda x: x.n)
+
+    df['year_quarter_dt'] = pd.PeriodIndex(df.year_quarter, freq='Q')
+
+    return df
+
+
+def test_add_time_difference_matches_period_subtraction():
+    df = pd.DataFrame({'year_quarter': pd.period_range('2010Q1', '2024Q4', freq='Q')})
+    df_stores = pd.DataFrame({'opening_date': ['15/02/2019', '01/10/2019', '31/12/2012']}, index=pd.Index(['city1', 'city2', 'city3'], name='city'))
+
+    df_time_difference = add_time_difference(df, df_stores)
+
+    assert (df_time_difference[[f'q_since_open_{city}' for city in df_stores.index]].dtypes == 'int16').all()
+    assert_frame_equal(df_time_difference, legacy_add_time_difference(df, df_stores), check_dtype=False)
+
+
+def test_add_time_difference_missing_quarters():
+    df = pd.DataFrame({'year_quarter': pd.PeriodIndex(['2019Q1', None, '2020Q2'], freq='Q')})
+    df_stores = pd.DataFrame({'opening_date': ['15/02/2019', np.nan]}, index=pd.Index(['city1', 'city2'], name='city'))
+
+    df_time_difference = add_time_difference(df, df_stores)
+
+    assert df_time_difference['q_since_open_city1'].dtype == 'Int16'
+    assert df_time_difference['q_since_open_city1'].tolist() == [0, pd.NA, 5]
+    assert df_time_difference['q_since_open_city2'].isna().all()
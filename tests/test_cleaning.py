@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.preprocessing.cleaning import basic_cleaning, vectorized_basic_cleaning
+
+
+def make_raw_orders(num_orders: int=500, random_seed: int=0) -> pd.DataFrame:
+    # sampled raw order lines (format of the original order_data dataset) with the data errors handled by `basic_cleaning`
+    rng = np.random.default_rng(random_seed)
+
+    post_codes = np.array(['04109', ' 80331 ', '8010', '0801', '1010', '123', '123456', None, '3011 ', '  '], dtype=object)
+    order_numbers = np.array([f'{number}' for number in range(1000, 1000 + num_orders)], dtype=object)
+    order_numbers[rng.random(num_orders) < 0.03] = 'ABC-1'
+    order_values = np.round(rng.normal(60, 50, num_orders), 2).astype(object)
+    order_values[rng.random(num_orders) < 0.03] = 'n/a'
+
+    return pd.DataFrame({'order_number': order_numbers,
+                         'item_line_number': rng.integers(1, 5, num_orders),
+                         'webshop_country': rng.choice(['DE', 'FH', 'AT', 'CH', 'UNKNOWN', 'FR'], num_orders, p=[0.45, 0.1, 0.2, 0.15, 0.05, 0.05]),
+                         'order_date': (pd.Timestamp('2013-01-01') + pd.to_timedelta(rng.integers(0, 300, num_orders), unit='D')).strftime('%Y-%m-%d'),
+                         'shipping_post_code': rng.choice(post_codes, num_orders),
+                         'net_order_value_euros': order_values,
+                         'return_quantity': np.where(rng.random(num_orders) < 0.7, np.nan, rng.integers(0, 2, num_orders)),
+                         'quantity_sold': 1,
+                         'cancellation_flag': rng.random(num_orders) < 0.1})
+
+
+def test_vectorized_basic_cleaning_matches_basic_cleaning():
+    df = make_raw_orders()
+
+    df_vectorized = vectorized_basic_cleaning(df)
+
+    assert_frame_equal(df_vectorized, basic_cleaning(df.copy()))
+    assert 0 < len(df_vectorized) < len(df)
+
+
+def test_vectorized_basic_cleaning_lean_dtypes_keep_values():
+    df = make_raw_orders(random_seed=1)
+
+    df_lean = vectorized_basic_cleaning(df, lean_dtypes=True)
+    df_expected = basic_cleaning(df.copy())
+
+    assert df_lean['webshop_country'].dtype == 'category' and df_lean['net_order_value_euros'].dtype == 'float32'
+    assert_frame_equal(df_lean, df_expected, check_dtype=False, check_categorical=False)
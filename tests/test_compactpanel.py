@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.main.did import did_preprocessing
+from omnichannelstrategy.preprocessing.aggregation import vectorized_aggregate_treated_df
+from omnichannelstrategy.preprocessing.compactpanel import CompactPanel
+from omnichannelstrategy.preprocessing.treatment import vectorized_apply_treat_control
+from tests.test_treatment import DF_STORES, make_orders
+
+
+def make_panel(num_orders: int=400, random_seed: int=0) -> pd.DataFrame:
+    # aggregated panel of sampled orders with the postal code data (coordinates, credit score) merged onto it
+    df = vectorized_apply_treat_control(make_orders(num_orders=num_orders, random_seed=random_seed), DF_STORES, treat_dist=50, early_store_date=[2013, 4, 1])
+    df_panel = vectorized_aggregate_treated_df(df, DF_STORES)
+
+    rng = np.random.default_rng(random_seed)
+    post_codes = df_panel['shipping_post_code'].unique()
+    df_post_codes = pd.DataFrame({'shipping_post_code': post_codes,
+                                  'latitude': np.where(rng.random(len(post_codes)) < 0.1, np.nan, rng.uniform(47, 55, len(post_codes))),
+                                  'credit_score': rng.normal(100, 10, len(post_codes)),
+                                  'population_density_per_sqkm': rng.lognormal(5, 1, len(post_codes))})
+
+    return pd.merge(df_panel, df_post_codes, how='left', on='shipping_post_code')
+
+
+def test_from_long_round_trip():
+    df = make_panel()
+    panel = CompactPanel.from_long(df)
+
+    assert set(panel.attributes.columns) == {'treatment_store_opening_date', 'treatment_store_distance', 'treatment_store', 'Treatment', 'Group', 'latitude', 'credit_score',
+                                             'population_density_per_sqkm'}
+    assert set(panel.quarter_columns) == {f'q_since_open_{city}' for city in DF_STORES.index}
+    assert_frame_equal(panel.to_long(), df.sort_values(['shipping_post_code', 'year_quarter']).reset_index(drop=True))
+
+
+def test_from_long_keeps_measures_that_look_constant():
+    ## no returns at all and `Post` equal for all postal codes in a quarter: both are still measures
+    df = make_panel()
+    df['number_of_returned_items'] = 0.0
+    df['Post'] = (df['year_quarter'] >= pd.Period('2015Q1', freq='Q')).astype('float')
+
+    panel = CompactPanel.from_long(df)
+
+    assert {'number_of_returned_items', 'Post'} <= set(panel.measures)
+    assert_frame_equal(panel.to_long(), df.sort_values(['shipping_post_code', 'year_quarter']).reset_index(drop=True))
+
+
+def test_from_long_time_varying_attribute():
+    df = make_panel()
+    df.loc[df.index[1], 'credit_score'] += 1
+
+    with pytest.raises(ValueError, match="credit_score"):
+        CompactPanel.from_long(df)
+
+
+@pytest.mark.parametrize('dropna', [True, False])
+def test_did_preprocessing_compact_matches_long(dropna):
+    df = make_panel()
+
+    df_long = did_preprocessing(df, first_quarter='2013Q2', dropna=dropna)
+    df_compact = did_preprocessing(CompactPanel.from_long(df), first_quarter='2013Q2', dropna=dropna)
+
+    df_long = df_long.sort_values(['shipping_post_code', 'year_quarter']).reset_index(drop=True)
+    assert_frame_equal(df_compact, df_long)
@@ -0,0 +1,162 @@
+import haversine as hs
+import numpy as np
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.preprocessing import coordinates
+from omnichannelstrategy.preprocessing.coordinates import (save_geodata_store, open_geodata_store, lookup_geodata, post_code_key, map_store_distance,
+                                                           extract_unique_post_codes_and_add_coordinates, reconcile_coordinates, choose_correct_coordinates)
+
+
+DF_STORES = pd.DataFrame({'city': ['city1'], 'store_latitude': [51.34], 'store_longitude': [12.37]})
+
+## coordinates and addresses of the local fake geocoders
+POST_CODES = {('DE', '04109'): (51.34, 12.37, 'Leipzig, Germany'),
+              ('AT', '8010'): (47.07, 15.44, 'Graz, Austria'),
+              ('CH', '8010'): (47.37, 8.54, 'Zurich, Switzerland'),
+              ('DE', '99999'): (np.nan, np.nan, 'Germany')}
+
+
+class FakeGmapsClient():
+    # google maps client with the `geocode` result format used by `get_gmaps_coordinates`
+    COUNTRIES = {'Germany': 'DE', 'Austria': 'AT', 'Switzerland': 'CH'}
+
+    def geocode(self, query: str) -> list:
+        post_code, country = query.split(" ")[2:4]
+        latitude, longitude, address = POST_CODES[(self.COUNTRIES[country], post_code)]
+
+        if np.isnan(latitude):
+            return []
+
+        return [{'geometry': {'location': {'lat': latitude, 'lng': longitude}}, 'formatted_address': address,
+                 'address_components': [{'short_name': post_code}]}]
+
+
+class FakeNominatim():
+    # pgeocode instance of one country, slightly different coordinates than google maps
+    def __init__(self, country: str):
+        self.country = country
+
+    def query_postal_code(self, post_codes: list) -> pd.DataFrame:
+        values = [POST_CODES.get((self.country, post_code), (np.nan, np.nan, None)) for post_code in post_codes]
+
+        return pd.DataFrame({'latitude': [value[0] + 0.01 for value in values], 'longitude': [value[1] + 0.01 for value in values]})
+
+
+def test_lookup_geodata_empty_store(tmp_path):
+    df_coordinates = pd.DataFrame({'webshop_country': pd.Series([], dtype=str), 'shipping_post_code': pd.Series([], dtype=str),
+                                   'latitude': pd.Series([], dtype=float), 'longitude': pd.Series([], dtype=float)})
+
+    save_geodata_store(df_coordinates, DF_STORES, str(tmp_path / 'geodata.arrow'))
+    df = lookup_geodata(open_geodata_store(str(tmp_path / 'geodata.arrow')), ['DE', 'AT'], ['04109', '8010'])
+
+    assert list(df.columns) == ['latitude', 'longitude', 'dist_city1']
+    assert len(df) == 2 and df.isna().all().all()
+
+
+def test_lookup_geodata_missing_post_code(tmp_path):
+    df_coordinates = pd.DataFrame({'webshop_country': ['DE'], 'shipping_post_code': ['04109'], 'latitude': [51.34], 'longitude': [12.37]})
+
+    save_geodata_store(df_coordinates, DF_STORES, str(tmp_path / 'geodata.arrow'))
+    df = lookup_geodata(open_geodata_store(str(tmp_path / 'geodata.arrow')), ['DE', 'AT'], ['04109', '8010'])
+
+    assert np.isclose(df.loc[0, 'latitude'], 51.34)
+    assert df.loc[1].isna().all()
+
+
+def test_post_code_key_only_digits():
+    countries = ['DE', 'AT', 'CH', 'DE', 'DE', 'DE', 'AT', 'DE', 'FR', 'DE']
+    post_codes = ['04109', '1010', '8010', '1e3', '12.5', ' 123', '123456', None, '75001', '']
+
+    keys = post_code_key(countries, post_codes)
+
+    np.testing.assert_array_equal(keys, [104109, 201010, 308010, -1, -1, -1, -1, -1, -1, -1])
+
+
+def test_extract_unique_post_codes_adds_pgeocode_coordinates(monkeypatch):
+    monkeypatch.setattr(coordinates, 'get_nominatim', FakeNominatim)
+    df = pd.DataFrame({'webshop_country': ['DE', 'AT', 'CH', 'DE', 'AT', 'DE'], 'shipping_post_code': ['04109', '8010', '8010', '04109', '8010', '99999']})
+
+    df_post_codes = extract_unique_post_codes_and_add_coordinates(df, gmaps_client=FakeGmapsClient())
+
+    df_post_codes = df_post_codes.set_index(['webshop_country', 'shipping_post_code'])
+    assert len(df_post_codes) == 4
+    assert np.isclose(df_post_codes.loc[('CH', '8010'), 'gmaps_lat'], 47.37) and np.isclose(df_post_codes.loc[('CH', '8010'), 'geopd_lat'], 47.38)
+    assert np.isclose(df_post_codes.loc[('AT', '8010'), 'geopd_lng'], 15.45)
+    assert df_post_codes.loc[('DE', '99999'), ['gmaps_lat', 'geopd_lat']].isna().all()
+
+
+def test_extract_unique_post_codes_reconciles_sources(monkeypatch):
+    monkeypatch.setattr(coordinates, 'get_nominatim', FakeNominatim)
+    df = pd.DataFrame({'webshop_country': ['DE', 'AT', 'DE'], 'shipping_post_code': ['04109', '8010', '99999']})
+    df_spo = pd.DataFrame({'webshop_country': ['DE'], 'shipping_post_code': ['99999'], 'spo_lat': [50.0], 'spo_lng': [10.0]})
+
+    df_post_codes = extract_unique_post_codes_and_add_coordinates(df, gmaps_client=FakeGmapsClient(), df_spo=df_spo).set_index('shipping_post_code')
+
+    assert df_post_codes['coordinate_source'].to_dict() == {'04109': 'gmaps', '8010': 'gmaps', '99999': 'spo'}
+    assert np.isclose(df_post_codes.loc['99999', 'latitude'], 50.0) and np.isclose(df_post_codes.loc['8010', 'longitude'], 15.44)
+
+
+def test_extract_unique_post_codes_without_post_codes(monkeypatch):
+    ## no geocoding and no google maps client needed
+    monkeypatch.setattr(coordinates, 'get_nominatim', FakeNominatim)
+    df = pd.DataFrame({'webshop_country': ['DE', 'AT'], 'shipping_post_code': ['04109', '8010']})
+    df_spo = pd.DataFrame({'webshop_country': ['DE'], 'shipping_post_code': ['99999'], 'spo_lat': [50.0], 'spo_lng': [10.0]})
+
+    df_post_codes = extract_unique_post_codes_and_add_coordinates(df, gmaps_client=FakeGmapsClient(), df_spo=df_spo)
+    df_empty = extract_unique_post_codes_and_add_coordinates(df.iloc[:0], df_spo=df_spo)
+
+    assert len(df_empty) == 0
+    assert list(df_empty.columns) == list(df_post_codes.columns)
+    assert_frame_equal(extract_unique_post_codes_and_add_coordinates(df.iloc[:0], pgeocode_coordinates=False), df_empty, check_dtype=False)
+
+
+def test_reconcile_coordinates_sources():
+    df = pd.DataFrame({'gmaps_address': ['Leipzig, Germany', 'Leipzig, Germany', 'Somewhere, France', None, 'Graz, Austria', None],
+                       'gmaps_lat': [51.3, np.nan, 48.8, np.nan, 47.1, np.nan],
+                       'gmaps_lng': [12.4, 12.4, 2.3, np.nan, 15.4, np.nan],
+                       'geopd_lat': [51.0, 51.1, 48.0, np.nan, 47.0, np.nan],
+                       'geopd_lng': [12.0, 12.1, 9.0, np.nan, 15.0, np.nan],
+                       'spo_lat': [50.0, 50.1, 50.2, 50.3, np.nan, np.nan],
+                       'spo_lng': [10.0, 10.1, 10.2, 10.3, np.nan, np.nan]})
+
+    df_reconciled = reconcile_coordinates(df)
+
+    ## valid gmaps wins over a different pgeocode location, missing gmaps latitude or foreign address falls back to pgeocode, then spo
+    assert df_reconciled['coordinate_source'].tolist() == ['gmaps', 'pgeocode', 'pgeocode', 'spo', 'gmaps', None]
+    np.testing.assert_array_equal(df_reconciled['latitude'], [51.3, 51.1, 48.0, 50.3, 47.1, np.nan])
+    np.testing.assert_array_equal(df_reconciled['longitude'], [12.4, 12.1, 9.0, 10.3, 15.4, np.nan])
+
+    ## same as `choose_correct_coordinates` where its result is valid and pgeocode is given
+    legacy = df.apply(lambda row: choose_correct_coordinates(row.copy()), axis=1, result_type='expand').to_numpy()
+    rows = [0, 2, 4]
+    np.testing.assert_array_equal(df_reconciled[['latitude', 'longitude']].to_numpy()[rows], legacy[rows])
+
+
+def legacy_map_store_distance(df: pd.DataFrame, df_stores: pd.DataFrame) -> pd.DataFrame:
+    # row-wise `haversine` per store (implementation of `map_store_distance` before the broadcast distance matrix)
+    def apply_haversine(store_coordinates, row):
+        try:
+            return round(hs.haversine(store_coordinates, (row['latitude'], row['longitude'])))
+        except:
+            return np.nan
+
+    for city in df_stores.city:
+        store_coordinates = (df_stores.set_index(keys="city").loc[city].store_latitude, df_stores.set_index(keys="city").loc[city].store_longitude)
+        df[f"dist_{city}"] = df.apply(lambda row: apply_haversine(store_coordinates, row), axis=1)
+
+    return df
+
+
+def test_map_store_distance_matches_haversine_package():
+    rng = np.random.default_rng(0)
+    df_stores = pd.DataFrame({'city': ['leipzig', 'graz', 'zurich'], 'store_latitude': [51.34, 47.07, 47.37], 'store_longitude': [12.37, 15.44, 8.54]})
+    df = pd.DataFrame({'latitude': rng.uniform(45, 56, 300), 'longitude': rng.uniform(5, 17, 300)})
+    df.loc[:4, ['latitude', 'longitude']] = [[np.nan, 10.0], [50.0, np.nan], [95.0, 10.0], [50.0, -190.0], [-90.0, 180.0]]
+
+    df_distances = map_store_distance(df.copy(), df_stores)
+
+    assert (df_distances[['dist_leipzig', 'dist_graz', 'dist_zurich']].dtypes == 'float32').all()
+    assert df_distances.loc[:3, 'dist_leipzig'].isna().all() and df_distances['dist_leipzig'].notna().sum() == 296
+    assert_frame_equal(df_distances, legacy_map_store_distance(df.copy(), df_stores), check_dtype=False)
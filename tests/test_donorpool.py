@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.main.donorpool import composite_donors, correlation_donor_filter, knn_donor_filter, prune_donor_pool
+
+
+def make_scm_frame(trajectories: dict, covariates: dict=None) -> pd.DataFrame:
+    # frame in the format of `scm_preprocessing` from {postal code: order values per quarter} and {postal code: (credit_score, population density)}
+    rows = []
+    for post_code, order_values in trajectories.items():
+        credit_score, population_density = (covariates or {}).get(post_code, (100.0, 500.0))
+        for quarter, order_value in enumerate(order_values):
+            rows.append({'shipping_post_code': post_code, 'q_since_observation': quarter, 'order_value': order_value,
+                         'order_value_2013Q2': order_values[0], 'credit_score': credit_score, 'population_density_per_sqkm': population_density})
+
+    return pd.DataFrame(rows)
+
+
+TREATED = [1.0, 2.0, 4.0, 3.0, 5.0, 6.0]
+
+
+def test_knn_donor_filter_standardizes_covariates():
+    rng = np.random.default_rng(0)
+    covariates = {'treated': (100.0, 500.0)}
+    covariates.update({f'pc{idx:02d}': (rng.normal(100, 10), rng.lognormal(6, 1)) for idx in range(30)})
+    df = make_scm_frame({post_code: rng.random(6) * 100 for post_code in covariates}, covariates)
+    df.loc[df['shipping_post_code'] == 'pc00', 'credit_score'] = np.nan
+
+    donors = knn_donor_filter(df, 'treated', num_donors=5)
+
+    ## brute force: euclidean distance of the covariates standardized with the control group, missing covariates at the mean
+    df_units = df.groupby('shipping_post_code')[['credit_score', 'population_density_per_sqkm', 'order_value_2013Q2']].first()
+    df_controls = df_units.drop(index='treated')
+    standardized = ((df_units - df_controls.mean()) / df_controls.std()).fillna(0)
+    distances = np.linalg.norm(standardized.drop(index='treated') - standardized.loc['treated'], axis=1)
+
+    assert donors == list(df_controls.index[np.argsort(distances)[:5]])
+    assert sorted(knn_donor_filter(df, 'treated', num_donors=30)) == list(df_controls.index)
+
+
+def test_correlation_donor_filter_order_and_screening():
+    treated = np.array(TREATED)
+    df = make_scm_frame({'treated': treated,
+                         'scaled': 2 * treated + 1,
+                         'reversed': -treated,
+                         'noisy': treated + np.array([0.5, -0.5, 0.5, -0.5, 0.5, -0.5]),
+                         'constant': np.ones(6),
+                         'post_only_break': np.append(treated[:4], [50.0, -50.0])})
+
+    ## pre-period: the first 4 quarters, the break after them does not count (ties in order of the postal codes)
+    donors = correlation_donor_filter(df, 'treated', treatment_period=4)
+
+    assert donors[:2] == ['post_only_break', 'scaled']
+    assert donors[2:] == ['noisy', 'reversed'] and 'constant' not in donors
+    assert correlation_donor_filter(df, 'treated', treatment_period=4, min_correlation=0) == donors[:3]
+    assert correlation_donor_filter(df, 'treated', treatment_period=4, num_donors=1) == donors[:1]
+
+
+def test_composite_donors_combine_clusters():
+    ## two groups of donors with clearly different pre-period trajectories
+    df = make_scm_frame({'treated': TREATED,
+                         'up1': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+                         'up2': [1.2, 2.2, 3.2, 4.2, 5.0, 7.0],
+                         'down1': [6.0, 5.0, 4.0, 3.0, 2.0, 1.0],
+                         'down2': [6.4, 5.4, 4.4, 3.4, 2.0, 2.0],
+                         'down3': [5.6, 4.6, 3.6, 2.6, 2.0, 0.0]})
+
+    df_composite, donor_clusters = composite_donors(df, 'treated', treatment_period=4, num_clusters=2)
+
+    assert donor_clusters['up1'] == donor_clusters['up2'] != donor_clusters['down1'] == donor_clusters['down2'] == donor_clusters['down3']
+    assert sorted(df_composite['shipping_post_code'].unique()) == sorted(set(donor_clusters) | {'treated'})
+    assert list(df_composite.columns) == list(df.columns)
+
+    ## composite donor: mean of its postal codes per quarter
+    df_down = df_composite[df_composite['shipping_post_code'] == donor_clusters['down1']].reset_index(drop=True)
+    expected = df[df['shipping_post_code'].str.startswith('down')].groupby('q_since_observation', as_index=False)['order_value'].mean()
+    assert_frame_equal(df_down[['q_since_observation', 'order_value']], expected)
+
+
+def test_composite_donors_post_code_without_pre_period():
+    df = make_scm_frame({'treated': TREATED, 'up1': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0], 'down1': [6.0, 5.0, 4.0, 3.0, 2.0, 1.0]})
+    df = pd.concat([df, make_scm_frame({'late': [7.0, 8.0]}).assign(q_since_observation=[4, 5])], ignore_index=True)
+
+    with pytest.raises(ValueError, match="late"):
+        composite_donors(df, 'treated', treatment_period=4, num_clusters=2)
+
+
+def test_prune_donor_pool_stages():
+    rng = np.random.default_rng(1)
+    trajectories = {'treated': np.array(TREATED)}
+    trajectories.update({f'pc{idx:02d}': np.array(TREATED) * rng.uniform(0.5, 2) + rng.normal(0, 1, 6) for idx in range(40)})
+    df = make_scm_frame(trajectories, {post_code: (rng.normal(100, 10), rng.lognormal(6, 1)) for post_code in trajectories})
+
+    df_knn = prune_donor_pool(df, 'treated', treatment_period=4, num_knn=20)
+    df_correlated = prune_donor_pool(df, 'treated', treatment_period=4, num_knn=20, num_correlated=10)
+    df_composite = prune_donor_pool(df, 'treated', treatment_period=4, num_knn=20, num_correlated=10, num_clusters=3)
+
+    assert df_knn['shipping_post_code'].nunique() == 21 and df_correlated['shipping_post_code'].nunique() == 11
+    assert set(df_correlated['shipping_post_code']) <= set(df_knn['shipping_post_code'])
+    assert set(df_composite['shipping_post_code']) == {'treated', 'composite_0', 'composite_1', 'composite_2'}
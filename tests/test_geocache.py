@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from omnichannelstrategy.preprocessing.geocache import GeocodeCache, cached_geocode
+
+
+def test_get_many_returns_requested_keys_only(tmp_path):
+    cache = GeocodeCache(str(tmp_path / 'geocode.sqlite'))
+    cache.put_many({('DE', f'{post_code:05d}'): (50.0, 10.0, f'address {post_code}') for post_code in range(1000)})
+    cache.put_many({('AT', '8010'): (np.nan, np.nan, None)})
+
+    keys = [('DE', f'{post_code:05d}') for post_code in range(0, 1000, 2)] + [('AT', '8010'), ('CH', '8010')]
+    results = cache.get_many(keys, batch_size=64)
+
+    assert set(results) == set(keys[:-1])
+    assert results[('DE', '00998')] == (50.0, 10.0, 'address 998')
+    assert np.isnan(results[('AT', '8010')][0])
+
+
+def test_cached_geocode_caches_results_of_other_keys_on_failure(tmp_path):
+    cache_path = str(tmp_path / 'geocode.sqlite')
+    keys = [('DE', f'{post_code:05d}') for post_code in range(20)]
+
+    def geocode_function(country, post_code):
+        if post_code == '00003':
+            raise ConnectionError("geocoding service unavailable")
+        return (50.0, 10.0, f'{country} {post_code}')
+
+    with pytest.raises(ConnectionError):
+        cached_geocode(keys, geocode_function, cache_path=cache_path, max_workers=4)
+
+    assert set(GeocodeCache(cache_path).get_many(keys)) == set(keys) - {('DE', '00003')}
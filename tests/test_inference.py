@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from omnichannelstrategy.main.inference import (permutation_inference, permutation_p_values, pooled_permutation_test, post_effects, rmspe_ratios,
+                                                stack_placebo_gaps)
+
+
+## 2 cities x 4 units (treated unit first) x 4 periods, city2 has only 2 placebo units (padded with NaN)
+GAPS = np.array([[[1.0, -1.0, 3.0, 3.0],
+                  [1.0, 1.0, 1.0, -1.0],
+                  [2.0, 2.0, 4.0, 4.0],
+                  [1.0, 1.0, -6.0, -6.0]],
+                 [[1.0, 1.0, 10.0, 10.0],
+                  [1.0, 1.0, 1.0, 1.0],
+                  [1.0, 1.0, 2.0, 2.0],
+                  [np.nan, np.nan, np.nan, np.nan]]])
+
+
+def make_model(treated_outcome: np.ndarray, synth_outcome: np.ndarray, control_outcome: np.ndarray, placebo_outcome: np.ndarray, periods_pre_treatment: int):
+    # fitted model with in-space placebos (attributes of `original_data` used by `stack_placebo_gaps`)
+    periods_all, n_controls = control_outcome.shape
+
+    return SimpleNamespace(original_data=SimpleNamespace(treated_outcome_all=treated_outcome.reshape(-1, 1), synth_outcome=synth_outcome.reshape(1, -1),
+                                                         n_controls=n_controls, periods_all=periods_all, periods_pre_treatment=periods_pre_treatment,
+                                                         in_space_placebos=[(placebo_outcome[:, [unit]] - control_outcome[:, [unit]]) for unit in range(n_controls)]))
+
+
+def test_rmspe_ratios_and_effects():
+    pre_rmspe, post_rmspe, ratios = rmspe_ratios(GAPS, 2)
+
+    np.testing.assert_allclose(pre_rmspe, [[1, 1, 2, 1], [1, 1, 1, np.nan]])
+    np.testing.assert_allclose(post_rmspe, [[3, 1, 4, 6], [10, 1, 2, np.nan]])
+    np.testing.assert_allclose(ratios, [[3, 1, 2, 6], [10, 1, 2, np.nan]])
+    np.testing.assert_allclose(post_effects(GAPS, 2), [[3, 0, 4, -6], [10, 1, 2, np.nan]])
+
+    ## one number of pre-treatment periods per city
+    np.testing.assert_allclose(rmspe_ratios(GAPS, [2, 2])[2], ratios)
+    np.testing.assert_allclose(post_effects(GAPS, [1, 3]), [[5 / 3, 1 / 3, 10 / 3, -11 / 3], [10, 1, 2, np.nan]])
+
+
+@pytest.mark.parametrize('alternative, expected', [('greater', [2 / 4, 1 / 3]), ('less', [3 / 4, 3 / 3]), ('two-sided', [3 / 4, 1 / 3])])
+def test_permutation_p_values(alternative, expected):
+    ## NaN (padded) units are not counted
+    effects = post_effects(GAPS, 2)
+
+    np.testing.assert_allclose(permutation_p_values(effects, alternative=alternative), expected)
+
+
+def test_permutation_p_values_of_rmspe_ratios():
+    _, _, ratios = rmspe_ratios(GAPS, 2)
+
+    np.testing.assert_allclose(permutation_p_values(ratios), [2 / 4, 1 / 3])
+
+    with pytest.raises(ValueError, match="alternative"):
+        permutation_p_values(ratios, alternative='larger')
+
+
+def test_pooled_permutation_test_exact_and_random():
+    _, _, ratios = rmspe_ratios(GAPS, 2)
+
+    ## 4 x 3 assignments, the mean ratio is at least 6.5 for (3, 10) and (6, 10)
+    exact = pooled_permutation_test(ratios, num_permutations=12)
+    assert exact == {'statistic': 6.5, 'p_value': 2 / 12, 'num_permutations': 12, 'exact': True}
+
+    ## fewer permutations than assignments: random draws (in batches), the observed assignment counts as one
+    sampled = pooled_permutation_test(ratios, num_permutations=11, random_seed=1, batch_size=4)
+    assert sampled['num_permutations'] == 11 and not sampled['exact'] and round(sampled['p_value'] * 12, 9).is_integer()
+
+    sampled = pooled_permutation_test(ratios, num_permutations=10, random_seed=1, batch_size=4)
+    assert sampled == pooled_permutation_test(ratios, num_permutations=10, random_seed=1, batch_size=10)
+
+    with pytest.raises(ValueError, match="treated unit"):
+        pooled_permutation_test(ratios[:, ::-1])
+
+
+def test_stack_placebo_gaps_flips_placebo_sign():
+    rng = np.random.default_rng(0)
+    control_outcome, placebo_outcome = rng.normal(size=(4, 3)), rng.normal(size=(4, 3))
+    treated_outcome, synth_outcome = rng.normal(size=4), rng.normal(size=4)
+
+    models = {'city1': make_model(treated_outcome, synth_outcome, control_outcome, placebo_outcome, 2),
+              'city2': make_model(treated_outcome[:3], synth_outcome[:3], control_outcome[:3, :2], placebo_outcome[:3, :2], 1)}
+
+    gaps, periods_pre_treatment, cities = stack_placebo_gaps(models)
+
+    assert gaps.shape == (2, 4, 4) and cities == ['city1', 'city2']
+    np.testing.assert_array_equal(periods_pre_treatment, [2, 1])
+
+    ## all gaps are outcome - synthetic outcome, padding is NaN
+    np.testing.assert_allclose(gaps[0, 0], treated_outcome - synth_outcome)
+    np.testing.assert_allclose(gaps[0, 1:], (control_outcome - placebo_outcome).T)
+    np.testing.assert_allclose(gaps[1, 1:3, :3], (control_outcome[:3, :2] - placebo_outcome[:3, :2]).T)
+    assert np.isnan(gaps[1, 3]).all() and np.isnan(gaps[1, :, 3]).all()
+
+    models['city2'].original_data.in_space_placebos = None
+    with pytest.raises(ValueError, match="In-space placebos"):
+        stack_placebo_gaps(models)
+
+
+def test_permutation_inference_table():
+    df = permutation_inference(GAPS, 2, cities=['city1', 'city2'], num_permutations=12)
+
+    assert list(df.index) == ['city1', 'city2', 'pooled']
+    np.testing.assert_allclose(df['post/pre'], [3, 10, 6.5])
+    np.testing.assert_allclose(df['p_value'], [2 / 4, 1 / 3, 2 / 12])
+    np.testing.assert_allclose(df['effect_p_value'][:2], [3 / 4, 1 / 3])
+    np.testing.assert_allclose(df['num_placebos'], [3, 2, 5])
+
+    ## pooled averaged effect (two-sided): share of the 12 assignments with an absolute mean effect at least 6.5
+    effects = post_effects(GAPS, 2)
+    means = np.add.outer(effects[0], effects[1][:3]) / 2
+    assert df.loc['pooled', 'effect_p_value'] == np.mean(np.abs(means) >= 6.5)
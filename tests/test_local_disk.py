@@ -0,0 +1,73 @@
+import pandas as pd
+import pyarrow.parquet as pq
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.data_sources.local_disk import (iter_local_parquet, save_local_parquet_batches, get_local_parquet, _periods_to_str,
+                                                          save_local_partitioned_parquet, get_local_partitioned_parquet)
+from omnichannelstrategy.preprocessing.cleaning import iter_basic_cleaning, vectorized_basic_cleaning
+from tests.test_cleaning import make_raw_orders
+from tests.test_compactpanel import make_panel
+
+
+def test_cleaned_chunks_round_trip(tmp_path):
+    ## chunks with different value ranges: only DE orders and only returns of 0/1 in the first chunk, a large return quantity in the last one
+    df_raw = make_raw_orders(num_orders=900)
+    df_raw.loc[:299, 'webshop_country'] = 'DE'
+    df_raw.loc[:599, 'return_quantity'] = df_raw.loc[:599, 'return_quantity'].clip(upper=1)
+    df_raw.loc[600:, 'return_quantity'] = 300.0
+    df_raw['net_order_value_euros'] = df_raw['net_order_value_euros'].astype(str)
+    df_raw.to_parquet(str(tmp_path / 'raw.parquet'), row_group_size=300)
+
+    chunks = iter_basic_cleaning(iter_local_parquet(str(tmp_path / 'raw.parquet'), batch_size=300), lean_dtypes=True)
+    num_rows = save_local_parquet_batches(chunks, str(tmp_path / 'clean.parquet'))
+
+    df_expected = pd.concat([vectorized_basic_cleaning(df_raw.iloc[start:start + 300], lean_dtypes=True) for start in range(0, 900, 300)])
+    df = get_local_parquet(str(tmp_path / 'clean.parquet'))
+
+    assert pq.ParquetFile(str(tmp_path / 'clean.parquet')).num_row_groups == 3 and num_rows == len(df_expected)
+    assert_frame_equal(df, df_expected.reset_index(drop=True))
+
+
+def sort_panel(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    # rows of a loaded dataset are ordered by partition
+    return df[columns].sort_values(['shipping_post_code', 'year_quarter']).reset_index(drop=True)
+
+
+def test_periods_to_str():
+    filters = [[('year_quarter', '>=', pd.Period('2015Q3', freq='Q')), ('Group', 'in', ['Non_Store'])],
+               [('year_quarter', 'in', {pd.Period('2013Q2', freq='Q')})]]
+
+    assert _periods_to_str(filters) == [[('year_quarter', '>=', '2015Q3'), ('Group', 'in', ['Non_Store'])],
+                                        [('year_quarter', 'in', ['2013Q2'])]]
+
+
+def test_partitioned_round_trip(tmp_path):
+    df = make_panel()
+
+    save_local_partitioned_parquet(df, str(tmp_path / 'panel'))
+    df_loaded = get_local_partitioned_parquet(str(tmp_path / 'panel'))
+
+    ## Periods are written as strings and turned back into Periods, the partition columns are the last columns
+    assert list(df_loaded.columns[-2:]) == ['year_quarter', 'Group']
+    assert isinstance(df_loaded['year_quarter'].dtype, pd.PeriodDtype)
+    assert_frame_equal(sort_panel(df_loaded, df.columns), sort_panel(df, df.columns))
+
+    ## an existing dataset is replaced
+    save_local_partitioned_parquet(df[df['Group'] == 'Non_Store'], str(tmp_path / 'panel'))
+    assert (get_local_partitioned_parquet(str(tmp_path / 'panel'))['Group'] == 'Non_Store').all()
+    assert [path.name for path in tmp_path.iterdir()] == ['panel']
+
+
+def test_partitioned_filters(tmp_path):
+    df = make_panel()
+    save_local_partitioned_parquet(df, str(tmp_path / 'panel'))
+
+    filters = [[('year_quarter', '>=', pd.Period('2015Q1', freq='Q')), ('Group', 'in', ['Non_Store', 'Early_Store'])],
+               [('year_quarter', '=', pd.Period('2013Q2', freq='Q')), ('credit_score', '>', 100)]]
+    df_loaded = get_local_partitioned_parquet(str(tmp_path / 'panel'), columns=['shipping_post_code', 'year_quarter', 'Group', 'credit_score'], filters=filters)
+
+    mask = (((df['year_quarter'] >= pd.Period('2015Q1', freq='Q')) & df['Group'].isin(['Non_Store', 'Early_Store'])) |
+            ((df['year_quarter'] == pd.Period('2013Q2', freq='Q')) & (df['credit_score'] > 100)))
+    columns = ['shipping_post_code', 'year_quarter', 'Group', 'credit_score']
+    assert_frame_equal(sort_panel(df_loaded, columns), sort_panel(df[mask], columns))
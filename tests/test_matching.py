@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+
+from pandas.testing import assert_frame_equal
+from sklearn.neighbors import NearestNeighbors
+
+from omnichannelstrategy.main.did import get_nearest_neighbors
+from omnichannelstrategy.main.matching import add_nearest_neighbors
+from tests.test_compactpanel import make_panel
+
+
+def legacy_get_nearest_neighbors(input_df: pd.DataFrame, num_neighbors: int=1) -> pd.DataFrame:
+    # unstandardized matching with merges (implementation of `get_nearest_neighbors` before the `MatchingIndex`)
+    df = input_df
+
+    earliest_yq = df.year_quarter.min()
+    df_obs = df[df['year_quarter'] == earliest_yq]
+    df_obs = df_obs[['Treatment', 'credit_score', 'population_density_per_sqkm', 'order_value_firstQ']]
+    Control_df = df_obs[df_obs['Treatment'] == 0].loc[:, df_obs.columns != 'Treatment']
+    Treatment_df = df_obs[df_obs['Treatment'] == 1].loc[:, df_obs.columns != 'Treatment']
+
+    neigh = NearestNeighbors()
+    neigh.fit(Control_df)
+    neighbor_index = neigh.kneighbors(X=Treatment_df, n_neighbors=num_neighbors, return_distance=False).flatten()
+
+    result_df = Control_df.iloc[neighbor_index].reset_index()
+    result_df = result_df.drop(columns=['credit_score', 'population_density_per_sqkm', 'order_value_firstQ'])
+
+    df_Control_Shipping_Code = pd.merge(result_df, df, how='left', left_on='index', right_index=True)
+    df_Control_Shipping_Code = df_Control_Shipping_Code[['shipping_post_code']]
+
+    df_Matched_Controls = pd.merge(df_Control_Shipping_Code, df, how='left', left_on='shipping_post_code', right_on='shipping_post_code')
+    df_Matched_Controls['Group'] = "Matched_Control"
+
+    return pd.concat([df, df_Matched_Controls]).reset_index()
+
+
+def make_matching_panel() -> pd.DataFrame:
+    # panel with the baseline `order_value_firstQ` (order value of the earliest quarter) of each postal code
+    df = make_panel()
+    df_first = df[df['year_quarter'] == df['year_quarter'].min()][['shipping_post_code', 'order_value']]
+
+    return pd.merge(df, df_first.rename(columns={'order_value': 'order_value_firstQ'}), how='left', on='shipping_post_code')
+
+
+@pytest.mark.parametrize('num_neighbors', [1, 3])
+def test_unstandardized_matching_matches_legacy_neighbors(num_neighbors):
+    df = make_matching_panel()
+
+    df_legacy = legacy_get_nearest_neighbors(df, num_neighbors=num_neighbors)
+
+    assert (df_legacy['Group'] == "Matched_Control").sum() > 0
+    assert_frame_equal(get_nearest_neighbors(df, num_neighbors=num_neighbors, standardize=False), df_legacy)
+    assert_frame_equal(add_nearest_neighbors(df, num_neighbors=num_neighbors, standardize=False), df_legacy)
+
+
+def test_standardized_matching_differs_from_legacy_neighbors():
+    ## population density (lognormal, scale ~100s) dominates the unstandardized distance
+    df = make_matching_panel()
+
+    df_standardized = add_nearest_neighbors(df, num_neighbors=3)
+    df_legacy = legacy_get_nearest_neighbors(df, num_neighbors=3)
+
+    assert len(df_standardized) == len(df_legacy)
+    assert not df_standardized['shipping_post_code'].equals(df_legacy['shipping_post_code'])
@@ -0,0 +1,53 @@
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.preprocessing.cleaning import vectorized_basic_cleaning
+from omnichannelstrategy.preprocessing.coordinates import map_store_distance
+from omnichannelstrategy.preprocessing.parallel import add_coordinates, parallel_order_preprocessing, run_sharded
+from omnichannelstrategy.preprocessing.treatment import vectorized_apply_treat_control
+from tests.test_cleaning import make_raw_orders
+
+
+def test_run_sharded_matches_serial_stages():
+    rng = np.random.default_rng(0)
+    post_codes = [f'{post_code:05d}' for post_code in range(1000, 1040)]
+
+    df = pd.DataFrame({'shipping_post_code': rng.choice(post_codes, size=500),
+                       'order_date': pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.permutation(500), unit='D'),
+                       'net_order_value_euros': rng.random(500)})
+    df_coordinates = pd.DataFrame({'shipping_post_code': post_codes, 'latitude': rng.random(40), 'longitude': rng.random(40)})
+
+    ## the reference frame is bound to the stage and sent to the workers by the pool initializer
+    df_parallel = run_sharded(df, [partial(add_coordinates, df_coordinates=df_coordinates)], num_workers=2, num_shards=5)
+    df_serial = add_coordinates(df, df_coordinates).sort_values(by='order_date', kind='mergesort').reset_index(drop=True)
+
+    assert_frame_equal(df_parallel, df_serial)
+
+
+def test_parallel_order_preprocessing_matches_serial_pipeline():
+    df_raw = make_raw_orders(num_orders=600)
+    df_stores = pd.DataFrame({'city': ['city1', 'city2', 'city3'],
+                              'store_latitude': [51.3, 48.1, 50.1],
+                              'store_longitude': [12.4, 11.6, 8.7],
+                              'opening_date': ['01/06/2012', '15/03/2013', '01/06/2013']}).set_index('city', drop=False)
+
+    rng = np.random.default_rng(1)
+    post_codes = vectorized_basic_cleaning(df_raw)['shipping_post_code'].unique()
+    df_coordinates = pd.DataFrame({'shipping_post_code': post_codes, 'latitude': rng.uniform(48, 52, len(post_codes)),
+                                   'longitude': rng.uniform(8, 13, len(post_codes))})
+    ## 04109 is next to the store opened after the early_store_date
+    df_coordinates.loc[df_coordinates['shipping_post_code'] == '04109', ['latitude', 'longitude']] = [50.2, 8.6]
+
+    df_parallel = parallel_order_preprocessing(df_raw, df_stores, df_coordinates=df_coordinates, num_workers=2, num_shards=3, treat_dist=150)
+
+    df_serial = add_coordinates(vectorized_basic_cleaning(df_raw), df_coordinates)
+    df_serial = vectorized_apply_treat_control(map_store_distance(df_serial, df_stores), df_stores, treat_dist=150)
+
+    ## same order for rows with the same order_date
+    sort_columns = ['order_date', 'order_number', 'item_line_number']
+    assert_frame_equal(df_parallel.sort_values(sort_columns).reset_index(drop=True), df_serial.sort_values(sort_columns).reset_index(drop=True))
+    assert isinstance(df_parallel['Treatment_store_opening_date'].dtype, pd.PeriodDtype) and (df_parallel['Treatment'] == 1).any()
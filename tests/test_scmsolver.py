@@ -0,0 +1,202 @@
+import contextlib
+import io
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from omnichannelstrategy.main import placebo, scmsolver
+from omnichannelstrategy.main.scmplotting import CustomSynth
+from omnichannelstrategy.main.scmsolver import fit_synthetic_control, loss_within_tolerance, project_to_simplex
+
+
+def make_panel(num_controls: int=30, num_periods: int=20, treatment_period: int=13, random_seed: int=1) -> pd.DataFrame:
+    # two latent factors, the treated unit has an effect of 3 from the treatment period on
+    rng = np.random.default_rng(random_seed)
+    factors = rng.normal(size=(num_periods, 2)).cumsum(axis=0)
+
+    rows = []
+    for unit in range(num_controls + 1):
+        loadings = rng.random(2)
+        outcome = factors @ loadings + rng.normal(0, 0.2, num_periods) + (3 * (np.arange(num_periods) >= treatment_period) if unit == 0 else 0)
+        for period in range(num_periods):
+            rows.append(('treated' if unit == 0 else f'pc{unit:03d}', period, outcome[period], loadings[0] + rng.normal(0, 0.1), rng.random()))
+
+    return pd.DataFrame(rows, columns=['shipping_post_code', 'q', 'order_value', 'credit_score', 'x'])
+
+
+def fit(df: pd.DataFrame, pen, solver: str):
+    with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+        warnings.simplefilter('ignore')
+        return CustomSynth(df, 'order_value', 'shipping_post_code', 'q', 13, 'treated', n_optim=1, pen=pen, solver=solver).original_data
+
+
+def pre_treatment_loss(data) -> float:
+    residual = data.treated_outcome[:data.periods_pre_treatment].ravel() - data.control_outcome[:data.periods_pre_treatment] @ data.w.ravel()
+    return float(residual @ residual)
+
+
+def test_native_weights_match_library_with_penalty():
+    df = make_panel()
+    library, native = fit(df, 100, 'library'), fit(df, 100, 'native')
+
+    np.testing.assert_allclose(native.w, library.w, atol=1e-4)
+    assert loss_within_tolerance(pre_treatment_loss(native), pre_treatment_loss(library))
+
+
+@pytest.mark.parametrize('random_seed', [1, 2])
+def test_native_loss_within_tolerance_without_penalty(random_seed):
+    df = make_panel(random_seed=random_seed)
+    library, native = fit(df, 0, 'library'), fit(df, 0, 'native')
+
+    assert loss_within_tolerance(pre_treatment_loss(native), pre_treatment_loss(library))
+
+    ## deterministic: refitting gives the same weights
+    np.testing.assert_array_equal(fit(df, 0, 'native').w, native.w)
+
+
+def test_fit_synthetic_control_falls_back_without_valid_run():
+    rng = np.random.default_rng(0)
+    control_outcome, control_covariates = rng.normal(size=(10, 5)), rng.random((2, 5))
+    treated_outcome, treated_covariates = np.full(10, np.nan), control_covariates[:, :2].mean(axis=1)
+    w0 = np.array([0.5, 0.5, 0.5, -1.0, 0.0])
+
+    result = fit_synthetic_control(treated_outcome, treated_covariates, control_outcome, control_covariates,
+                                   treated_covariates[:, np.newaxis] - control_covariates, pen=1, n_optim=2, w0=w0)
+
+    np.testing.assert_allclose(result['w'].ravel(), project_to_simplex(w0))
+    np.testing.assert_allclose(result['v'], [0.5, 0.5])
+
+    result = fit_synthetic_control(treated_outcome, treated_covariates, control_outcome, control_covariates,
+                                   treated_covariates[:, np.newaxis] - control_covariates, pen=1, n_optim=2)
+
+    np.testing.assert_allclose(result['w'].ravel(), np.full(5, 0.2))
+
+
+def test_in_space_placebo_worker_uses_native_solver():
+    data = fit(make_panel(num_controls=8), 100, 'native')
+    placebo._SHARED.update(control_outcome_all=(None, data.control_outcome_all), control_covariates=(None, data.control_covariates))
+
+    try:
+        unit, w = placebo._fit_in_space_placebo(3, data.periods_pre_treatment, 1, 0, solver="native")
+    finally:
+        placebo._SHARED.clear()
+
+    treated_outcome, treated_covariates, control_outcome, control_covariates = placebo.placebo_matrices(data.control_outcome_all, data.control_covariates, 3)
+    expected = fit_synthetic_control(treated_outcome[:data.periods_pre_treatment], treated_covariates,
+                                     control_outcome[:data.periods_pre_treatment], control_covariates, treated_covariates - control_covariates,
+                                     pen="auto", n_optim=1, rng=np.random.default_rng([0, 3]), broadcast_covariates=True)
+
+    assert unit == 3
+    np.testing.assert_array_equal(w, expected['w'])
+
+
+def serial_in_space_placebos(model, n_optim: int, random_seed: int, solver: str) -> list:
+    # placebo outcomes of all control units fitted one after another in the main process (same per-unit seeds as the workers)
+    data = model.original_data
+    placebo._SHARED.update(control_outcome_all=(None, data.control_outcome_all), control_covariates=(None, data.control_covariates))
+
+    try:
+        placebo_outcomes = []
+        for unit in range(data.n_controls):
+            _, w = placebo._fit_in_space_placebo(unit, data.periods_pre_treatment, n_optim, random_seed, solver=solver)
+            placebo_outcomes.append(w.T @ np.delete(data.control_outcome_all, unit, axis=1).T)
+    finally:
+        placebo._SHARED.clear()
+
+    return placebo_outcomes
+
+
+@pytest.mark.parametrize('solver', ['native', 'library'])
+def test_shared_memory_placebos_match_serial_fits(solver):
+    with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+        warnings.simplefilter('ignore')
+        model = CustomSynth(make_panel(num_controls=5), 'order_value', 'shipping_post_code', 'q', 13, 'treated', n_optim=1, pen=100, solver=solver)
+        rmspe_df = placebo.run_in_space_placebos(model, n_optim=2, num_workers=2, random_seed=5)
+        in_space_placebos = model.original_data.in_space_placebos
+
+        placebo_outcomes = serial_in_space_placebos(model, n_optim=2, random_seed=5, solver=solver)
+
+    ## serial results stored in the same structures (up to the tolerance of the optimizers, which run in other processes)
+    data = model.original_data
+    data.rmspe_df = data.rmspe_df.iloc[:1]
+    model._pre_post_rmspe_ratios(placebo_outcomes)
+
+    assert len(rmspe_df) == data.n_controls + 1 and not rmspe_df.isna().any().any()
+    pd.testing.assert_frame_equal(rmspe_df, data.rmspe_df, rtol=1e-3)
+    np.testing.assert_allclose(np.concatenate(in_space_placebos), np.concatenate(model._normalize_placebos(placebo_outcomes)), atol=1e-3)
+
+
+def sweep(df: pd.DataFrame, placebo_periods: list, treatment_period=13, num_workers: int=None) -> pd.DataFrame:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return placebo.in_time_placebo_sweep(df, 'order_value', 'shipping_post_code', 'q', 'treated', placebo_periods,
+                                             treatment_period=treatment_period, n_optim=1, num_workers=num_workers)
+
+
+def test_in_time_placebo_matrices_match_custom_synth():
+    df = make_panel(num_controls=8)
+    data = fit(df.assign(q=df['q'] + 4), 0, 'native')
+
+    ## treatment period 13 of the shifted panel is the 9th period
+    matrices = placebo.sweep_matrices(df, 'order_value', 'shipping_post_code', 'q', 'treated')
+    treated_outcome, treated_covariates, control_outcome, control_covariates = placebo.in_time_placebo_matrices(matrices['outcome_all'], matrices['covariate_sums'],
+                                                                                                                data.periods_pre_treatment)
+
+    assert data.periods_pre_treatment == 9
+    np.testing.assert_allclose(treated_outcome, data.treated_outcome[:9])
+    np.testing.assert_allclose(control_outcome, data.control_outcome[:9])
+    np.testing.assert_allclose(treated_covariates, data.treated_covariates)
+    np.testing.assert_allclose(control_covariates, data.control_covariates)
+
+
+def test_in_time_placebo_windows_end_before_treatment():
+    ## the effect of 3 starts in period 13
+    df = make_panel(num_controls=8)
+
+    df_placebos = sweep(df, [11, 9])
+    df_unbounded = sweep(df, [9, 11], treatment_period=None)
+
+    assert df_placebos['placebo_period'].tolist() == [9, 11] and df_placebos['periods_pre_treatment'].tolist() == [9, 11]
+    np.testing.assert_allclose(df_placebos['pre_rmspe'], df_unbounded['pre_rmspe'])
+    assert (df_placebos['effect'].abs() < 1).all() and (df_unbounded['effect'] > 1).all()
+
+    for placebo_period in [0, 13, 15]:
+        with pytest.raises(ValueError, match=f"Placebo period {placebo_period}"):
+            sweep(df, [9, placebo_period])
+
+
+def test_in_time_placebo_sweep_parallel_matches_serial():
+    df = make_panel(num_controls=8)
+
+    df_serial = sweep(df, [8, 9, 10, 11])
+    df_parallel = sweep(df, [8, 9, 10, 11], num_workers=2)
+
+    pd.testing.assert_frame_equal(df_parallel, df_serial, rtol=1e-3)
+
+
+def test_warm_start_only_for_the_same_donors(monkeypatch):
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = CustomSynth(make_panel(num_controls=5), 'order_value', 'shipping_post_code', 'q', 13, 'treated', n_optim=1, pen=100, solver='native')
+    data, starts = model.original_data, []
+
+    def recording_fit(*args, w0=None, **kwargs):
+        starts.append(w0)
+        return fit_synthetic_control(*args, w0=w0, **kwargs)
+
+    monkeypatch.setattr(scmsolver, 'fit_synthetic_control', recording_fit)
+
+    ## in-space placebos: every placebo unit has a different donor set of the same size
+    with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+        warnings.simplefilter('ignore')
+        model.in_space_placebo(n_optim=1)
+    assert len(starts) == 5 and all(w0 is None for w0 in starts)
+
+    ## in-time placebo after a refit of the model: same donors (shorter pre-treatment period)
+    model.optimize(data.treated_outcome, data.treated_covariates, data.control_outcome, data.control_covariates, data.pairwise_difference, data, False, 100, 1)
+    starts.clear()
+    with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+        warnings.simplefilter('ignore')
+        model.in_time_placebo(9, n_optim=1)
+    assert len(starts) == 1 and starts[0] is not None
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pandas.testing import assert_frame_equal
+from sklearn.metrics.pairwise import haversine_distances
+
+from omnichannelstrategy.preprocessing.spatialindex import EARTH_RADIUS_KM, PostCodeIndex, coordinates_fingerprint, get_post_code_index
+from omnichannelstrategy.preprocessing.treatment import apply_treat_control_by_post_code, post_code_treatment_table
+
+
+DF_STORES = pd.DataFrame({'city': ['leipzig', 'graz', 'zurich'],
+                          'store_latitude': [51.34, 47.07, 47.37],
+                          'store_longitude': [12.37, 15.44, 8.54],
+                          'opening_date': ['01/06/2014', '15/03/2015', '01/10/2016']}).set_index('city', drop=False)
+
+## 8010 is Graz in AT and Zurich in CH
+DF_COORDINATES = pd.DataFrame({'webshop_country': ['DE', 'AT', 'CH', 'AT'],
+                               'shipping_post_code': ['04109', '8010', '8010', '1010'],
+                               'latitude': [51.34, 47.07, 47.38, 48.21],
+                               'longitude': [12.37, 15.44, 8.50, 16.37]})
+
+
+def make_orders() -> pd.DataFrame:
+    # one order per postal code with the (rounded) store distances like `map_store_distance`
+    df = DF_COORDINATES.copy()
+    order_date = pd.to_datetime(['2016-01-10', '2016-02-10', '2017-03-10', '2016-04-10'])
+
+    df['order_number'] = np.arange(len(df), dtype='float64')
+    df['item_line_number'] = 1
+    df['order_date'] = order_date
+    df['net_order_value_euros'] = 50.0
+    df['return_quantity'] = 0
+    df['year_quarter'] = pd.PeriodIndex(order_date, freq='Q')
+    df['year_month'] = pd.PeriodIndex(order_date, freq='M')
+
+    distances = haversine_distances(np.radians(df[['latitude', 'longitude']].to_numpy()),
+                                    np.radians(DF_STORES[['store_latitude', 'store_longitude']].to_numpy())) * EARTH_RADIUS_KM
+    for idx, city in enumerate(DF_STORES.index):
+        df[f'dist_{city}'] = np.round(distances[:, idx])
+
+    return df
+
+
+def test_same_post_code_in_several_countries():
+    df_treatment = post_code_treatment_table(make_orders(), DF_STORES, treat_dist=50, post_code_index=PostCodeIndex(DF_COORDINATES))
+
+    df_treatment = df_treatment.set_index(['webshop_country', 'shipping_post_code'])
+    assert df_treatment.loc[('AT', '8010'), 'Treatment_store_1'] == 'graz'
+    assert df_treatment.loc[('CH', '8010'), 'Treatment_store_1'] == 'zurich'
+    assert df_treatment.loc[('AT', '1010'), 'Treatment_store_1'] == ''
+
+
+@pytest.mark.parametrize('drop_cities', [[], ['graz']])
+def test_post_code_index_matches_distance_columns(drop_cities):
+    df = make_orders()
+    country_list = ['DE', 'AT', 'CH']
+
+    df_distances = apply_treat_control_by_post_code(df, DF_STORES, treat_dist=300, country_list=country_list, drop_cities=drop_cities)
+    df_index = apply_treat_control_by_post_code(df, DF_STORES, treat_dist=300, country_list=country_list, drop_cities=drop_cities,
+                                                post_code_index=PostCodeIndex(DF_COORDINATES))
+
+    assert_frame_equal(df_index, df_distances)
+    assert ('graz' in df_index['Treatment_store_1'].to_numpy()) == (drop_cities == [])
+
+
+def test_coordinates_fingerprint_depends_on_order_and_values():
+    fingerprint = coordinates_fingerprint(DF_COORDINATES)
+
+    assert coordinates_fingerprint(DF_COORDINATES.copy()) == fingerprint
+    assert coordinates_fingerprint(DF_COORDINATES.iloc[::-1]) != fingerprint
+    assert coordinates_fingerprint(DF_COORDINATES.assign(latitude=DF_COORDINATES['latitude'] + 0.01)) != fingerprint
+
+
+def test_get_post_code_index_rebuilds_for_changed_coordinates(tmp_path):
+    file_path = str(tmp_path / 'post_code_index.joblib')
+
+    get_post_code_index(DF_COORDINATES, file_path)
+    assert get_post_code_index(DF_COORDINATES, file_path).fingerprint == coordinates_fingerprint(DF_COORDINATES)
+
+    df_moved = DF_COORDINATES.assign(latitude=DF_COORDINATES['latitude'].iloc[::-1].to_numpy())
+    assert get_post_code_index(df_moved, file_path).fingerprint == coordinates_fingerprint(df_moved)
+
+
+def test_duplicate_post_codes_in_coordinates():
+    ## the first row of a duplicated postal code is used
+    df_coordinates = pd.concat([DF_COORDINATES, DF_COORDINATES.iloc[[1]].assign(latitude=48.21, longitude=16.37)], ignore_index=True)
+
+    df_treatment = post_code_treatment_table(make_orders(), DF_STORES, treat_dist=50, post_code_index=PostCodeIndex(df_coordinates))
+
+    assert_frame_equal(df_treatment, post_code_treatment_table(make_orders(), DF_STORES, treat_dist=50, post_code_index=PostCodeIndex(DF_COORDINATES)))
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pandas.testing import assert_frame_equal
+from scipy.stats.mstats import winsorize
+
+from omnichannelstrategy.preprocessing.compactpanel import CompactPanel
+from omnichannelstrategy.data_sources.local_disk import save_local_partitioned_parquet
+from omnichannelstrategy.preprocessing.syntheticcontrol import (SCMBatchPreprocessor, SCMScaler, batch_scm_preprocessing, load_scm_panel,
+                                                                scm_preprocessing, scm_scaler)
+from tests.test_treatment import DF_STORES
+
+
+def legacy_scm_scaler(df_input: pd.DataFrame, column_scaling: dict={}, column_winsor: dict={}) -> pd.DataFrame:
+    # column-by-column pandas/winsorize implementation of `scm_scaler` before `SCMScaler`
+    df = df_input.copy()
+
+    for column, scaling in column_scaling.items():
+        for scaler in scaling:
+            if scaler == 'minmax':
+                df[f'{column}_minmax'] = (df[column] - df[column].min()) / (df[column].max() - df[column].min())
+
+            if scaler == 'meannormal':
+                df[f'{column}_meannormal'] = (df[column] - df[column].mean()) / (df[column].max() - df[column].min())
+
+            if scaler == 'standard':
+                df[f'{column}_standard'] = (df[column] - df[column].mean()) / df[column].std()
+
+            if column in column_winsor.keys():
+                limits = column_winsor.get(column, [0.05, 0.05])
+                df[f'{column}_{scaler}_winsor'] = winsorize(df[f'{column}_{scaler}'], limits=limits)
+
+    return df
+
+
+def make_panel(num_rows: int=60, random_seed: int=0) -> pd.DataFrame:
+    # skewed columns without NaN, with a few NaN and with mostly NaN
+    rng = np.random.default_rng(random_seed)
+    df = pd.DataFrame({'order_value': rng.lognormal(3, 1, num_rows),
+                       'orders': rng.poisson(4, num_rows).astype('float64'),
+                       'return_rate': rng.random(num_rows),
+                       'distance': rng.gamma(2, 20, num_rows)})
+    df.loc[rng.choice(num_rows, 5, replace=False), 'orders'] = np.nan
+    df.loc[rng.choice(num_rows, num_rows - 2, replace=False), 'distance'] = np.nan
+
+    return df
+
+
+COLUMN_SCALING = {'order_value': ['minmax', 'meannormal', 'standard'], 'orders': ['minmax', 'standard'],
+                  'return_rate': ['standard'], 'distance': ['minmax']}
+
+
+@pytest.mark.parametrize('limits', [[0.05, 0.05], [0, 0], [0, 0.1], [0.1, 0], [0.2, 0.2]])
+def test_scm_scaler_matches_legacy(limits):
+    df = make_panel()
+    column_winsor = {column: limits for column in COLUMN_SCALING}
+
+    df_scaled = scm_scaler(df, COLUMN_SCALING, column_winsor)
+
+    assert_frame_equal(df_scaled, legacy_scm_scaler(df, COLUMN_SCALING, column_winsor))
+
+
+def test_scm_scaler_nan_rows_take_upper_bound():
+    df = make_panel()
+    df_scaled = scm_scaler(df, {'orders': ['minmax']}, {'orders': [0, 0.1]})
+
+    nan_rows = df['orders'].isna()
+    assert (df_scaled.loc[nan_rows, 'orders_minmax_winsor'] == df_scaled['orders_minmax_winsor'].max()).all()
+    assert df_scaled.loc[~nan_rows, 'orders_minmax_winsor'].notna().all()
+
+    ## without upper limit NaN values are kept
+    df_scaled = scm_scaler(df, {'orders': ['minmax']}, {'orders': [0.05, 0]})
+    assert df_scaled['orders_minmax_winsor'].isna().sum() == nan_rows.sum()
+
+
+def test_scm_scaler_fitted_statistics_on_other_data():
+    df, df_other = make_panel(random_seed=0), make_panel(random_seed=1)
+    column_winsor = {'order_value': [0.05, 0.05]}
+
+    scaler = SCMScaler(COLUMN_SCALING, column_winsor).fit(df)
+    df_other_scaled = scaler.transform(df_other)
+
+    mean, std = df['order_value'].mean(), df['order_value'].std()
+    np.testing.assert_allclose(df_other_scaled['order_value_standard'], (df_other['order_value'] - mean) / std)
+    assert df_other_scaled['order_value_standard_winsor'].max() <= scaler.fit_transform(df)['order_value_standard_winsor'].max()
+
+
+def test_scm_scaler_unknown_method():
+    with pytest.raises(ValueError, match="mean_normal"):
+        SCMScaler({'orders': ['mean_normal']})
+
+
+@pytest.fixture(scope='module')
+def df_panel() -> pd.DataFrame:
+    from tests.test_compactpanel import make_panel
+
+    return make_panel()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_batch_scm_preprocessing_matches_scm_preprocessing(df_panel, compact):
+    treatment_areas = ['city2', 'city3', 'city4']
+    df_input = CompactPanel.from_long(df_panel) if compact else df_panel
+
+    frames = batch_scm_preprocessing(df_input, treatment_areas, num_quarter_before=4, num_quarter_after=4, earliest_quarter='2012Q1',
+                                     additional_columns={'latitude': 'mean'})
+
+    for treatment_area in treatment_areas:
+        df_expected = scm_preprocessing(df_panel, treatment_area, num_quarter_before=4, num_quarter_after=4, earliest_quarter='2012Q1',
+                                        additional_columns={'latitude': 'mean'})
+
+        assert treatment_area in df_expected['shipping_post_code'].to_numpy()
+        assert_frame_equal(frames[treatment_area], df_expected)
+
+
+def test_batch_scm_preprocessing_unknown_treatment_area(df_panel):
+    batch = SCMBatchPreprocessor(CompactPanel.from_long(df_panel), treatment_areas=['city2'])
+
+    with pytest.raises(ValueError, match="city3"):
+        batch.city_frame('city3', earliest_quarter='2012Q1')
+
+
+def test_load_scm_panel_reads_needed_rows(df_panel, tmp_path):
+    save_local_partitioned_parquet(df_panel, str(tmp_path / 'panel'))
+
+    df_loaded = load_scm_panel(str(tmp_path / 'panel'), DF_STORES, 'city3', num_quarter_before=4, num_quarter_after=4, earliest_quarter='2012Q1')
+
+    assert len(df_loaded) < len(df_panel)
+    assert_frame_equal(scm_preprocessing(df_loaded, 'city3', num_quarter_before=4, num_quarter_after=4, earliest_quarter='2012Q1'),
+                       scm_preprocessing(df_panel, 'city3', num_quarter_before=4, num_quarter_after=4, earliest_quarter='2012Q1'))
@@ -0,0 +1,128 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pandas.testing import assert_frame_equal
+
+from omnichannelstrategy.preprocessing.treatment import (POST_CODE_KEY, apply_treat_control, apply_treat_control_by_post_code, post_code_treatment_table,
+                                                        treat_control_sweep, vectorized_apply_treat_control)
+
+
+DF_STORES = pd.DataFrame({'opening_date': ['01/06/2012', '15/03/2014', '01/10/2015', '20/02/2016', '01/01/2017']},
+                         index=pd.Index(['city1', 'city2', 'city3', 'city4', 'city5'], name='city'))
+
+
+def make_orders(num_orders: int=300, random_seed: int=0) -> pd.DataFrame:
+    # sampled order lines with store distances between 0 and 200 km (some unknown) in DE and AT
+    rng = np.random.default_rng(random_seed)
+    order_date = pd.Timestamp('2012-01-01') + pd.to_timedelta(rng.integers(0, 2500, num_orders), unit='D')
+
+    df = pd.DataFrame({'order_number': np.arange(num_orders, dtype='float64'),
+                       'item_line_number': rng.integers(1, 4, num_orders),
+                       'webshop_country': rng.choice(['DE', 'DE', 'DE', 'AT'], num_orders),
+                       'order_date': order_date,
+                       'shipping_post_code': [f'{post_code:05d}' for post_code in rng.integers(1000, 99999, num_orders)],
+                       'net_order_value_euros': rng.random(num_orders) * 100,
+                       'return_quantity': rng.integers(0, 2, num_orders),
+                       'year_quarter': pd.PeriodIndex(order_date, freq='Q'),
+                       'year_month': pd.PeriodIndex(order_date, freq='M')})
+
+    for city in DF_STORES.index:
+        df[f'dist_{city}'] = np.where(rng.random(num_orders) < 0.05, np.nan, rng.integers(0, 200, num_orders).astype('float64'))
+
+    return df
+
+
+def num_stores_in_range(df: pd.DataFrame, treat_dist: int) -> pd.Series:
+    return (df[[f'dist_{city}' for city in DF_STORES.index]] < treat_dist).sum(axis=1)
+
+
+@pytest.mark.parametrize('treat_dist, early_store_date', [(50, [2013, 4, 1]), (120, [2016, 1, 1])])
+def test_vectorized_matches_row_wise_assignment(treat_dist, early_store_date):
+    df = make_orders()
+
+    df_legacy = apply_treat_control(df.copy(), DF_STORES, treat_dist=treat_dist, early_store_date=early_store_date)
+    df_nearest = vectorized_apply_treat_control(df.copy(), DF_STORES, treat_dist=treat_dist, early_store_date=early_store_date)
+    df_legacy_rule = vectorized_apply_treat_control(df.copy(), DF_STORES, treat_dist=treat_dist, early_store_date=early_store_date, multiple_stores="legacy")
+
+    assert_frame_equal(df_legacy_rule, df_legacy)
+
+    ## the closest store is the same as in the row-wise assignment unless three or more stores are within treat_dist
+    fewer_stores = (num_stores_in_range(df_legacy, treat_dist) < 3).to_numpy()
+    assert_frame_equal(df_nearest[fewer_stores], df_legacy[fewer_stores])
+
+
+def test_three_stores_in_range_takes_closest_store():
+    df = make_orders(num_orders=1)
+    df.loc[0, ['webshop_country', 'dist_city1', 'dist_city2', 'dist_city3', 'dist_city4', 'dist_city5']] = ['DE', 40.0, 10.0, 150.0, 30.0, 150.0]
+
+    ## row-wise: first (city1, 40 km) and last store (city4, 30 km) within 50 km are compared, the closest store city2 (10 km) is never considered
+    df_legacy = apply_treat_control(df.copy(), DF_STORES, treat_dist=50)
+    df_nearest = vectorized_apply_treat_control(df.copy(), DF_STORES, treat_dist=50)
+
+    assert df_legacy.loc[0, 'Treatment_store_1'] == 'city4'
+    assert df_nearest.loc[0, 'Treatment_store_1'] == 'city2' and df_nearest.loc[0, 'Treatment_store_distance'] == 10.0
+    assert vectorized_apply_treat_control(df.copy(), DF_STORES, treat_dist=50, multiple_stores="legacy").loc[0, 'Treatment_store_1'] == 'city4'
+
+
+def test_unknown_multiple_stores_option():
+    with pytest.raises(ValueError, match="multiple_stores"):
+        vectorized_apply_treat_control(make_orders(num_orders=5), DF_STORES, multiple_stores="first")
+
+
+@pytest.mark.parametrize('treat_dist, early_store_date', [(50, [2013, 4, 1]), (120, [2016, 1, 1])])
+def test_by_post_code_matches_row_wise_assignment(treat_dist, early_store_date):
+    ## the distances only depend on the postal code (like `map_store_distance`)
+    df = make_orders(num_orders=400)
+    dist_columns = [f'dist_{city}' for city in DF_STORES.index]
+    df[dist_columns] = df.groupby(POST_CODE_KEY)[dist_columns].transform('first')
+
+    df_legacy = apply_treat_control(df.copy(), DF_STORES, treat_dist=treat_dist, early_store_date=early_store_date)
+    df_post_code = apply_treat_control_by_post_code(df.copy(), DF_STORES, treat_dist=treat_dist, early_store_date=early_store_date)
+
+    fewer_stores = (num_stores_in_range(df_legacy, treat_dist) < 3).to_numpy()
+    assert fewer_stores.sum() > 100
+    assert_frame_equal(df_post_code[fewer_stores], df_legacy[fewer_stores])
+
+
+def test_by_post_code_missing_in_treatment_table():
+    df = make_orders(num_orders=20)
+    df_treatment = post_code_treatment_table(df.iloc[:10], DF_STORES)
+
+    with pytest.raises(ValueError, match=f"DE {df.loc[df['webshop_country'] == 'DE', 'shipping_post_code'].iloc[-1]}"):
+        apply_treat_control_by_post_code(df, DF_STORES, df_treatment=df_treatment)
+
+
+@pytest.mark.parametrize('multiple_stores', ["nearest", "legacy"])
+def test_treat_control_sweep_matches_single_configurations(multiple_stores):
+    df = make_orders(num_orders=400)
+    dist_columns = [f'dist_{city}' for city in DF_STORES.index]
+    df[dist_columns] = df.groupby(POST_CODE_KEY)[dist_columns].transform('first')
+
+    treat_dists, early_store_dates = [50, 120], [[2013, 4, 1], [2016, 1, 1]]
+    treatment_tables = treat_control_sweep(df, DF_STORES, treat_dists=treat_dists, early_store_dates=early_store_dates, multiple_stores=multiple_stores)
+
+    assert list(treatment_tables) == ['50km_2013-04-01', '50km_2016-01-01', '120km_2013-04-01', '120km_2016-01-01']
+
+    for treat_dist in treat_dists:
+        for early_store_date in early_store_dates:
+            df_treatment = treatment_tables[f"{treat_dist}km_{date(*early_store_date).isoformat()}"]
+
+            assert_frame_equal(apply_treat_control_by_post_code(df, DF_STORES, df_treatment=df_treatment),
+                               vectorized_apply_treat_control(df, DF_STORES, treat_dist=treat_dist, early_store_date=early_store_date, multiple_stores=multiple_stores))
+
+    df_long = treat_control_sweep(df, DF_STORES, treat_dists=treat_dists, early_store_dates=early_store_dates, multiple_stores=multiple_stores, long_format=True)
+    assert len(df_long) == 4 * len(treatment_tables['50km_2013-04-01']) and df_long['config_id'].nunique() == 4
+
+
+def test_row_wise_assignment_ignores_drop_cities():
+    df = make_orders()
+
+    df_legacy = apply_treat_control(df.copy(), DF_STORES, treat_dist=120, drop_cities=['city2'])
+    df_dropped = vectorized_apply_treat_control(df.copy(), DF_STORES, treat_dist=120, drop_cities=['city2'], multiple_stores="legacy")
+
+    assert_frame_equal(df_legacy, vectorized_apply_treat_control(df.copy(), DF_STORES, treat_dist=120, multiple_stores="legacy"))
+    assert 'city2' in df_legacy['Treatment_store_1'].to_numpy() and 'city2' not in df_dropped['Treatment_store_1'].to_numpy()
+    assert 'dist_city2' not in df_dropped.columns